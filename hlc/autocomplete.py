@@ -0,0 +1,226 @@
+"""
+In-memory prefix index for input suggestions
+"""
+
+import heapq
+import threading
+from bisect import bisect_left, insort
+from collections import namedtuple
+from .db import CatalogueDB
+
+
+Field = namedtuple("Field", ["table", "column", "link_table", "link_column"])
+
+
+class PrefixIndex(object):
+    """
+    Distinct values of a single database column ranked by frequency
+
+    Values are kept in a list sorted by normalized key (see
+    CatalogueDB.name_key), so all values starting with a prefix form a
+    continuous slice that is found with binary search.
+
+    Every value remembers ids of the rows it came from. That allows applying
+    row updates and deletions without rereading the whole column
+
+    Arguments:
+        limit
+            Maximum number of distinct values. Least frequent values are
+            skipped when loading and new values are ignored when the limit
+            is reached, `complete` property becomes False in that case
+    """
+    def __init__(self, limit=10000):
+        self.limit = limit
+        self.complete = True
+        self._entries = list()  # sorted [(key, value)]
+        self._frequency = dict()  # {value: [total weight, number of rows]}
+        self._rows = dict()  # {row_id: (value, weight)}
+
+    def __len__(self):
+        return len(self._frequency)
+
+    def load(self, rows):
+        """Fill the index from (row_id, value, weight) triples"""
+        frequency = dict()
+        for row_id, value, weight in rows:
+            counters = frequency.setdefault(value, [0, 0])
+            counters[0] += weight
+            counters[1] += 1
+        if len(frequency) > self.limit:
+            self.complete = False
+            frequency = dict(heapq.nlargest(
+                self.limit,
+                frequency.items(),
+                key=lambda item: item[1][0]))
+        for row_id, value, weight in rows:
+            if value in frequency:
+                self._rows[row_id] = (value, weight)
+        self._frequency = frequency
+        self._entries = sorted(self._entry(value) for value in frequency)
+
+    def set(self, row_id, value, weight=1):
+        """Replace the value (and its weight) contributed by the row"""
+        self.remove(row_id)
+        if not value:
+            return
+        if value not in self._frequency:
+            if len(self._frequency) >= self.limit:
+                self.complete = False
+                return
+            self._frequency[value] = [0, 0]
+            insort(self._entries, self._entry(value))
+        counters = self._frequency[value]
+        counters[0] += weight
+        counters[1] += 1
+        self._rows[row_id] = (value, weight)
+
+    def remove(self, row_id):
+        """Forget the value contributed by the row"""
+        if row_id not in self._rows:
+            return
+        value, weight = self._rows.pop(row_id)
+        counters = self._frequency[value]
+        counters[0] -= weight
+        counters[1] -= 1
+        if not counters[1]:
+            del self._frequency[value]
+            entry = self._entry(value)
+            position = bisect_left(self._entries, entry)
+            if position < len(self._entries) and self._entries[position] == entry:
+                del self._entries[position]
+
+    @staticmethod
+    def _entry(value):
+        return (CatalogueDB.name_key(value) or "", value)
+
+    def search(self, prefix, count=10):
+        """Return up to `count` most frequent values starting with `prefix`"""
+        prefix = CatalogueDB.name_key(prefix)
+        if not prefix:
+            return list()
+
+        def matching():
+            for position in range(bisect_left(self._entries, (prefix,)), len(self._entries)):
+                key, value = self._entries[position]
+                if not key.startswith(prefix):
+                    break
+                yield value
+
+        return heapq.nsmallest(
+            count,
+            matching(),
+            key=lambda value: (-self._frequency[value][0], value))
+
+
+class Autocomplete(object):
+    """
+    Suggestions for web form fields served from memory
+
+    Prefix index for each field is loaded from the database on first use and
+    is kept up to date by changed() which has to be registered as
+    CatalogueDB listener:
+
+        db.listeners.append(autocomplete.changed)
+
+    Values of fields that refer to catalogue entities (authors, series, tags)
+    are ranked by the number of connected books, other values are ranked by
+    the number of rows they are found in
+
+    Arguments:
+        limit
+            Maximum number of distinct values kept in memory for each field
+    """
+
+    FIELDS = {
+        # form_field: Field(db_table, db_column, link_table, link_column)
+        "title": Field("books", "name", None, None),
+        "author": Field("authors", "name", "book_authors", "author_id"),
+        "publisher": Field("books", "publisher", None, None),
+        "in_type": Field("books", "in_type", None, None),
+        "in_comment": Field("books", "in_comment", None, None),
+        "out_type": Field("books", "out_type", None, None),
+        "out_comment": Field("books", "out_comment", None, None),
+        "series_type": Field("series", "type", None, None),
+        "series_name": Field("series", "name", "book_series", "series_id"),
+        "tags": Field("tags", "name", "book_tags", "tag_id"),
+        "groups": Field("groups", "name", "user_groups", "group_id"),
+    }
+
+    def __init__(self, limit=10000):
+        self.limit = limit
+        self._indexes = dict()  # {form_field: PrefixIndex}
+        self._lock = threading.RLock()
+
+    def suggest(self, db, field, line, count=10):
+        """Return suggestions for the `field` that start with `line`"""
+        if field not in self.FIELDS:
+            return list()
+        with self._lock:
+            index = self._index(db, field)
+            result = index.search(line, count)
+            complete = index.complete
+        if not complete and len(result) < count:
+            table, column = self.FIELDS[field][:2]
+            for value in db.getsuggestions(line, table, column, count):
+                if value not in result and len(result) < count:
+                    result.append(value)
+        return result
+
+    def changed(self, db, item, other=None):
+        """
+        CatalogueDB listener. Updates loaded indexes after `item` was saved or
+        deleted, or after it was connected to/disconnected from `other`
+        """
+        tables = {obj.__TableName__: obj.id for obj in (item, other) if obj is not None}
+        with self._lock:
+            for field, index in self._indexes.items():
+                spec = self.FIELDS[field]
+                if spec.table not in tables:
+                    continue
+                if other is not None and spec.link_table is None:
+                    continue
+                row_id = tables[spec.table]
+                rows = list(self._select(db, spec, row_id))
+                if rows:
+                    index.set(*rows[0])
+                else:
+                    index.remove(row_id)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                field: dict(values=len(index), complete=index.complete)
+                for field, index in self._indexes.items()
+            }
+
+    def _index(self, db, field):
+        if field not in self._indexes:
+            index = PrefixIndex(self.limit)
+            index.load(list(self._select(db, self.FIELDS[field])))
+            self._indexes[field] = index
+        return self._indexes[field]
+
+    def _select(self, db, spec, row_id=None):
+        """Yield (row_id, value, weight) triples for the field"""
+        fields = [spec.table, spec.column, spec.table, spec.column]
+        if spec.link_table is None:
+            query = "SELECT id, %s.%s, 1 FROM %s WHERE %s NOT NULL"
+        else:
+            query = """
+                SELECT id, %s.%s, count(link.%s) FROM %s
+                LEFT JOIN %s AS link ON link.%s = id
+                WHERE %s NOT NULL
+                """
+            fields = [spec.table, spec.column, spec.link_column, spec.table,
+                      spec.link_table, spec.link_column, spec.column]
+        params = ()
+        if row_id is not None:
+            query += " AND id = ?"
+            params = (row_id,)
+        if spec.link_table is not None:
+            query += " GROUP BY id"
+        cursor = db.sql.generic(db.connection, query, fields, params)
+        for row_id, value, weight in db.sql.iterate(cursor):
+            if value:
+                yield row_id, value, weight
@@ -0,0 +1,493 @@
+"""
+Bulk import and export of catalogue data
+"""
+
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime
+from .db import CatalogueDB, SQL
+from .items import ISBN
+from .util import alphanumeric, chunks, debug, message, parse_csv, time2unix
+
+
+# Keys of exported records, in the order of CSV columns. The same keys are
+# accepted by BulkImporter
+RECORD_KEYS = (
+    "title", "authors", "isbn", "publisher", "year", "price", "annotation",
+    "in_date", "in_type", "in_comment", "out_date", "out_type", "out_comment",
+    "tags", "series_name", "series_type", "book_no", "total",
+)
+SERIES_KEYS = RECORD_KEYS[-4:]
+
+
+def read_records(stream, format=None):
+    """
+    Yield books from CSV file or from file with one JSON object per line
+    (JSON lines). Records are dictionaries with the same keys as inputs of
+    book edit form (see BulkImporter)
+
+    Arguments:
+        stream
+            Text file object
+        format
+            "csv" or "jsonl". Guessed from file name if omitted
+    """
+    if format is None:
+        extension = os.path.splitext(getattr(stream, "name", ""))[1].lower()
+        format = "csv" if extension == ".csv" else "jsonl"
+    if format == "csv":
+        yield from csv.DictReader(stream)
+    elif format == "jsonl":
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        raise ValueError("unsupported format: %s" % format)
+
+
+def export_records(db):
+    """
+    Yield all books as dictionaries with RECORD_KEYS. Authors and tags are
+    lists. Series keys are lists of the same length, one item per series
+    of the book
+
+    Books are read with a single SELECT statement (a consistent snapshot)
+    fetched in chunks, so memory usage does not depend on catalogue size
+    """
+    cursor = db.connection.execute("""
+        SELECT
+            books.name, books.isbn, books.publisher, books.year, books.price,
+            books.annotation, books.in_date, books.in_type, books.in_comment,
+            books.out_date, books.out_type, books.out_comment,
+            (SELECT group_concat(authors.name, char(10))
+             FROM book_authors
+             JOIN authors ON authors.id = book_authors.author_id
+             WHERE book_authors.book_id = books.id),
+            (SELECT group_concat(tags.name, char(10))
+             FROM book_tags
+             JOIN tags ON tags.id = book_tags.tag_id
+             WHERE book_tags.book_id = books.id),
+            (SELECT json_group_array(json_array(name, type, book_number, number_books))
+             FROM (SELECT series.name, series.type, book_series.book_number, series.number_books
+                   FROM book_series
+                   JOIN series ON series.id = book_series.series_id
+                   WHERE book_series.book_id = books.id
+                   ORDER BY book_series.series_id))
+        FROM books
+        ORDER BY books.id
+        """)
+    for row in SQL.iterate(cursor):
+        (title, isbn, publisher, year, price, annotation,
+         in_date, in_type, in_comment, out_date, out_type, out_comment,
+         authors, tags, series) = row
+        authors = authors.split("\n") if authors else []
+        tags = tags.split("\n") if tags else []
+        series = list(zip(*json.loads(series))) or [(), (), (), ()]
+        yield dict(zip(RECORD_KEYS, (
+            title, authors, isbn, publisher, year, price, annotation,
+            in_date, in_type, in_comment, out_date, out_type, out_comment,
+            tags) + tuple(map(list, series))))
+
+
+def format_csv(records):
+    """CSV with header row, the format read_records() accepts"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(RECORD_KEYS)
+    yield output.getvalue()
+    for record in records:
+        output.seek(0)
+        output.truncate()
+        record["authors"] = "; ".join(record["authors"])
+        record["tags"] = ", ".join(record["tags"])
+        for key in SERIES_KEYS:
+            record[key] = "; ".join("" if value is None else str(value) for value in record[key])
+        writer.writerow(record[key] for key in RECORD_KEYS)
+        yield output.getvalue()
+
+
+def format_jsonl(records):
+    """One JSON object per line, empty values are omitted"""
+    for record in records:
+        record = {key: value for key, value in record.items() if value or value == 0}
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def format_marc(records):
+    """MARC 21 fields in human readable mnemonic format (MARCMaker .mrk)"""
+    for record in records:
+        fields = [("LDR", "00000nam  2200000 i 4500")]
+        if record["isbn"]:
+            fields.append(("020", "\\\\$a" + record["isbn"]))
+        for num, author in enumerate(record["authors"]):
+            fields.append(("100" if num == 0 else "700", "1\\$a" + author))
+        fields.append(("245", "00$a" + record["title"]))
+        publication = ""
+        if record["publisher"]:
+            publication += "$b" + record["publisher"]
+        if record["year"]:
+            publication += "$c%s" % record["year"]
+        if publication:
+            fields.append(("264", "\\1" + publication))
+        for name, number in zip(record["series_name"], record["book_no"]):
+            series = "0\\$a" + name
+            if number:
+                series += "$v%s" % number
+            fields.append(("490", series))
+        if record["annotation"]:
+            fields.append(("520", "\\\\$a" + record["annotation"].replace("\n", " ")))
+        for tag in record["tags"]:
+            fields.append(("653", "\\\\$a" + tag))
+        if record["price"]:
+            fields.append(("365", "\\\\$b%s" % record["price"]))
+        fields[1:] = sorted(fields[1:], key=lambda field: field[0])
+        yield "".join("=%s  %s\n" % field for field in fields) + "\n"
+
+
+# {format: (formatter, content type, file extension)}
+EXPORT_FORMATS = {
+    "csv": (format_csv, "text/csv", "csv"),
+    "jsonl": (format_jsonl, "application/x-ndjson", "jsonl"),
+    "marc": (format_marc, "text/plain", "mrk"),
+}
+
+
+def export(db, format, chunk_size=1000):
+    """
+    Yield the whole catalogue as text in chunks of `chunk_size` records
+
+    Arguments:
+        db
+            CatalogueDB object
+        format
+            One of EXPORT_FORMATS keys
+    """
+    formatter = EXPORT_FORMATS[format][0]
+    for chunk in chunks(formatter(export_records(db)), chunk_size):
+        yield "".join(chunk)
+
+
+class BulkImporter(object):
+    """
+    Load large amounts of books into CatalogueDB without creating item objects
+    for every row
+
+    Authors, series and tags are matched to existing ones by their name_key
+    (the same way CatalogueDB.get(simplify=True) does) using in-memory maps.
+    Rows are inserted with executemany() in batches. The whole import is a
+    single transaction: either all valid rows are loaded or none.
+
+    Triggers that would fire for every inserted book (book count and ISBN
+    normalization) are dropped for the duration of the import and their
+    effect is applied once at the end.
+
+    Caches of running web application (pages, suggestions) are not aware of
+    the changes, restart it after importing
+
+    Record keys:
+        title, isbn, publisher, year, price, annotation, in_date, in_type,
+        in_comment, out_date, out_type, out_comment
+            Book fields. Dates are Unix timestamps or DD.MM.YYYY strings
+        authors
+            List of names or a string of names separated by semicolons
+        tags
+            List of tags or a comma-separated string
+        series_name, series_type, book_no, total
+            Series of the book. series_type is required for new series.
+            Several series are given as lists or as strings of values
+            separated by semicolons, n-th values of the keys belong to n-th
+            series
+
+    Rows without title and rows with ISBN that is already in the catalogue
+    are skipped. Invalid values of other fields are ignored
+
+    Arguments:
+        db
+            CatalogueDB object
+        batch_size
+            Number of books inserted with one executemany() call
+
+    Attributes (available after run()):
+        rows
+            Number of records read
+        books
+            Number of books inserted
+        skipped
+            Number of records that were not imported
+        seconds
+            Time spent
+    """
+
+    BOOK_FIELDS = (
+        "name", "isbn_user", "isbn", "price", "publisher", "year", "annotation",
+        "in_date", "in_type", "in_comment", "out_date", "out_type", "out_comment",
+    )
+    TEXT_FIELDS = (
+        "publisher", "annotation", "in_type", "in_comment", "out_type", "out_comment",
+    )
+    DEFERRED_TRIGGERS = (
+        "trg_book_count1", "trg_book_count2", "trg_isbn_insert",
+        "trg_book_summary_books_insert", "trg_book_summary_books_update",
+        "trg_book_summary_book_authors_insert", "trg_book_summary_book_series_insert",
+        "trg_book_summary_book_tags_insert",
+    )
+
+    def __init__(self, db, batch_size=5000):
+        self.db = db
+        self.batch_size = batch_size
+        self.rows = 0
+        self.books = 0
+        self.skipped = 0
+        self.seconds = 0
+
+    @property
+    def rate(self):
+        """Records processed per second"""
+        return self.rows / self.seconds if self.seconds else 0
+
+    def run(self, records):
+        """Import books from iterable of dictionaries (see read_records)"""
+        started = time.monotonic()
+        with self.db.writer as connection:
+            if not connection.in_transaction:
+                # otherwise DROP TRIGGER would be committed right away
+                connection.execute("BEGIN")
+            self._load_maps()
+            first_id = self._next["books"]
+            triggers = self._drop_triggers()
+            for batch in chunks(self._parse(records), self.batch_size):
+                self._insert(batch)
+                debug("Imported %s books" % self.books)
+            self._restore_triggers(triggers, first_id)
+            self.db.search_index.update(*range(first_id, self._next["books"]))
+            self.db.writer.touch()
+        self.seconds = time.monotonic() - started
+        message("Imported %s books from %s records (%s skipped) in %.1f s, %d rows/sec"
+                % (self.books, self.rows, self.skipped, self.seconds, self.rate))
+        return self.books
+
+    def _load_maps(self):
+        """Read existing names, ISBNs and series positions into memory"""
+        connection = self.db.connection
+        self._names = dict()  # {table: {name_key: id}}
+        self._seen = dict()  # {table: {name: id}}
+        self._tag_lists = dict()  # {tags string: parsed list}
+        self._new_series = set()  # name keys of series parsed, but not inserted yet
+        self._next = dict()  # {table: next free id}
+        for table in CatalogueDB.NAME_KEYS + ("books",):
+            self._next[table] = 1 + (connection.execute(
+                "SELECT max(id) FROM %s" % table).fetchone()[0] or 0)
+        for table in CatalogueDB.NAME_KEYS:
+            self._seen[table] = dict()
+            self._names[table] = {
+                key: id for key, id in connection.execute(
+                    "SELECT name_key, id FROM %s WHERE name_key NOT NULL" % table)
+            }
+        self._isbns = set(row[0] for row in connection.execute(
+            "SELECT isbn FROM books WHERE isbn NOT NULL"))
+        self._positions = set(tuple(row) for row in connection.execute(
+            "SELECT series_id, book_number FROM book_series WHERE book_number NOT NULL"))
+
+    def _drop_triggers(self):
+        connection = self.db.connection
+        triggers = connection.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN (%s)"
+            % ",".join("?" * len(self.DEFERRED_TRIGGERS)),
+            self.DEFERRED_TRIGGERS).fetchall()
+        for name, sql in triggers:
+            connection.execute("DROP TRIGGER %s" % name)
+        return triggers
+
+    def _restore_triggers(self, triggers, first_id):
+        """Recreate triggers and do what they would have done for new books"""
+        connection = self.db.connection
+        for name, sql in triggers:
+            connection.execute(sql)
+        connection.execute("DELETE FROM app_config WHERE option = 'book_count'")
+        connection.execute(
+            "INSERT INTO app_config (option, value) "
+            "SELECT 'book_count', count(id) FROM books")
+        connection.execute(
+            "DELETE FROM barcode_queue WHERE isbn IN "
+            "(SELECT isbn FROM books WHERE id >= ? AND isbn NOT NULL)",
+            (first_id,))
+        connection.execute(CatalogueDB.book_summary_refresh("books.id >= ?"), (first_id,))
+
+    def _parse(self, records):
+        """Validate records and yield rows for _insert()"""
+        for number, record in enumerate(records, 1):
+            self.rows += 1
+            row, problem = self._parse_one(record)
+            if problem:
+                self.skipped += 1
+                message("Record %s skipped: %s" % (number, problem), 6)
+            else:
+                yield row
+
+    def _parse_one(self, record):
+        record = {key: value for key, value in record.items()
+                  if value is not None and value != ""}
+        book = dict.fromkeys(self.BOOK_FIELDS)
+        book["name"] = str(record.get("title", record.get("name", ""))).strip()
+        if not book["name"]:
+            return None, "no title"
+        isbn = ISBN(record.get("isbn", ""))
+        if isbn.number and isbn.valid:
+            if isbn.number in self._isbns:
+                return None, "ISBN %s is already in catalogue" % isbn.number
+            book["isbn_user"] = str(record["isbn"])
+            book["isbn"] = isbn.number
+        for field in self.TEXT_FIELDS:
+            book[field] = str(record.get(field, "")).strip() or None
+        book["year"] = self._number(record.get("year"), int, 1900, 2100)
+        book["price"] = self._number(record.get("price"), float, 0)
+        for field in ("in_date", "out_date"):
+            book[field] = self._date(record.get(field))
+
+        authors = record.get("authors", record.get("author", ()))
+        if isinstance(authors, str):
+            authors = authors.split(";")
+        authors = [name.strip() for name in authors if name.strip()]
+
+        tags = record.get("tags", ())
+        if isinstance(tags, str):
+            if tags not in self._tag_lists:  # the same lists of tags repeat a lot
+                self._tag_lists[tags] = [tag for tag in parse_csv(tags) if tag]
+            tags = self._tag_lists[tags]
+        else:
+            tags = [tag for tag in map(alphanumeric, tags) if tag]
+
+        series, new_series = list(), set()
+        names, types, numbers, totals = (self._values(record.get(key)) for key in SERIES_KEYS)
+        for num, series_name in enumerate(names):
+            series_name = str(series_name or "").strip()
+            if not series_name:
+                continue
+            key = CatalogueDB.name_key(series_name)
+            series_type = str(types[num] if num < len(types) and types[num] else "").strip()
+            if key not in self._names["series"] and key not in self._new_series:
+                if not series_type:
+                    return None, "series type is required for new series: %s" % series_name
+                new_series.add(key)
+            number = self._number(numbers[num] if num < len(numbers) else None, int, 1)
+            total = self._number(totals[num] if num < len(totals) else None, int, 1)
+            series.append((series_name, series_type, number, total))
+
+        self._new_series.update(new_series)
+        if book["isbn"]:
+            self._isbns.add(book["isbn"])
+        return (book, authors, tags, series), None
+
+    @staticmethod
+    def _values(value):
+        """List of values of a series key"""
+        if value is None:
+            return []
+        if isinstance(value, str):
+            return value.split(";")
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return [value]
+
+    @staticmethod
+    def _number(value, type, minimum=None, maximum=None):
+        try:
+            value = type(value)
+        except (TypeError, ValueError):
+            return None
+        if minimum is not None and value < minimum \
+        or maximum is not None and value > maximum:
+            return None
+        return value
+
+    @staticmethod
+    def _date(value):
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return time2unix(datetime.strptime(str(value).strip(), "%d.%m.%Y"))
+        except ValueError:
+            return None
+
+    def _entity_id(self, table, name, new_rows):
+        """Find id for the name or reserve a new one"""
+        seen = self._seen[table]
+        if name in seen:  # skip normalizing names that repeat verbatim
+            return seen[name]
+        key = CatalogueDB.name_key(name)
+        names = self._names[table]
+        if key and key not in names:
+            names[key] = self._next[table]
+            self._next[table] += 1
+            new_rows.append((names[key], name))
+        seen[name] = names.get(key) if key else None
+        return seen[name]
+
+    def _insert(self, batch):
+        connection = self.db.connection
+        books, links, new = list(), dict(), dict()
+        for table in CatalogueDB.NAME_KEYS:
+            new[table] = list()
+        for table in ("book_authors", "book_tags", "book_series"):
+            links[table] = list()
+        series_updates = dict()
+
+        for book, authors, tags, series in batch:
+            book_id = self._next["books"]
+            self._next["books"] += 1
+            books.append((book_id,) + tuple(book[field] for field in self.BOOK_FIELDS))
+            author_ids = (self._entity_id("authors", name, new["authors"]) for name in authors)
+            for author_id in dict.fromkeys(author_ids):
+                if author_id:
+                    links["book_authors"].append((book_id, author_id))
+            tag_ids = (self._entity_id("tags", name, new["tags"]) for name in tags)
+            for tag_id in dict.fromkeys(tag_ids):
+                if tag_id:
+                    links["book_tags"].append((book_id, tag_id))
+            series_ids = set()
+            for name, type, number, total in series:
+                new_series = list()
+                series_id = self._entity_id("series", name, new_series)
+                if series_id in series_ids:
+                    continue
+                series_ids.add(series_id)
+                if new_series:
+                    new["series"].append((series_id, name, type, total))
+                elif total:
+                    series_updates[series_id] = total
+                if (series_id, number) in self._positions:
+                    number = None
+                elif number:
+                    self._positions.add((series_id, number))
+                links["book_series"].append((book_id, series_id, number))
+
+        connection.executemany(
+            "INSERT INTO authors (id, name) VALUES (?, ?)", new["authors"])
+        connection.executemany(
+            "INSERT INTO tags (id, name) VALUES (?, ?)", new["tags"])
+        connection.executemany(
+            "INSERT INTO series (id, name, type, number_books) VALUES (?, ?, ?, ?)",
+            new["series"])
+        connection.executemany(
+            "UPDATE series SET number_books = ? WHERE id = ?",
+            ((total, id) for id, total in series_updates.items()))
+        connection.executemany(
+            "INSERT INTO books (id, %s) VALUES (?, %s)" % (
+                ", ".join(self.BOOK_FIELDS), ", ".join("?" * len(self.BOOK_FIELDS))),
+            books)
+        for table, columns in (("book_authors", "book_id, author_id"),
+                               ("book_tags", "book_id, tag_id"),
+                               ("book_series", "book_id, series_id, book_number")):
+            connection.executemany(
+                "INSERT INTO %s (%s) VALUES (%s)" % (
+                    table, columns, ",".join("?" * (columns.count(",") + 1))),
+                links[table])
+        self.books += len(books)
@@ -5,8 +5,22 @@ Manage database interaction
 import sqlite3
 import os
 import re
+import json
+import tempfile
+import logging
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 from .items import ISBN, Author, Book, Series, Tag
-from .util import lowercase, alphanumeric, debug, timestamp, printf_replacement
+from .util import (
+    alphanumeric,
+    chunks,
+    debug,
+    lowercase,
+    printf_replacement,
+    timestamp,
+)
 from hashlib import sha224
 
 if sqlite3.sqlite_version_info < (3, 8, 11):
@@ -16,6 +30,16 @@ if sqlite3.sqlite_version_info < (3, 8, 11):
         "Please consider updating at least to 3.8.11"]))
 
 
+# Read-only book data for listing pages (see CatalogueDB.getbookrecords)
+BookRecord = namedtuple("BookRecord", [
+    "id", "name", "year", "publisher", "isbn", "annotation", "thumbnail_id",
+    "authors",  # tuple of names
+    "series",   # tuple of SeriesRecord, sorted by series type
+    "tags",     # tuple of names
+])
+SeriesRecord = namedtuple("SeriesRecord", ["id", "name", "type", "position", "number_books"])
+
+
 class FSKeyFileStorage(object):
     """
     Dictionary-like object for storing key:file pairs in file system
@@ -207,6 +231,17 @@ class SQLBaseWithEscaping(object):
             identifiers,
             (esc_chars for i in iter(int, 1))))
 
+    @staticmethod
+    def _execute(cursor, query, params=(), many=False):
+        """Execute query on cursor and record its statistics (see QUERIES)"""
+        started = time.perf_counter()
+        if many:
+            cursor.executemany(query, params)
+        else:
+            cursor.execute(query, params)
+        QUERIES.record(cursor, query, params, time.perf_counter() - started, many)
+        return cursor
+
     def generic(self, connection, query, fields=(), params=(), commit=False):
         """
         Generic SQL query with proper escaping
@@ -229,12 +264,15 @@ class SQLBaseWithEscaping(object):
                 Boolean. If True connection.commit() will be called after
                 executing the query
         """
+        if isinstance(connection, SQLiteWriter):
+            with connection as writer:  # commits when the lock is released
+                return self.generic(writer, query, fields, params)
         if fields:
             fields = tuple(map(self._escape_identifier, fields))
             query = query % fields
         cur = connection.cursor()
         try:
-            cur.execute(query, params)
+            self._execute(cur, query, params)
         except Exception as e:
             connection.rollback()
             raise e
@@ -261,7 +299,7 @@ class DBKeyValueStorage(SQLBaseWithEscaping):
             column names in SQL queries. Double quotes by default.
     """
 
-    def __init__(self, connection, table, key_field, value_field):
+    def __init__(self, connection, table, key_field, value_field, writer=None):
         """
         Arguments:
             connection
@@ -270,8 +308,12 @@ class DBKeyValueStorage(SQLBaseWithEscaping):
                 Name of the table which stores key:value pairs
             key_field, value_field
                 Fields storing keys and values
+            writer
+                SQLiteWriter object for modifying data. Optional, `connection`
+                is used by default
         """
         self.__db = connection
+        self.__writer = connection if writer is None else writer
         self.__table = str(table)
         self.__keyfield = str(key_field)
         self.__valfield = str(value_field)
@@ -325,7 +367,7 @@ class DBKeyValueStorage(SQLBaseWithEscaping):
             query = "INSERT INTO %s (%s,%s) VALUES (?,?)"
         args = (self.__table, self.__valfield, self.__keyfield)
         params = (value, key)
-        self.generic(self.__db, query, args, params, commit=True)
+        self.generic(self.__writer, query, args, params, commit=True)
 
     def __delitem__(self, key):
         """
@@ -335,7 +377,7 @@ class DBKeyValueStorage(SQLBaseWithEscaping):
         query = "DELETE FROM %s WHERE %s=?"
         args = (self.__table, self.__keyfield)
         params = (key,)
-        self.generic(self.__db, query, args, params, commit=True)
+        self.generic(self.__writer, query, args, params, commit=True)
 
     def pop(self, key, default=KeyError):
         """
@@ -362,14 +404,45 @@ class SQL(SQLBaseWithEscaping):
         delete
         insert
         update_where
+        insert_many
+        delete_many
         table2text
     """
-    def __init__(self, dbapi_connection):
+    def __init__(self, dbapi_connection, writer=None):
         """
         dbapi_connection
             Connection object providing Python DB API (PEP 249)
+        writer
+            SQLiteWriter object. Optional. If provided, it is used for
+            modifying data and for reading while the current thread holds
+            the writer lock
         """
         self.__dbapi = dbapi_connection
+        self.__writer = writer
+
+    @property
+    def _reader(self):
+        if self.__writer is not None and self.__writer.owned:
+            return self.__writer.connection
+        return self.__dbapi
+
+    def _modify(self, query, params, many=False):
+        """
+        Execute data modifying query and commit. If `many` is True, `params`
+        is a sequence of parameter tuples for executemany(). Returns cursor
+        """
+        if self.__writer is not None:
+            with self.__writer as connection:
+                cursor = self._execute(connection.cursor(), query, params, many)
+            return cursor
+        cursor = self.__dbapi.cursor()
+        try:
+            self._execute(cursor, query, params, many)
+        except Exception as e:
+            cursor.connection.rollback()
+            raise e
+        cursor.connection.commit()
+        return cursor
 
     def select(self, table, where=None, what="*", order=None):
         """
@@ -412,10 +485,8 @@ class SQL(SQLBaseWithEscaping):
             order_clause += ", ".join(order_cmds)
         query_template += order_clause
 
-        cursor = self.__dbapi.cursor()
-        cursor.execute(query_template,
-                       list(where.values()) if where else tuple())
-        return cursor
+        return self._execute(self._reader.cursor(), query_template,
+                             list(where.values()) if where else tuple())
 
     def delete(self, table, where):
         """
@@ -435,14 +506,8 @@ class SQL(SQLBaseWithEscaping):
                 tuple(str(x) + "=?" for x in self._escape_seq(where.keys())))
             query_template += where_clause
 
-        cursor = self.__dbapi.cursor()
-        try:
-            cursor.execute(query_template,
-                           list(where.values()) if where else tuple())
-        except Exception as e:
-            cursor.connection.rollback()
-            raise e
-        cursor.connection.commit()
+        cursor = self._modify(query_template,
+                              list(where.values()) if where else tuple())
         return cursor.rowcount
 
     def insert(self, table, data):
@@ -461,14 +526,8 @@ class SQL(SQLBaseWithEscaping):
             "(" + ",".join(tuple('%s' for x in range(len(data)))) + ")")
         query_template = query_template.replace("#VALUES#",
             "(" + ",".join(tuple("?" for x in range(len(data)))) + ")")
-        cursor = self.__dbapi.cursor()
-        try:
-            cursor.execute(query_template % self._escape_seq(data.keys()),
-                           list(data.values()))
-        except Exception as e:
-            cursor.connection.rollback()
-            raise e
-        cursor.connection.commit()
+        cursor = self._modify(query_template % self._escape_seq(data.keys()),
+                              list(data.values()))
         return cursor.lastrowid
 
     def update_where(self, table, data, where):
@@ -495,16 +554,43 @@ class SQL(SQLBaseWithEscaping):
                  "#VALUES#",
                  ",".join(tuple('%s=?' for x in range(len(data)))))
 
-        cursor = self.__dbapi.cursor()
-        try:
-            cursor.execute(query_template % self._escape_seq(data.keys()),
+        cursor = self._modify(query_template % self._escape_seq(data.keys()),
                   list(data.values()) + (list(where.values()) if where else list()))
-        except Exception as e:
-            cursor.connection.rollback()
-            raise e
-        cursor.connection.commit()
         return cursor.rowcount
 
+    def insert_many(self, table, fields, rows):
+        """
+        Run SQL INSERT operation for several rows at once
+
+        Arguments:
+            table:  String. The name of the table to be updated
+            fields: Sequence of strings. Field names
+            rows:   Sequence of tuples with values for each field
+
+        Returns number of inserted rows
+        """
+        query_template = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            self._escape_identifier(table),
+            ",".join(self._escape_seq(fields)),
+            ",".join("?" * len(fields)))
+        return self._modify(query_template, rows, many=True).rowcount
+
+    def delete_many(self, table, fields, rows):
+        """
+        Run SQL DELETE operation for several rows at once
+
+        Arguments:
+            table:  String. The name of the table to be updated
+            fields: Sequence of strings. Field names for WHERE clause
+            rows:   Sequence of tuples with required values for each field
+
+        Returns number of deleted rows
+        """
+        query_template = 'DELETE FROM %s WHERE %s' % (
+            self._escape_identifier(table),
+            " AND ".join(x + "=?" for x in self._escape_seq(fields)))
+        return self._modify(query_template, rows, many=True).rowcount
+
     @staticmethod
     def iterate(cursor, limit=-1, arraysize=1000):
         """Use this generator to efficiently iterate over cursor results"""
@@ -538,6 +624,328 @@ class SQL(SQLBaseWithEscaping):
         return text
 
 
+class SearchIndex(object):
+    """
+    Inverted index for full text search in the books catalogue
+
+    Every book is indexed by its title, ISBN, authors and series names. FTS5
+    virtual table is used if current sqlite build supports it, otherwise
+    token:book_id pairs are stored in a regular table (posting lists)
+
+    Index is updated by CatalogueDB.changed() whenever a book or any of its
+    related entries are modified, so search cost depends only on the number
+    of matches, not on the size of catalogue
+
+    Methods:
+        update(*book_ids)
+            Reindex books with specified ids
+        remove(*book_ids)
+            Remove books from index
+        rebuild()
+            Reindex the whole catalogue
+        query(search)
+            Return SQL subquery and parameters selecting ids of matching books
+
+    Properties:
+        fts
+            Boolean. True if FTS5 table is used for storing the index
+    """
+    FTS_TABLE = "search_fts"
+    TOKENS_TABLE = "search_tokens"
+    WILDCARD = "*"  # single char
+    MIN_WORD = 3  # shorter words are ignored in search queries
+    CHUNK = 500  # maximum number of ids in a single query
+    _fts5_support = None
+
+    def __init__(self, db):
+        """
+        Arguments:
+            db
+                SQLiteDB object containing the index
+        """
+        self._db = db
+        self._fts = None
+
+    @classmethod
+    def fts5_available(cls):
+        """Check if FTS5 extension is supported by current sqlite build"""
+        if cls._fts5_support is None:
+            test = sqlite3.connect(":memory:")
+            try:
+                test.execute("CREATE VIRTUAL TABLE test USING fts5(text)")
+                cls._fts5_support = True
+            except sqlite3.OperationalError:
+                cls._fts5_support = False
+            finally:
+                test.close()
+        return cls._fts5_support
+
+    @classmethod
+    def schema(cls):
+        """Return SQL statements for creating index tables"""
+        if cls.fts5_available():
+            return (
+                """
+                CREATE VIRTUAL TABLE %s USING fts5(
+                    info,
+                    tokenize = "unicode61 remove_diacritics 0 tokenchars '_'")
+                """ % cls.FTS_TABLE,
+                )
+        else:
+            return (
+                """
+                CREATE TABLE %s (
+                    token       text not null,
+                    book_id     integer not null,
+                    primary key (token, book_id))
+                    WITHOUT ROWID
+                """ % cls.TOKENS_TABLE,
+                """
+                CREATE INDEX idx_%s_book ON %s (book_id)
+                """ % (cls.TOKENS_TABLE, cls.TOKENS_TABLE),
+                )
+
+    @property
+    def fts(self):
+        if self._fts is None:
+            search = self._db.sql.select(
+                "sqlite_master",
+                {"name": self.FTS_TABLE},
+                "name")
+            self._fts = bool(search.fetchone())
+        return self._fts
+
+    @staticmethod
+    def simplify(text):
+        """Normalize text the same way as search queries are normalized"""
+        return lowercase(alphanumeric(text)) or ""
+
+    def _texts(self, book_ids=None):
+        """Yield (book_id, search text) pairs for specified books"""
+        query = """
+            SELECT
+                books.id,
+                books.name,
+                books.isbn,
+                (SELECT group_concat(authors.name, " ")
+                 FROM book_authors
+                 JOIN authors ON authors.id = book_authors.author_id
+                 WHERE book_authors.book_id = books.id),
+                (SELECT group_concat(series.name, " ")
+                 FROM book_series
+                 JOIN series ON series.id = book_series.series_id
+                 WHERE book_series.book_id = books.id)
+            FROM books
+            """
+        if book_ids is None:
+            batches = [None]
+        else:
+            batches = chunks(book_ids, self.CHUNK)
+        for chunk in batches:
+            if chunk is None:
+                cursor = self._db.connection.execute(query)
+            else:
+                where = "WHERE books.id IN (%s)" % ",".join("?" * len(chunk))
+                cursor = self._db.connection.execute(query + where, chunk)
+            for row in SQL.iterate(cursor):
+                text = " ".join(str(x) for x in tuple(row)[1:] if x)
+                yield row[0], self.simplify(text)
+
+    def _write(self, texts, delete=()):
+        """Replace index entries for books in `delete` with new `texts`"""
+        with self._db.writer as db:
+            for chunk in chunks(delete, self.CHUNK):
+                marks = ",".join("?" * len(chunk))
+                if self.fts:
+                    db.execute("DELETE FROM %s WHERE rowid IN (%s)"
+                               % (self.FTS_TABLE, marks), chunk)
+                else:
+                    db.execute("DELETE FROM %s WHERE book_id IN (%s)"
+                               % (self.TOKENS_TABLE, marks), chunk)
+            if self.fts:
+                db.executemany(
+                    "INSERT INTO %s (rowid, info) VALUES (?, ?)"
+                    % self.FTS_TABLE,
+                    ((id, text) for id, text in texts))
+            else:
+                db.executemany(
+                    "INSERT INTO %s (token, book_id) VALUES (?, ?)"
+                    % self.TOKENS_TABLE,
+                    ((token, id) for id, text in texts
+                                 for token in set(text.split())))
+
+    def update(self, *book_ids):
+        """Reindex books with specified ids"""
+        book_ids = set(id for id in book_ids if id is not None)
+        if book_ids:
+            self._write(list(self._texts(book_ids)), delete=book_ids)
+
+    def remove(self, *book_ids):
+        """Remove books from index"""
+        self._write((), delete=set(book_ids))
+
+    def rebuild(self):
+        """Drop all index entries and reindex the whole catalogue"""
+        self._fts = None  # index table may have been just created
+        table = self.FTS_TABLE if self.fts else self.TOKENS_TABLE
+        with self._db.writer as db:
+            db.execute("DELETE FROM %s" % table)
+            self._write(self._texts())
+
+    def words(self, search):
+        """
+        Split user input into search words
+
+        Returns a list of 3-tuples: (word, wildcard_before, wildcard_after)
+        """
+        wildcard = self.WILDCARD
+        search = re.sub(r"\s+", " ", search).strip()
+        search = re.sub(r"[^\d\w %s]" % re.escape(wildcard), "", search).lower()
+        words = list()
+        for word in search.split(" "):
+            core = word.strip(wildcard)
+            if len(core) >= self.MIN_WORD:  # drop short words
+                words.append((
+                    core,
+                    word.startswith(wildcard),
+                    word.endswith(wildcard)))
+        return words
+
+    def query(self, search):
+        """
+        Return SQL subquery selecting ids of books matching the search string
+        and a list of parameters for it. Accepts "*" as wildcard
+
+        Returns (None, None) if search string contains no usable words
+        """
+        subqueries = list()
+        params = list()
+        match = list()
+        for word, before, after in self.words(search):
+            if self.fts and not before:
+                match.append('"%s"%s' % (word, " *" if after else ""))
+            elif self.fts:
+                # FTS5 can not handle leading wildcards, fall back to scanning
+                # the index (one row per book, no joins)
+                subqueries.append(
+                    "SELECT rowid FROM %s WHERE instr(' ' || info || ' ', ?)>0"
+                    % self.FTS_TABLE)
+                params.append(word if after else word + " ")
+            else:
+                if not before and not after:
+                    where = "token = ?"
+                    params.append(word)
+                elif not before:
+                    where = "token >= ? AND token < ?"
+                    params += [word, word + chr(0x10ffff)]
+                elif not after:
+                    where = "substr(token, -length(?)) = ?"
+                    params += [word, word]
+                else:
+                    where = "instr(token, ?)>0"
+                    params.append(word)
+                subqueries.append("SELECT book_id FROM %s WHERE %s"
+                                  % (self.TOKENS_TABLE, where))
+        if match:
+            subqueries.insert(0, "SELECT rowid FROM %s WHERE %s MATCH ?"
+                                 % (self.FTS_TABLE, self.FTS_TABLE))
+            params.insert(0, " ".join(match))
+        if subqueries:
+            return " INTERSECT ".join(subqueries), params
+        else:
+            return None, None
+
+
+class SQLiteWriter(object):
+    """
+    Database connection for modifying data. May be shared between threads
+    and between several SQLiteDB objects (see `writer` argument of SQLiteDB)
+
+    Use as context manager: the lock is held and transaction stays open until
+    the outermost `with` block exits. Changes are committed on success and
+    rolled back if an exception escapes from the outermost block
+
+        with db.writer as connection:
+            connection.execute(...)
+
+    Attributes:
+        checkpoint_interval
+            Seconds between WAL checkpoints issued after commits. Zero means
+            relying on SQLite automatic checkpoints only
+        checkpoint_mode
+            PASSIVE, FULL, RESTART or TRUNCATE. See SQLite documentation for
+            `PRAGMA wal_checkpoint`
+        generation
+            Integer incremented after each commit that follows touch() call.
+            Useful for invalidating caches of data derived from the database
+    """
+    checkpoint_interval = 0
+    checkpoint_mode = "PASSIVE"
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._lock = threading.RLock()
+        self._owner = None
+        self._depth = 0
+        self._last_checkpoint = time.monotonic()
+        self._touched = False
+        self.generation = 0
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._owner = threading.get_ident()
+        self._depth += 1
+        return self._connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                if exc_type is None:
+                    self._connection.commit()
+                    if self._touched:
+                        self.generation += 1
+                    self._checkpoint_if_needed()
+                else:
+                    self._connection.rollback()
+                self._touched = False
+        finally:
+            self._lock.release()
+
+    def touch(self):
+        """
+        Mark data as modified: generation is incremented after the current
+        transaction is committed (or right away if there is no transaction)
+        """
+        with self:
+            self._touched = True
+
+    def _checkpoint_if_needed(self):
+        interval = self.checkpoint_interval
+        if interval and time.monotonic() - self._last_checkpoint > interval:
+            self.checkpoint()
+
+    def checkpoint(self, mode=None):
+        """Copy WAL contents into the database file"""
+        if mode is None:
+            mode = self.checkpoint_mode
+        if mode.upper() not in {"PASSIVE", "FULL", "RESTART", "TRUNCATE"}:
+            raise ValueError("invalid checkpoint mode: %s" % mode)
+        with self._lock:
+            self._connection.execute("PRAGMA wal_checkpoint(%s)" % mode).fetchall()
+            self._last_checkpoint = time.monotonic()
+
+    @property
+    def owned(self):
+        """True if current thread holds the lock"""
+        return self._owner == threading.get_ident()
+
+    @property
+    def connection(self):
+        return self._connection
+
+
 class SQLiteDB(object):
     """
     SQLite database with some extra methods and properties
@@ -545,18 +953,37 @@ class SQLiteDB(object):
     Methods:
         close()
             Close database connection
+        reset()
+            Drop state left by previous user of the connection (see
+            ConnectionPool)
 
     Properties:
         connection
-            Get DB API connection
+            Get DB API connection. While current thread holds the writer lock
+            writer connection is returned, so that uncommitted changes are
+            visible
+        writer
+            SQLiteWriter object. All data modifications go through it
         sql
             SQL() object. Contains methods for performing most popular queries
         filename
             Database file name with full path
     """
-    def __init__(self, filename):
+    def __init__(self, filename, shared=False, writer=None):
+        """
+        Arguments:
+            filename
+                SQLite database file
+            shared
+                Allow using connection from different threads (one thread
+                at a time, see ConnectionPool)
+            writer
+                SQLiteWriter object shared with other SQLiteDB instances.
+                If provided, own connection is switched to read only mode.
+                Otherwise own connection is used for writing too
+        """
         sqlite3.enable_callback_tracebacks(True)  # debug
-        self._connection = sqlite3.connect(filename)
+        self._connection = sqlite3.connect(filename, check_same_thread=not shared)
         self._connection.row_factory = sqlite3.Row
 
         self._connection.create_function("clean_isbn", 1,
@@ -567,8 +994,14 @@ class SQLiteDB(object):
             lambda x: lowercase(alphanumeric(x)))
         # self._connection.create_function("timestamp", 0, timestamp)
 
+        if writer is None:
+            writer = SQLiteWriter(self._connection)
+        else:
+            self._connection.execute("PRAGMA query_only=ON")
+        self._writer = writer
+
         self._dbfile = os.path.abspath(filename)
-        self._sql = SQL(self._connection)
+        self._sql = SQL(self._connection, writer)
 
     def __eq__(self, other):
         try:
@@ -582,8 +1015,14 @@ class SQLiteDB(object):
 
     @property
     def connection(self):
+        if self._writer.owned:
+            return self._writer.connection
         return self._connection
 
+    @property
+    def writer(self):
+        return self._writer
+
     @property
     def sql(self):
         return self._sql
@@ -592,6 +1031,11 @@ class SQLiteDB(object):
     def filename(self):
         return self._dbfile
 
+    def reset(self):
+        """Roll back transaction left unfinished by previous user"""
+        if self.connection.in_transaction:
+            self.connection.rollback()
+
     def close(self):
         try:
             self._connection.close()
@@ -610,25 +1054,340 @@ class CatalogueDB(SQLiteDB):
         getauthor(name)
             Fetch Author object from database. If no author with this name
             exists, new Author object is created
+        getbookrecords(ids)
+            Read-only BookRecord tuples for listing pages
+        changed(item, other=None)
+            Notify database about modification of TableEntityWithID objects.
+            Keeps search index up to date and calls `listeners`
+        transaction()
+            Context manager that groups several modifications into a single
+            commit (unit of work)
+        reset()
+            Roll back unfinished transaction and empty identity map
         create_db(db_filname)
             Create new SQLite database. Dates and times are stored
             in Unix epoch format
+
+    Properties:
+        search_index
+            SearchIndex() object. Full text search index for books
+        listeners
+            List of callables that are called by changed() with the same
+            arguments prepended by CatalogueDB object
+        thumbnails
+            FSKeyFileStorage() object. Cover images keyed by hash of their
+            contents (see Thumbnail.checksum)
+        identities
+            Identity map {(class, id): TableEntityWithID object} or None if
+            disabled. While enabled, `cls(db, id)` returns the same object
+            for the same row, so its data is fetched only once. Emptied by
+            reset(), i.e. after each HTTP request for pooled connections
     """
-    _schema_version = 3  # Integer. Increment this when schema changes.
+    _schema_version = 10  # Integer. Increment this when schema changes.
+
+    # Indexes for lookups by the second column of link tables and for
+    # ORDER BY clauses of listing pages (see WebUI._listing_queries)
+    INDEXES = (
+        """
+        CREATE INDEX idx_books_last_edit ON books (last_edit)
+        """,
+        """
+        CREATE INDEX idx_books_in_date ON books (in_date)
+        """,
+        """
+        CREATE INDEX idx_book_authors_author ON book_authors (author_id, book_id)
+        """,
+        """
+        CREATE INDEX idx_book_tags_tag ON book_tags (tag_id, book_id)
+        """,
+        """
+        CREATE INDEX idx_book_series_series ON book_series (series_id, book_number, book_id)
+        """,
+        """
+        CREATE INDEX idx_book_files_file ON book_files (file_id, book_id)
+        """,
+        """
+        CREATE INDEX idx_user_groups_group ON user_groups (group_id, user_id)
+        """,
+        """
+        CREATE INDEX idx_book_reviews_date ON book_reviews (date)
+        """,
+        """
+        CREATE INDEX idx_book_reviews_book ON book_reviews (book_id, date)
+        """,
+        """
+        CREATE INDEX idx_barcode_queue_date ON barcode_queue (date)
+        """,
+    )
+
+    # Tables with `name_key` column: normalized copy of `name` that is used
+    # for lookups ignoring case and punctuation. Maintained by triggers
+    NAME_KEYS = ("authors", "series", "tags")
+
+    @classmethod
+    def name_key_schema(cls, table):
+        """SQL statements that index `name_key` column and keep it up to date"""
+        return (
+            """
+            CREATE INDEX idx_{table}_name_key ON {table} (name_key)
+            """.format(table=table),
+            """
+            CREATE TRIGGER trg_{table}_name_key_insert AFTER INSERT ON {table}
+            BEGIN
+                UPDATE {table} SET name_key = simplify(NEW.name) WHERE _rowid_ = NEW._rowid_;
+            END
+            """.format(table=table),
+            """
+            CREATE TRIGGER trg_{table}_name_key_update AFTER UPDATE OF name ON {table}
+            BEGIN
+                UPDATE {table} SET name_key = simplify(NEW.name) WHERE _rowid_ = NEW._rowid_;
+            END
+            """.format(table=table),
+        )
+
+    # Denormalized copy of book data shown on listing pages and used for
+    # sorting search results, one row per book. Authors, series and tags are
+    # stored as JSON arrays, series items are
+    # [id, name, type, book_number, number_books]. Maintained by triggers.
+    # Indexed by sort keys of booksearch (see WebUI._booksearch_ids)
+    BOOK_SUMMARY = """
+        CREATE TABLE book_summary (
+            id          integer primary key,
+            title       text,
+            author      text,
+            authors     text,
+            series      text,
+            tags        text,
+            in_date     integer,
+            year        integer,
+            last_edit   integer)
+        """
+
+    # Tables that book_summary is computed from:
+    # (table, columns that affect summary, link table, link column)
+    BOOK_SUMMARY_SOURCES = (
+        ("authors", "name", "book_authors", "author_id"),
+        ("series", "name, type, number_books", "book_series", "series_id"),
+        ("tags", "name", "book_tags", "tag_id"),
+    )
 
-    def __init__(self, filename):
+    @staticmethod
+    def book_summary_refresh(condition):
+        """SQL statement that recomputes book_summary rows of matching books"""
+        return """
+            INSERT OR REPLACE INTO book_summary
+                (id, title, author, authors, series, tags, in_date, year, last_edit)
+            SELECT
+                id, name, json_extract(authors, '$[0]'), authors, series, tags,
+                in_date, year, last_edit
+            FROM (
+                SELECT
+                    books.id, books.name, books.in_date,
+                    books.year, books.last_edit,
+                    (SELECT json_group_array(name) FROM (
+                        SELECT authors.name FROM book_authors
+                        JOIN authors ON authors.id = book_authors.author_id
+                        WHERE book_authors.book_id = books.id
+                        ORDER BY book_authors.author_id)) AS authors,
+                    (SELECT json_group_array(json_array(
+                            id, name, type, book_number, number_books)) FROM (
+                        SELECT series.id, series.name, series.type,
+                            book_series.book_number, series.number_books
+                        FROM book_series
+                        JOIN series ON series.id = book_series.series_id
+                        WHERE book_series.book_id = books.id
+                        ORDER BY series.type, series.id)) AS series,
+                    (SELECT json_group_array(name) FROM (
+                        SELECT tags.name FROM book_tags
+                        JOIN tags ON tags.id = book_tags.tag_id
+                        WHERE book_tags.book_id = books.id
+                        ORDER BY book_tags.tag_id)) AS tags
+                FROM books
+                WHERE {condition})
+            """.format(condition=condition)
+
+    @classmethod
+    def book_summary_schema(cls):
+        """SQL statements that create book_summary table and keep it up to date"""
+        trigger = """
+            CREATE TRIGGER trg_book_summary_{name} AFTER {event} ON {table}
+            BEGIN
+                {body};
+            END
+            """
+        refresh = cls.book_summary_refresh
+        queries = [cls.BOOK_SUMMARY] + [
+            "CREATE INDEX idx_book_summary_{0} ON book_summary ({0})".format(column)
+            for column in ("in_date", "year", "title", "author")
+        ] + [
+            trigger.format(
+                name="books_insert", event="INSERT", table="books",
+                body=refresh("books.id = NEW.id")),
+            # The summary copies only a few columns of books and one save
+            # updates the row several times (see trg_book_mtime and
+            # trg_isbn_update), refresh it only when these columns change
+            """
+            CREATE TRIGGER trg_book_summary_books_update
+            AFTER UPDATE OF name, in_date, year ON books
+            WHEN OLD.name IS NOT NEW.name
+                OR OLD.in_date IS NOT NEW.in_date
+                OR OLD.year IS NOT NEW.year
+            BEGIN
+                {body};
+            END
+            """.format(body=refresh("books.id = NEW.id")),
+            trigger.format(
+                name="books_last_edit", event="UPDATE OF last_edit", table="books",
+                body="UPDATE book_summary SET last_edit = NEW.last_edit WHERE id = NEW.id"),
+            trigger.format(
+                name="books_delete", event="DELETE", table="books",
+                body="DELETE FROM book_summary WHERE id = OLD.id"),
+        ]
+        for table, columns, link_table, link_column in cls.BOOK_SUMMARY_SOURCES:
+            queries += [
+                trigger.format(
+                    name=link_table + "_insert", event="INSERT", table=link_table,
+                    body=refresh("books.id = NEW.book_id")),
+                trigger.format(
+                    name=link_table + "_update", event="UPDATE", table=link_table,
+                    body=refresh("books.id IN (OLD.book_id, NEW.book_id)")),
+                trigger.format(
+                    name=link_table + "_delete", event="DELETE", table=link_table,
+                    body=refresh("books.id = OLD.book_id")),
+                trigger.format(
+                    name=table + "_update", event="UPDATE OF " + columns, table=table,
+                    body=refresh("books.id IN (SELECT book_id FROM %s WHERE %s = NEW.id)"
+                                 % (link_table, link_column))),
+                trigger.format(
+                    name=table + "_delete", event="DELETE", table=table,
+                    body=refresh("books.id IN (SELECT book_id FROM %s WHERE %s = OLD.id)"
+                                 % (link_table, link_column))),
+            ]
+        return tuple(queries)
+
+    @staticmethod
+    def name_key(text):
+        """Normalize text the same way as simplify() SQL function does"""
+        return lowercase(alphanumeric(text))
+
+    def __init__(self, filename, thumbnails_dir=None, shared=False, writer=None,
+                 identity_map=False):
+        """
+        Arguments:
+            filename
+                SQLite database file. Will be created if it does not exist
+            thumbnails_dir
+                Directory for storing cover images. Defaults to "thumbs"
+                next to the database file
+            shared
+                Allow using connection from different threads
+            writer
+                SQLiteWriter object for modifying data (see SQLiteDB)
+            identity_map
+                Share entity objects that refer to the same row (see
+                `identities` property). Meant for short-lived units of work
+                such as HTTP requests, objects are kept until reset()
+        """
         new = not os.path.isfile(filename)
 
-        SQLiteDB.__init__(self, filename)
+        SQLiteDB.__init__(self, filename, shared, writer)
+        self._search_index = SearchIndex(self)
+        self._pending_books = None  # ids of books to reindex after transaction
+        self.listeners = list()
+        self.identities = dict() if identity_map else None
+        if thumbnails_dir is None and filename != ":memory:":
+            thumbnails_dir = os.path.join(os.path.dirname(self.filename), "thumbs")
+        self._thumbnails_dir = thumbnails_dir
+        self._thumbnails = None
         if new:
             self.create_db(filename)
 
+    @property
+    def search_index(self):
+        return self._search_index
+
+    @property
+    def thumbnails(self):
+        if self._thumbnails is None:
+            if self._thumbnails_dir is None:  # in-memory database
+                self._thumbnails_dir = tempfile.mkdtemp(prefix="hlc-thumbs-")
+            self._thumbnails = FSKeyFileStorage(self._thumbnails_dir)
+        return self._thumbnails
+
+    def changed(self, item, other=None):
+        """
+        Notify CatalogueDB that TableEntityWithID `item` was saved or deleted,
+        or that it was connected to/disconnected from `other`
+        """
+        self.writer.touch()
+        books = set()
+        if other is None:
+            if isinstance(item, Book):
+                books.add(item.id)
+            elif isinstance(item, (Author, Series)):
+                books.update(item.getconnected_id(Book))
+        else:
+            for entry in (item, other):
+                if isinstance(entry, Book):
+                    books.add(entry.id)
+        if self._pending_books is not None:
+            self._pending_books.update(books)
+        elif books:
+            self.search_index.update(*books)
+        for listener in self.listeners:
+            listener(self, item, other)
+
+    def reset(self):
+        SQLiteDB.reset(self)
+        if self.identities is not None:
+            self.identities.clear()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Unit of work: all modifications made within `with` block are committed
+        once when it exits or are rolled back together if an exception is
+        raised. Search index is updated once per modified book right before
+        commit. Nested calls join the outermost transaction
+
+            with db.transaction():
+                book.save()
+                book.setconnected(Author, authors)
+        """
+        with self.writer:
+            outermost = self._pending_books is None
+            if outermost:
+                self._pending_books = set()
+            try:
+                yield self
+                if outermost and self._pending_books:
+                    self.search_index.update(*self._pending_books)
+            finally:
+                if outermost:
+                    self._pending_books = None
+
     def getsuggestions(self, beginning, table, field, count=10):
         """
         Get suggestions
         """
         suggestions = list()
-        if bool(beginning.strip()):
+        if table in self.NAME_KEYS and field == "name":
+            prefix = self.name_key(beginning)
+            if not prefix:
+                return suggestions
+            query = """
+                SELECT %s FROM %s
+                WHERE name_key >= ? AND name_key < ?
+                ORDER BY name_key
+                """
+            search = self.sql.generic(
+                self.connection,
+                query,
+                (field, table),
+                (prefix, prefix + "\U0010ffff"))  # index range scan
+            for result in self.sql.iterate(search, count):
+                suggestions.append(result[0])
+        elif bool(beginning.strip()):
             query = """
                 SELECT DISTINCT %s FROM %s
                 WHERE simplify(%s) LIKE simplify(?) || "%%"
@@ -653,15 +1412,17 @@ class CatalogueDB(SQLiteDB):
         """
         if attr is None: attr = field
         if value:
-            if simplify:
+            fields = (cls.__IDField__, cls.__TableName__, field)
+            params = (value, )
+            if simplify and field == "name" and cls.__TableName__ in self.NAME_KEYS:
+                query = "SELECT %s FROM %s WHERE name_key=?"
+                fields = fields[:2]
+                params = (self.name_key(value), )
+            elif simplify:
                 query = "SELECT %s FROM %s WHERE simplify(%s)=simplify(?)"
             else:
                 query = "SELECT %s FROM %s WHERE %s=?"
-            search = self.sql.generic(
-                self.connection,
-                query,
-                (cls.__IDField__, cls.__TableName__, field),
-                (value, ))
+            search = self.sql.generic(self.connection, query, fields, params)
             result = search.fetchone()
             second = search.fetchone()
             if not result:
@@ -721,6 +1482,107 @@ class CatalogueDB(SQLiteDB):
             b = Book(self)
         return b
 
+    def getbooks(self, ids):
+        """
+        Get multiple Book objects from database in a constant number of queries
+
+        Book data, connected authors, series (with book positions) and tags
+        are prefetched, so that listing pages do not query database for
+        every single book
+
+        Returns:
+            List of Book() objects in the same order as `ids`. Ids that were
+            not found in the database are skipped
+        """
+        ids = [id for id in ids if id is not None]
+        rows = dict()
+        connected = {id: {Author: [], Series: [], Tag: []} for id in ids}
+        shared = dict()  # the same Author/Series/Tag object for all books
+
+        def related(cls, row, skip):
+            key = (cls, row[cls.__IDField__])
+            if key not in shared:
+                item = shared[key] = cls(self, key[1])
+                item._load((k, row[k]) for k in row.keys() if k not in skip)
+            return shared[key]
+
+        relations = (
+            (Author, "book_authors", "author_id", ""),
+            (Series, "book_series", "series_id", ", link.book_number AS _number"),
+            (Tag, "book_tags", "tag_id", ""),
+        )
+        for chunk in chunks(set(ids), SearchIndex.CHUNK):
+            marks = ",".join("?" * len(chunk))
+            query = "SELECT * FROM %s WHERE %s IN (%s)" % (
+                self.sql._escape_identifier(Book.__TableName__),
+                self.sql._escape_identifier(Book.__IDField__),
+                marks)
+            for row in self.sql.generic(self.connection, query, params=chunk):
+                rows[row[Book.__IDField__]] = row
+
+            for cls, table, column, extra in relations:
+                query = """
+                    SELECT link.book_id AS _book%s, related.*
+                    FROM %s AS link JOIN %s AS related
+                        ON related.%s = link.%s
+                    WHERE link.book_id IN (%s)
+                    ORDER BY link.book_id, link.%s
+                    """ % (
+                        extra,
+                        self.sql._escape_identifier(table),
+                        self.sql._escape_identifier(cls.__TableName__),
+                        self.sql._escape_identifier(cls.__IDField__),
+                        self.sql._escape_identifier(column),
+                        marks,
+                        self.sql._escape_identifier(column))
+                for row in self.sql.generic(self.connection, query, params=chunk):
+                    item = related(cls, row, {"_book", "_number"})
+                    connected[row["_book"]][cls].append(item)
+                    if cls is Series:
+                        item._positions[row["_book"]] = row["_number"]
+
+        books = list()
+        for id in ids:
+            if id in rows:
+                book = Book(self, id)
+                book._load(rows[id], connected[id])
+                books.append(book)
+        return books
+
+    def getbookrecords(self, ids):
+        """
+        Read-only projection of books for listing pages
+
+        Book fields and author names, series and tag names precomputed in
+        book_summary table are read with a single query per SearchIndex.CHUNK
+        ids, without creating any TableEntityWithID objects. Related records
+        are ordered the same way as in getbooks()
+
+        Returns:
+            List of BookRecord tuples in the same order as `ids`. Ids that
+            were not found in the database are skipped
+        """
+        ids = [id for id in ids if id is not None]
+        records = dict()
+        for chunk in chunks(set(ids), SearchIndex.CHUNK):
+            query = """
+                SELECT
+                    books.id, books.name, books.year, books.publisher,
+                    books.isbn, books.annotation, books.thumbnail_id,
+                    book_summary.authors, book_summary.series, book_summary.tags
+                FROM books
+                JOIN book_summary ON book_summary.id = books.id
+                WHERE books.id IN (%s)
+                """ % ",".join("?" * len(chunk))
+            for row in self.sql.generic(self.connection, query, params=chunk):
+                authors, series, tags = row[7:]
+                records[row[0]] = BookRecord(
+                    *row[:7],
+                    tuple(json.loads(authors)),
+                    tuple(SeriesRecord(*info) for info in json.loads(series)),
+                    tuple(json.loads(tags)))
+        return [records[id] for id in ids if id in records]
+
     def create_db(self, db_filename):
         """Create new SQLite database file and all required tables"""
         # NOTE: increment CatalogueDB._schema_version and
@@ -747,6 +1609,9 @@ class CatalogueDB(SQLiteDB):
                 user_id integer,
                 date integer not null default (cast(strftime('%s','now') as integer)),
                 title text,
+                info text,
+                thumbs text,
+                fetched integer,
                 foreign key(user_id) references users(id) on delete cascade on update cascade
             )
             """,
@@ -768,7 +1633,8 @@ class CatalogueDB(SQLiteDB):
                 id      integer primary key,
                 url     text,
                 image   blob,
-                last_edit integer not null default (cast(strftime('%s','now') as integer)))
+                last_edit integer not null default (cast(strftime('%s','now') as integer)),
+                hash    text)
             """,
             """
             CREATE TABLE books (
@@ -823,14 +1689,16 @@ class CatalogueDB(SQLiteDB):
             """
             CREATE TABLE authors (
                 id      integer primary key,
-                name    text unique not null)
+                name    text unique not null,
+                name_key text)
             """,
             """
             CREATE TABLE series (
                 id              integer primary key,
                 type            text not null,
                 name            text unique not null,
-                number_books    integer check (number_books>0))
+                number_books    integer check (number_books>0),
+                name_key        text)
             """,
             """
             CREATE TABLE author_ratings (
@@ -888,23 +1756,6 @@ class CatalogueDB(SQLiteDB):
             SELECT DISTINCT type FROM series
             """,
             """
-            CREATE VIEW search_books AS
-            SELECT
-                books.id as id,
-                " " || simplify(printf("%s %s %s %s", books.name, books.isbn, authors.name, series.name)) || " " as info,
-                books.in_date as in_date,
-                books.year as year,
-                books.name as title,
-                authors.name as author,
-                books.last_edit as last_edit
-            FROM
-            books
-            LEFT JOIN book_authors ON book_authors.book_id = books.id
-            LEFT JOIN authors ON book_authors.author_id = authors.id
-            LEFT JOIN book_series ON book_series.book_id = books.id
-            LEFT JOIN series ON series.id = book_series.series_id
-            """,
-            """
             CREATE TABLE app_config (
                 option text unique not null,
                 value text,
@@ -952,7 +1803,8 @@ class CatalogueDB(SQLiteDB):
             """
             CREATE TABLE tags (
                 id      integer primary key,
-                name    text unique not null)
+                name    text unique not null,
+                name_key text)
             """,
             """
             CREATE TABLE book_tags (
@@ -961,16 +1813,277 @@ class CatalogueDB(SQLiteDB):
                 primary key (book_id, tag_id),
                 foreign key(book_id) references books(id) on delete cascade on update cascade,
                 foreign key(tag_id) references tags(id) on delete cascade on update cascade)
-            """)
-        db = self.connection
-        for query in new_table_queries:
-            try:
-                db.execute(query)
-            except Exception as e:
-                debug(query)
-                db.rollback()
-                raise e
-        db.commit()
+            """) + SearchIndex.schema() + self.INDEXES
+        for table in self.NAME_KEYS:
+            new_table_queries += self.name_key_schema(table)
+        new_table_queries += self.book_summary_schema()
+        with self.writer as db:
+            for query in new_table_queries:
+                try:
+                    db.execute(query)
+                except Exception as e:
+                    debug(query)
+                    raise e
 
         from .db_transition import version  # lazy import because of circular reference
         version(self, self._schema_version)
+
+
+def query_plan(connection, query, params=()):
+    """Return lines of EXPLAIN QUERY PLAN output for the query"""
+    return [
+        str(row[-1])
+        for row in connection.execute("EXPLAIN QUERY PLAN " + query, params)
+    ]
+
+
+def inefficient_steps(plan):
+    """
+    Select query plan lines that indicate full table scans or sorting in
+    temporary B-trees
+    """
+    return [
+        line for line in plan
+        if (line.startswith("SCAN ") and " USING " not in line)
+        or "TEMP B-TREE" in line
+    ]
+
+
+class QueryStats(threading.local):
+    """
+    SQL statistics for current thread
+
+    Statements executed by SQL helper methods (SQL.select, SQL.insert,
+    SQLBaseWithEscaping.generic, etc) are timed and summarized since the
+    last reset() call, which is meant to be called at the start of each unit
+    of work (i.e. web request). Statements that take longer than
+    `slow_threshold` seconds are written to `slow_log` together with their
+    query plans.
+
+    Install `trace` method as SQLite trace callback to also count statements
+    that do not go through SQL helpers:
+
+        connection.set_trace_callback(QUERIES.trace)
+
+    Attributes:
+        count
+            Number of statements seen by trace callback (never reset)
+        route
+            Label of current unit of work, included in slow query log
+        queries
+            Number of statements executed via SQL helpers since reset()
+        time
+            Seconds spent in those statements. Rows of SELECT queries are
+            fetched lazily, so only the time of the first step is counted
+        rows
+            Number of rows affected by modifying statements since reset()
+        slow_threshold
+            Class attribute. Seconds. None disables slow query log
+        slow_log
+            Class attribute. Logger for slow queries
+    """
+    count = 0
+    route = None
+    queries = 0
+    time = 0.0
+    rows = 0
+    slow_threshold = None
+    slow_log = logging.getLogger(__name__ + ".slow")
+
+    def trace(self, statement):
+        self.count += 1
+
+    def reset(self, route=None):
+        """Start collecting summary for the new unit of work"""
+        self.route = route
+        self.queries = 0
+        self.time = 0.0
+        self.rows = 0
+
+    def record(self, cursor, query, params, elapsed, many=False):
+        """Account for statement that has been executed on cursor"""
+        self.queries += 1
+        self.time += elapsed
+        if cursor.rowcount > 0:
+            self.rows += cursor.rowcount
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self._log_slow(cursor.connection, query, params, elapsed, many)
+
+    def _log_slow(self, connection, query, params, elapsed, many):
+        if many:
+            params = next(iter(params), ())
+        try:
+            plan = "\n".join("    " + line for line in query_plan(connection, query, params))
+        except sqlite3.Error as e:
+            plan = "    %r" % e
+        self.slow_log.warning(
+            "Slow query (%.1f ms, route: %s):\n%s\nParameters: %r\nQuery plan:\n%s",
+            elapsed * 1000, self.route, " ".join(query.split()), params, plan)
+
+    @property
+    def summary(self):
+        """Server-Timing header value for current unit of work"""
+        return 'db;dur=%.1f;desc="%d queries"' % (self.time * 1000, self.queries)
+
+
+QUERIES = QueryStats()
+
+
+class ConnectionPoolTimeout(RuntimeError):
+    """Raised when no database connection becomes available in time"""
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of database connections shared between threads
+
+    A thread checks out a connection on first access and keeps it until
+    release() is called (usually at the end of HTTP request). Repeated
+    checkouts from the same thread return the same connection. Connections
+    left idle for too long are closed, connections held by threads that have
+    exited are returned to the pool automatically
+
+    Arguments:
+        factory
+            Callable that returns new SQLiteDB object. Returned objects must
+            allow access from multiple threads (see `shared` argument of
+            SQLiteDB)
+        size
+            Maximum number of open connections
+        timeout
+            Seconds to wait for a free connection before raising
+            ConnectionPoolTimeout
+        idle_timeout
+            Seconds after which unused connections are closed
+        pragmas
+            Dictionary of PRAGMA statements executed on each new connection
+
+    Methods:
+        checkout()
+            Get connection for current thread
+        release()
+            Return connection held by current thread to the pool
+        close()
+            Close all connections
+
+    Properties:
+        stats
+            Dictionary with pool metrics
+    """
+    PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -8000,  # KiB
+        "mmap_size": 64*2**20,  # bytes
+    }
+
+    def __init__(self, factory, size=8, timeout=30, idle_timeout=5*60, pragmas=None):
+        self._factory = factory
+        self._size = size
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._pragmas = dict(self.PRAGMAS if pragmas is None else pragmas)
+        self._cond = threading.Condition()
+        self._idle = list()  # [(time returned, connection)], most recent last
+        self._busy = dict()  # {thread: connection or None while being created}
+        self._metrics = dict(
+            created=0,
+            closed=0,
+            reclaimed=0,
+            checkouts=0,
+            waits=0,
+            wait_time=0.0)
+
+    def _open(self):
+        db = self._factory()
+        for pragma, value in self._pragmas.items():
+            db.connection.execute("PRAGMA %s=%s" % (pragma, value)).fetchall()
+        return db
+
+    def _reap(self):
+        """Close idle connections and reclaim ones held by dead threads"""
+        for thread in [t for t, c in self._busy.items() if c and not t.is_alive()]:
+            self._idle.append((time.monotonic(), self._reset(self._busy.pop(thread))))
+            self._metrics["reclaimed"] += 1
+        deadline = time.monotonic() - self._idle_timeout
+        while self._idle and self._idle[0][0] < deadline:
+            self._idle.pop(0)[1].close()
+            self._metrics["closed"] += 1
+
+    @staticmethod
+    def _reset(db):
+        """Drop state left by previous user (see SQLiteDB.reset)"""
+        db.reset()
+        return db
+
+    def checkout(self):
+        thread = threading.current_thread()
+        started = time.monotonic()
+        with self._cond:
+            db = self._busy.get(thread)
+            if db is not None:
+                return db
+            self._metrics["checkouts"] += 1
+            waited = False
+            while True:
+                self._reap()
+                if self._idle:
+                    db = self._busy[thread] = self._idle.pop()[1]
+                    break
+                if len(self._busy) < self._size:
+                    self._busy[thread] = None  # reserve slot
+                    break
+                remaining = started + self._timeout - time.monotonic()
+                if remaining <= 0:
+                    self._metrics["waits"] += 1
+                    self._metrics["wait_time"] += time.monotonic() - started
+                    raise ConnectionPoolTimeout(
+                        "No free database connections after %s seconds" % self._timeout)
+                waited = True
+                self._cond.wait(min(remaining, 1))  # wake up to reap dead threads
+            if waited:
+                self._metrics["waits"] += 1
+                self._metrics["wait_time"] += time.monotonic() - started
+        if db is None:
+            try:
+                db = self._open()
+            except Exception:
+                with self._cond:
+                    del self._busy[thread]
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._busy[thread] = db
+                self._metrics["created"] += 1
+        return db
+
+    def release(self):
+        thread = threading.current_thread()
+        with self._cond:
+            db = self._busy.get(thread)
+            if db is None:  # nothing checked out or connection is being created
+                return
+            del self._busy[thread]
+            self._idle.append((time.monotonic(), self._reset(db)))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for db in [c for c in self._busy.values() if c] + [c for t, c in self._idle]:
+                db.close()
+            self._busy.clear()
+            self._idle.clear()
+
+    @property
+    def stats(self):
+        with self._cond:
+            stats = dict(self._metrics)
+            stats["busy"] = len(self._busy)
+            stats["idle"] = len(self._idle)
+        stats["size"] = stats["busy"] + stats["idle"]
+        if stats["waits"]:
+            stats["avg_wait"] = stats["wait_time"] / stats["waits"]
+        else:
+            stats["avg_wait"] = 0.0
+        return stats
@@ -2,7 +2,9 @@
 Transition CatalogueDB from previous versions
 """
 
-from .db import DBKeyValueStorage
+import io
+from .db import CatalogueDB, DBKeyValueStorage, SearchIndex
+from .items import Thumbnail
 
 
 def version(catalogue_db, set_version=None):
@@ -11,7 +13,8 @@ def version(catalogue_db, set_version=None):
                     catalogue_db.connection,
                     "app_config",
                     "option",
-                    "value")
+                    "value",
+                    catalogue_db.writer)
     if set_version:
         options["schema_version"] = int(set_version)
     elif not options.get("init_date"):
@@ -37,7 +40,10 @@ def upgrade_next(catalogue_db, transitions=None):
     transitions
         Transition information dictionary. Keys are schema versions, values
         are lists of SQL statements required to upgrade to this version from
-        the one immediately before it. Uses SCHEMA_TRANSITIONS by default
+        the one immediately before it. Callables may be used instead of SQL
+        statements when data has to be processed in Python, they are called
+        with catalogue_db as the only argument. Uses SCHEMA_TRANSITIONS by
+        default
     """
     if transitions is None:
         transitions = SCHEMA_TRANSITIONS
@@ -51,24 +57,130 @@ def upgrade_next(catalogue_db, transitions=None):
 
     if next_version:
         print("Upgrading CatalogueDB to version {}".format(next_version))
-        cursor = catalogue_db.connection.cursor()
-        try:
+        with catalogue_db.writer as db:  # rolls back on errors
+            if not db.in_transaction:
+                # sqlite3 module does not open transaction before DDL
+                db.execute("BEGIN")
+            cursor = db.cursor()
             for query in transitions[next_version]:
-                print(query.strip())
-                cursor.execute(query)
-        except Exception as e:
-            cursor.connection.rollback()
-            raise e
-        else:
-            cursor.connection.commit()
-        version(catalogue_db, next_version)
+                if callable(query):
+                    print(query.__doc__.strip())
+                    query(catalogue_db)
+                else:
+                    print(query.strip())
+                    cursor.execute(query)
+            version(catalogue_db, next_version)
+        for query in AFTER_TRANSITIONS.get(next_version, ()):
+            print(query.strip())
+            with catalogue_db.writer as db:
+                db.execute(query)
         print("Succefully upgraded CatalogueDB to version {}".format(next_version))
     else:
         print("CatalogueDB is already at the latest version")
 
 
+def _rebuild_search_index(catalogue_db):
+    """Populate full text search index"""
+    catalogue_db.search_index.rebuild()
+
+
+def _rebuild_book_summary(catalogue_db):
+    """Recreate book_summary table with its indexes and triggers"""
+    db = catalogue_db.connection
+    triggers = db.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'trigger' AND name LIKE 'trg_book_summary_%'").fetchall()
+    for name, in triggers:
+        db.execute("DROP TRIGGER %s" % name)
+    db.execute("DROP TABLE book_summary")
+    for query in CatalogueDB.book_summary_schema():
+        db.execute(query)
+    db.execute(CatalogueDB.book_summary_refresh("1"))
+
+
+# Number of cover images held in memory at a time by _move_thumbnails()
+THUMBNAILS_CHUNK = 100
+
+
+def _move_thumbnails(catalogue_db):
+    """Move cover images from database blobs to file storage"""
+    db = catalogue_db.connection
+    storage = catalogue_db.thumbnails
+    last_id = -1
+    while True:
+        rows = db.execute(
+            "SELECT id, image, last_edit FROM thumbs WHERE image NOT NULL AND id > ? "
+            "ORDER BY id LIMIT ?", (last_id, THUMBNAILS_CHUNK)).fetchall()
+        if not rows:
+            break
+        for id, image, last_edit in rows:
+            key = Thumbnail.checksum(image)
+            if key not in storage:
+                storage[key] = io.BytesIO(image)
+            db.execute(
+                "UPDATE thumbs SET hash=?, image=NULL, last_edit=? WHERE id=?",
+                (key, last_edit, id))
+        last_id = rows[-1][0]
+
+
+# Maintenance statements that can not run inside a transaction. Executed
+# after the upgrade to the version has been committed
+AFTER_TRANSITIONS = {
+    5: [
+        "VACUUM",  # return space freed by moving thumbnails to file system
+    ],
+}
+
+
 SCHEMA_TRANSITIONS = {
     # version: [sql_statement1, sql_statement2 ...]
+    10: [
+        _rebuild_book_summary,
+    ],
+    9: list(CatalogueDB.book_summary_schema()) + [
+        CatalogueDB.book_summary_refresh("1"),
+        """
+        DROP VIEW search_books
+        """,
+    ],
+    8: [
+        query
+        for table in CatalogueDB.NAME_KEYS
+        for query in (
+            """
+            ALTER TABLE {table}
+                ADD name_key text
+            """.format(table=table),
+            """
+            UPDATE {table} SET name_key = simplify(name)
+            """.format(table=table),
+        ) + CatalogueDB.name_key_schema(table)
+    ],
+    7: list(CatalogueDB.INDEXES),
+    6: [
+        """
+        ALTER TABLE barcode_queue
+            ADD info text
+        """,
+        """
+        ALTER TABLE barcode_queue
+            ADD thumbs text
+        """,
+        """
+        ALTER TABLE barcode_queue
+            ADD fetched integer
+        """,
+    ],
+    5: [
+        """
+        ALTER TABLE thumbs
+            ADD hash text
+        """,
+        _move_thumbnails,
+    ],
+    4: list(SearchIndex.schema()) + [
+        _rebuild_search_index,
+    ],
     3: [
         """
         ALTER TABLE book_reviews
@@ -7,36 +7,157 @@ import re
 import json
 import logging
 import ssl
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, as_completed
+from datetime import datetime
 from scrapehelper.fetch import BaseDataFetcher, DataFetcherError
-from .fetcher_cache import CachedObject
-from .items import ISBN
+from .fetcher_cache import CachedObject, PersistentCache
+from .items import ISBN, Barcode
 from .util import alphanumeric, fuzzy_str_eq, random_str
 
 
-threads = ThreadPoolExecutor()
 log = logging.getLogger(__name__)
 
+DEADLINE = 30  # seconds, how long user waits for fetchers to complete
 
-def _execute(fetcher):
-    '''Worker for concurrent execution'''
-    fetcher.info
-    return fetcher
+cache = None  # PersistentCache for fetched results, see setup_cache()
 
 
-def book_info(isbn):
+def setup_cache(filename, ttl=None, negative_ttl=None):
     """
-    Try all available fetchers until full information about book is fetched
+    Store fetched results in SQLite database to survive restarts
+
+    Arguments:
+        filename
+            SQLite database file for storing cache
+        ttl, negative_ttl
+            Default number of seconds to keep successful and empty results.
+            Fetcher classes may override these values with CACHE_TTL and
+            CACHE_NEGATIVE_TTL attributes
+    """
+    global cache
+    if cache is not None:
+        cache.close()
+    cache = PersistentCache(filename)
+    if ttl is not None:
+        BookInfoFetcher.CACHE_TTL = int(ttl)
+    if negative_ttl is not None:
+        BookInfoFetcher.CACHE_NEGATIVE_TTL = int(negative_ttl)
+
+
+class FetchService(object):
     """
-    jobs = set()
-    for fetcher in INFO_FETCHERS:
-        jobs.add(threads.submit(_execute, fetcher(isbn)))
+    Run book info fetchers in background threads
+
+    Concurrent requests for the same ISBN with the same fetcher class share
+    a single job, so remote hosts are queried only once. Number of jobs
+    running simultaneously is limited for each fetcher class by its
+    CONCURRENCY attribute (or by `concurrency` argument if there is none).
+    Jobs over the limit wait in a queue of their fetcher class and are handed
+    to the executor when a running job of that class finishes, so they do not
+    occupy worker threads needed by other fetchers
+
+    Jobs that were not awaited by any caller are left to finish in the
+    background: fetcher objects are cached (see CachedObject), so their
+    results will be available instantly to the next request
+    """
+
+    def __init__(self, max_workers=None, concurrency=2):
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._concurrency = concurrency
+        self._lock = threading.Lock()
+        self._jobs = dict()  # in-flight jobs: {(fetcher class, isbn): future}
+        self._running = dict()  # {fetcher class: number of jobs in executor}
+        self._waiting = dict()  # {fetcher class: deque([(isbn, future)])}
+
+    def _execute(self, fetcher_class, isbn, job):
+        """Worker for concurrent execution"""
+        try:
+            if job.set_running_or_notify_cancel():
+                try:
+                    fetcher = fetcher_class(isbn)
+                    fetcher.info
+                except BaseException as e:
+                    job.set_exception(e)
+                else:
+                    job.set_result(fetcher)
+        finally:
+            self._next(fetcher_class)
+
+    def _next(self, fetcher_class):
+        """Hand the next waiting job of `fetcher_class` to the executor"""
+        with self._lock:
+            waiting = self._waiting.get(fetcher_class)
+            if waiting:
+                isbn, job = waiting.popleft()
+                self._executor.submit(self._execute, fetcher_class, isbn, job)
+            else:
+                self._running[fetcher_class] -= 1
+
+    def _forget(self, key, job):
+        with self._lock:
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
+
+    def submit(self, fetcher_class, isbn):
+        """
+        Start fetching `isbn` with `fetcher_class` or join the job that is
+        already running. Returns Future object that resolves to fetcher instance
+        """
+        key = (fetcher_class, ISBN(isbn).number)
+        with self._lock:
+            job = self._jobs.get(key)
+            new = job is None
+            if new:
+                job = self._jobs[key] = Future()
+                limit = getattr(fetcher_class, "CONCURRENCY", self._concurrency)
+                if self._running.get(fetcher_class, 0) < limit:
+                    self._running[fetcher_class] = self._running.get(fetcher_class, 0) + 1
+                    self._executor.submit(self._execute, fetcher_class, isbn, job)
+                else:
+                    self._waiting.setdefault(fetcher_class, deque()).append((isbn, job))
+        if new:
+            job.add_done_callback(lambda done: self._forget(key, done))
+        return job
+
+    def fetch(self, fetchers, isbn, timeout=None):
+        """
+        Yield fetcher objects in order of completion until all of them are
+        done or until `timeout` seconds have passed. Failed fetchers are skipped
+        """
+        jobs = {self.submit(fetcher, isbn): fetcher for fetcher in fetchers}
+        try:
+            for job in as_completed(jobs, timeout=timeout):
+                try:
+                    yield job.result()
+                except Exception as e:
+                    log.warning("{fetcher} failed to fetch {isbn}: {error!r}".format(
+                        fetcher=jobs[job].__name__, isbn=isbn, error=e))
+        except TimeoutError:
+            log.debug("Deadline exceeded while fetching {isbn}".format(isbn=isbn))
+
+    @property
+    def pending(self):
+        """Number of jobs in progress"""
+        return len(self._jobs)
+
 
+service = FetchService()
+
+
+def book_info(isbn, timeout=DEADLINE):
+    """
+    Try all available fetchers until full information about book is fetched
+
+    Returns as soon as the information is full or when `timeout` expires,
+    remaining fetchers continue in the background
+    """
     result = dict()
-    for job in as_completed(jobs):
-        fetcher = job.result()
+    for fetcher in service.fetch(INFO_FETCHERS, isbn, timeout):
         if not result:
-            result = fetcher.info
+            result = {k: dict(v) for k, v in fetcher.info.items()}
         else:
             old, new = result[fetcher.isbn], fetcher.info[fetcher.isbn]
             for k in new.keys():
@@ -47,7 +168,7 @@ def book_info(isbn):
     return result
 
 
-def book_thumbs(isbn):
+def book_thumbs(isbn, timeout=DEADLINE):
     """
     Try to fetch as many thumbnails as possible
 
@@ -55,26 +176,151 @@ def book_thumbs(isbn):
     Those fetchers' results will be stripped of all extra information except
     for thumbnail urls
     """
-    jobs = set()
-    for fetcher in THUMB_FETCHERS:
-        jobs.add(threads.submit(_execute, fetcher(isbn)))
-
     result = dict()
     key = 'thumbnail'
-    for job in as_completed(jobs):
-        fetcher = job.result()
+    for fetcher in service.fetch(THUMB_FETCHERS, isbn, timeout):
         if not result:
             result = {fetcher.isbn: {}}
         old, new = result[fetcher.isbn], fetcher.info[fetcher.isbn]
         if key not in old and key in new:
-            old[key] = new[key]
+            old[key] = list(new[key])
         elif isinstance(new.get(key), list) \
         and isinstance(old.get(key), list):
             old[key] += new[key]
-    old[key] = list(set(old[key]))  # Remove duplicates if any
+    for book in result.values():
+        if key in book:
+            book[key] = list(set(book[key]))  # Remove duplicates if any
     return result
 
 
+class QueueResolver(object):
+    """
+    Fetch book information for every ISBN in barcode queue in background,
+    so that adding a queued book does not wait for remote hosts
+
+    Results of book_info() and book_thumbs() are stored in `info` and `thumbs`
+    fields of Barcode objects. Queue is drained by `parallel` ISBNs at a time,
+    per-fetcher limits of FetchService apply as usual
+
+    Fetchers swallow network errors, so nothing found may as well mean that
+    remote hosts were unavailable. Such barcodes are not marked as fetched
+    and are tried again after RETRY_INTERVAL seconds
+
+    Arguments:
+        db_factory
+            Callable that returns CatalogueDB object. It is called from the
+            worker thread because SQLite connections can not be shared
+        parallel
+            Number of ISBNs processed simultaneously
+
+    Methods:
+        wake()
+            Start worker thread if needed and make it check the queue
+        resolve_pending(db)
+            Fetch all unprocessed barcodes (blocking)
+
+    Properties:
+        stats
+            Dictionary with progress and throughput counters
+    """
+    POLL_INTERVAL = 60*60  # seconds between queue checks when nobody wakes us
+    RETRY_INTERVAL = 60*60  # seconds before fetching barcodes with nothing found again
+
+    def __init__(self, db_factory, parallel=2):
+        self._db_factory = db_factory
+        self._parallel = parallel
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._retry = dict()  # {barcode id: time.monotonic() of next attempt}
+        self.resolved = 0  # barcodes with any information fetched
+        self.empty = 0  # barcodes with nothing found
+        self.failed = 0  # barcodes that raised unexpected errors
+        self.pending = 0  # barcodes left in current batch
+        self.busy = 0.0  # seconds spent fetching
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name=self.__class__.__name__,
+                    daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        db = self._db_factory()
+        while True:
+            self._wakeup.wait(self.POLL_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.resolve_pending(db)
+            except Exception as e:
+                log.exception("Barcode queue processing failed: {!r}".format(e))
+
+    @staticmethod
+    def _fetch(isbn):
+        return book_info(isbn, timeout=None), book_thumbs(isbn, timeout=None)
+
+    def resolve_pending(self, db):
+        query = "SELECT id, isbn FROM {table} WHERE fetched IS NULL ORDER BY date"
+        cursor = db.sql.generic(
+            db.connection,
+            query.format(table=Barcode.__TableName__))
+        barcodes = dict(db.sql.iterate(cursor))  # {id: isbn}
+        now = time.monotonic()
+        self._retry = {id: retry for id, retry in self._retry.items()
+                       if retry > now and id in barcodes}
+        barcodes = [(id, isbn) for id, isbn in barcodes.items() if id not in self._retry]
+        if not barcodes:
+            return
+        self.pending = len(barcodes)
+        started = time.monotonic()
+        with ThreadPoolExecutor(self._parallel) as executor:
+            jobs = {executor.submit(self._fetch, isbn): id for id, isbn in barcodes}
+            for job in as_completed(jobs):
+                self.pending -= 1
+                try:
+                    self._store(Barcode(db, jobs[job]), *job.result())
+                except ValueError:  # barcode was deleted while we were busy
+                    continue
+                except Exception as e:
+                    self.failed += 1
+                    log.warning("Failed to resolve barcode #{id}: {error!r}".format(
+                        id=jobs[job], error=e))
+        self.busy += time.monotonic() - started
+
+    def _store(self, barcode, info, thumbs):
+        isbn = ISBN(barcode.isbn).number
+        book = info.get(isbn, {})
+        if not (book or thumbs.get(isbn)):
+            self.empty += 1
+            self._retry[barcode.id] = time.monotonic() + self.RETRY_INTERVAL
+            return
+        self.resolved += 1
+        title = book.get("title")
+        if isinstance(title, list):  # some fetchers return lists of strings
+            title = " ".join(title)
+        if title:
+            barcode.title = title
+        barcode.info = info
+        barcode.thumbs = thumbs
+        barcode.fetched = datetime.now()
+        barcode.save()
+
+    @property
+    def stats(self):
+        done = self.resolved + self.empty + self.failed
+        return dict(
+            resolved=self.resolved,
+            empty=self.empty,
+            failed=self.failed,
+            pending=self.pending,
+            per_minute=round(60 * done / self.busy, 1) if self.busy else None,
+        )
+
+
 def get_nested(dictionary, *keys, default=None):
     """Get value from nested dictionary"""
     reply = default
@@ -109,6 +355,9 @@ class BookInfoFetcher(BaseDataFetcher, CachedObject, metaclass=_UnionMeta):
     USER_AGENT = "Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 \
     (KHTML, like Gecko) Chrome/58.0.3029.96 Safari/537.36"
 
+    CACHE_TTL = 30*24*60*60  # seconds to keep fetched info in persistent cache
+    CACHE_NEGATIVE_TTL = 24*60*60  # seconds to remember that nothing was found
+
     def getbook():
         """
         This method has to be provided by child classes.
@@ -199,11 +448,22 @@ class BookInfoFetcher(BaseDataFetcher, CachedObject, metaclass=_UnionMeta):
         This property should be preferred when reading ISBN metadata,
         because it does not query remote host on every access.
         """
+        if self._info is None and self.isbn:
+            cache_key = "%s:%s" % (self.__class__.__name__, self.isbn)
+            if cache is not None:
+                self._info = cache.get(cache_key)
         if self._info is None and self.isbn:
             debug_info = dict(isbn=self.isbn, fetcher=self.__class__.__name__)
             log.debug('Requesting {isbn} with {fetcher}'.format(**debug_info))
-            self._info = self.getbook()
+            info = self.getbook()
             log.debug('>> Fetched {isbn} with {fetcher}'.format(**debug_info))
+            if cache is not None:
+                if info.get(self.isbn):
+                    ttl = self.CACHE_TTL
+                else:
+                    ttl = self.CACHE_NEGATIVE_TTL
+                cache.set(cache_key, info, ttl)
+            self._info = info
         elif not self.isbn:
             self._info = {self.isbn:{}}
         return self._info
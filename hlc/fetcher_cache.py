@@ -3,6 +3,10 @@ Caching mechanism for info fetchers
 '''
 
 
+import json
+import sqlite3
+import threading
+import time
 from collections import deque
 from weakref import WeakValueDictionary
 
@@ -109,3 +113,71 @@ class CachedObject(metaclass=CachedObjectMeta):
     initialized with the same arguments
     '''
     _CACHE_SIZE = 25
+
+
+class PersistentCache:
+    '''
+    Dict-like storage for JSON-serializable values in SQLite database with
+    expiration time for each entry. Safe to use from multiple threads
+
+    Expired entries are treated as missing and are purged when the cache is
+    opened
+    '''
+
+    def __init__(self, filename, table='fetcher_cache'):
+        self.filename = filename
+        self.table = table
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS "{}" ('
+                '   key text primary key,'
+                '   value text,'
+                '   expires integer not null)'.format(table)
+            )
+        self.purge()
+
+    def get(self, key, default=None):
+        '''Return cached value or `default` if key is missing or expired'''
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM "{}" WHERE key=? AND expires>=?'.format(self.table),
+                (key, int(time.time()))
+            ).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        '''Store value for `ttl` seconds'''
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO "{}" (key, value, expires) VALUES (?, ?, ?)'.format(self.table),
+                (key, json.dumps(value, ensure_ascii=False), int(time.time() + ttl))
+            )
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __delitem__(self, key):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM "{}" WHERE key=?'.format(self.table), (key,))
+
+    def purge(self):
+        '''Remove expired entries'''
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM "{}" WHERE expires<?'.format(self.table),
+                (int(time.time()),)
+            )
+
+    def close(self):
+        self._db.close()
+
+    def __repr__(self):
+        return '<{cls} {filename} at {id}>'.format(
+            cls=self.__class__.__name__,
+            id=hex(id(self)),
+            filename=self.filename
+        )
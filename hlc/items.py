@@ -6,8 +6,10 @@ import sqlite3
 import json
 import re
 import io
+from operator import attrgetter
 from PIL import Image
 from datetime import datetime
+from hashlib import sha224
 from .util import (
     PassHash,
     debug,
@@ -34,11 +36,77 @@ class NoneMocker(object):
     def __len__(self):
         return 0
 
-class TableEntityWithID(object):
+class EntityMeta(type):
+    """
+    Metaclass for TableEntityWithID. Turns field declarations into properties
+    backed by __slots__ once, when the class is defined
+
+    Class attributes:
+        __Fields__
+            Names of table columns exposed as plain properties
+        __DateFields__
+            Names of columns with Unix timestamps, exposed as datetime
+        __JSONFields__
+            Names of columns with JSON data, decoded on every access
+
+    Values of plain and date fields are stored in slots named "_v_<field>"
+    when the row is fetched. Reading such property is a slot lookup
+    (operator.attrgetter works without Python-level calls). Until the row is
+    fetched the slot is empty, so the lookup fails and __getattr__ fetches it.
+
+    The query that fetches the row is also prepared here, so creating an
+    entity does no per-instance setup beyond a few slot assignments.
+
+    Instantiation consults CatalogueDB.identities, so within a request the
+    same row is represented by the same object
+    """
+    def __new__(mcs, name, bases, namespace):
+        fields = tuple(namespace.get("__Fields__", ()))
+        dates = tuple(namespace.get("__DateFields__", ()))
+        namespace["__slots__"] = tuple(namespace.get("__slots__", ())) \
+                               + tuple("_v_" + field for field in fields + dates)
+        cls = super().__new__(mcs, name, bases, namespace)
+        for field in fields:
+            setattr(cls, field, cls._field_attr(field))
+        for field in dates:
+            setattr(cls, field, cls._date_attr(field))
+        for field in namespace.get("__JSONFields__", ()):
+            setattr(cls, field, cls._json_attr(field))
+
+        # (slot descriptor, column, converter) for filling slots from a row
+        own = [(field, None) for field in fields] \
+            + [(field, cls._date_value) for field in dates]
+        cls._own_hydrators = tuple(
+            (cls.__dict__["_v_" + field], field, convert) for field, convert in own)
+        cls._hydrators = tuple(
+            hydrator for base in reversed(cls.__mro__)
+            for hydrator in base.__dict__.get("_own_hydrators", ()))
+        cls._lazy = frozenset(
+            ("_data",) + tuple(field for slot, field, convert in cls._hydrators))
+        if cls.__TableName__ is not None:
+            cls._fetch_query = 'SELECT * FROM "%s" WHERE "%s" = ?' \
+                             % (cls.__TableName__, cls.__IDField__)
+        return cls
+
+    def __call__(cls, db, id=None):
+        """Return object from identity map of `db` if it is enabled"""
+        identities = db.identities
+        if id is None or identities is None:
+            return super().__call__(db, id)
+        key = (cls, id)
+        item = identities.get(key)
+        if item is None:
+            item = identities[key] = super().__call__(db, id)
+        return item
+
+
+class TableEntityWithID(object, metaclass=EntityMeta):
     """
     Base class for entities represented by a single row in the single table,
     such as books, authors, etc.
 
+    Database row is fetched on first access to any field (see EntityMeta)
+
     Properties:
         database:  Read only. CatalogueDB() object
         id:        Integer, read-only. ID of the database entry
@@ -55,38 +123,39 @@ class TableEntityWithID(object):
                              TableEntityWithID objects. Returns nothing
         disconnect(object):  Remove database connection between two
                              TableEntityWithID objects. Returns nothing
+        setconnected(cl, o): Replace connections to objects of type `cl`
+                             with connections to objects in `o` in bulk
     """
     __TableName__ = None
     __IDField__ = None
-
-    def __getattribute__(self, attr):
-        def getattr_direct(instance, attr):
-            cls = object  # parent class name
-            return cls.__getattribute__(instance, attr)
-
-        # Fetch _data from database only when absolutely necessary
-        if (not getattr_direct(self, "_fetched")) \
-        and ((attr == "_data") \
-        or  ((attr in type(self).__dict__) \
-        and (isinstance(getattr(type(self), attr, None), property)))):
-            getattr_direct(self, "_fetch")()
-
-        return getattr_direct(self, attr)
+    __slots__ = ("_db", "_id", "_new", "_saved", "_row", "_changes", "_connected")
+
+    def __getattr__(self, attr):
+        # Called only when regular lookup fails, i.e. fields were not fetched
+        # or containers were not created yet
+        if attr in self._lazy:
+            self._fetch()
+            return object.__getattribute__(self, attr)
+        if attr in ("_changes", "_connected"):
+            value = dict()
+            setattr(self, attr, value)
+            return value
+        raise AttributeError("%r object has no attribute %r"
+                             % (type(self).__name__, attr))
 
     def __init__(self, db, id=None):
         if id is None:
             self._new = True
             self._saved = False
-            self._fetched = True
-            self._data = dict()
+            self._hydrate(dict())
         else:
             self._new = False
             self._saved = True
-            self._fetched = False
-            # self._data is initialized upon access by _fetch() method
+            # fields are filled upon access by _fetch() method
         self._db = db
         self._id = id
-        self._changes = dict()
+        # _changes ({field: new value}) and _connected (prefetched
+        # connections: {class: [objects]}) are created on first use
 
     def __str__(self):
         return self.json
@@ -101,22 +170,63 @@ class TableEntityWithID(object):
         except Exception:
             return False
 
+    _data = property(attrgetter("_row"))
+
+    @staticmethod
+    def _date_value(value):
+        if value:
+            return unix2time(value)
+
+    def _hydrate(self, data):
+        """Store database row and fill field slots"""
+        self._row = data
+        for slot, field, convert in self._hydrators:
+            value = data.get(field)
+            if convert is not None:
+                value = convert(value)
+            slot.__set__(self, value)
+
+    def _unload(self):
+        """Forget fetched row, it will be fetched again on next access"""
+        slots = [TableEntityWithID._row] + [slot for slot, f, c in self._hydrators]
+        for slot in slots:
+            try:
+                slot.__delete__(self)
+            except AttributeError:
+                pass
+
     def _fetch(self):
         if self.id is not None:
-            c = self.database.sql.select(self.__TableName__,
-                          {self.__IDField__: self.id})
+            c = self.database.sql.generic(self.database.connection,
+                                          self._fetch_query,
+                                          params=(self.id,))
             keys = tuple([x[0] for x in c.description])
             values = c.fetchone()
             if values:
-                self._data = dict(zip(keys, values))
+                self._hydrate(dict(zip(keys, values)))
             else:
                 raise ValueError("Item with %s=%s not found in %s"
                                  % (self.__IDField__,
                                     self.id,
                                     self.__TableName__))
         else:
-            self._data = dict()
-        self._fetched = True
+            self._hydrate(dict())
+
+    def _load(self, data, connected=None):
+        """
+        Fill in database row and connected objects that were fetched in bulk
+        elsewhere (see CatalogueDB.getbooks). Saves SQL queries on access
+
+        Arguments:
+            data
+                Mapping of database fields to values
+            connected
+                Dictionary {class: sequence of objects}. Optional
+        """
+        self._hydrate(dict(data))
+        if connected:
+            for cls, objects in connected.items():
+                self._connected[cls] = list(objects)
 
     def _field_attr(*args):
         """Returns a single ready to use property based on the database field"""
@@ -139,18 +249,7 @@ class TableEntityWithID(object):
                 self._changes[property_name] = value
                 self._saved = False
 
-        def property_get(self):
-            if self._data:
-                return self._data[property_name]
-
-        return property(property_get, property_set)
-
-    def _simple_attrs(cls, *args):
-        """Create one or several simple properties"""
-        for i in args:
-            i = str(i)
-            if not hasattr(type(cls), i):
-                setattr(type(cls), i, cls._field_attr(i))
+        return property(attrgetter("_v_" + property_name), property_set)
 
     def _date_attr(*args):
         """
@@ -165,11 +264,6 @@ class TableEntityWithID(object):
             raise TypeError("_date_attr() takes 1 or 2 arguments but %s were given"
                             % len(args))
 
-        def date_get(self):
-            if self._data:
-                if self._data[property_name]:
-                    return unix2time(self._data[property_name])
-
         def date_set(self, value):
             if value:
                 value = time2unix(value)
@@ -181,30 +275,42 @@ class TableEntityWithID(object):
                 self._changes[property_name] = value
                 self._saved = False
 
-        return property(date_get, date_set)
+        return property(attrgetter("_v_" + property_name), date_set)
 
-    def _simple_date_attrs(cls, *args):
-        """Create one or several simple date properties"""
-        for i in args:
-            i = str(i)
-            if not hasattr(type(cls), i):
-                setattr(type(cls), i, cls._date_attr(i))
+    def _json_attr(*args):
+        """
+        Returns a single ready to use property based on the database field
+        for storing JSON serializable data
+        """
+        if len(args) == 1:    # (property_name): called as Class method
+            property_name = args[0]
+        elif len(args) == 2:  # (self,property_name): called as instance method
+            property_name = args[1]
+        else:
+            raise TypeError("_json_attr() takes 1 or 2 arguments but %s were given"
+                            % len(args))
 
-    @property
-    def database(self):
-        return self._db
+        def json_get(self):
+            if self._data and self._data[property_name]:
+                return json.loads(self._data[property_name])
 
-    @property
-    def id(self):
-        return self._id
+        def json_set(self, value):
+            if value is not None:
+                value = json.dumps(value, ensure_ascii=False)
+            if self._new or self._data[property_name] != value:
+                self._changes[property_name] = value
+                self._saved = False
+
+        return property(json_get, json_set)
+
+    database = property(attrgetter("_db"))
+    id = property(attrgetter("_id"))
 
     @property
     def json(self):
         return json.dumps(self._data, indent=4, ensure_ascii=False)
 
-    @property
-    def saved(self):
-        return self._saved
+    saved = property(attrgetter("_saved"))
 
     def save(self):
         for key in list(self._changes.keys()):
@@ -217,13 +323,16 @@ class TableEntityWithID(object):
                 selected = self.database.sql.select(self.__TableName__,
                                         {"_rowid_": rowid}, self.__IDField__)
                 self._id = selected.fetchone()[0]
+                if self.database.identities is not None:
+                    self.database.identities.setdefault((type(self), self._id), self)
             else:
                 self.database.sql.update_where(self.__TableName__,
                                  self._changes, {self.__IDField__: self.id})
             self._saved = True
             self._new = False
-            self._fetched = False
+            self._unload()
             self._changes = dict()
+            self.database.changed(self)
         elif not self.saved and len(self._changes) == 0 and not self._new:
             self._saved = True
 
@@ -233,7 +342,7 @@ class TableEntityWithID(object):
         """
         objects = set()
         for i in (a, b):
-            if type(i) is type:
+            if isinstance(i, type):
                 objects.add(i)
             else:
                 objects.add(type(i))
@@ -283,6 +392,13 @@ class TableEntityWithID(object):
 
         return unity_table, columns
 
+    def _forget_connected(self, other):
+        """Drop prefetched connections between two objects"""
+        for one, another in ((self, other), (other, self)):
+            one._connected.pop(type(another), None)
+            if isinstance(one, Series):
+                one._positions.clear()
+
     def isconnected(self, other):
         """
         Check if two TableEntityWithID objects are connected
@@ -315,6 +431,15 @@ class TableEntityWithID(object):
         If `order` is specified, results will be sorted on `order` column
         of the SQL query
         """
+        if cls in self._connected:
+            found = self._connected[cls]
+            if order:
+                found = sorted(
+                    found,
+                    key=lambda x: (getattr(x, order) is not None,
+                                   getattr(x, order)))
+            return iter(found) if found else list()
+
         legacy_sort = False
         try:
             ids = self.getconnected_id(cls, order)
@@ -340,6 +465,9 @@ class TableEntityWithID(object):
         Get connected objects of type `cls`
         Returns a tuple of ids
         """
+        if cls in self._connected and not order:
+            return tuple(x.id for x in self._connected[cls])
+
         unity_table, columns = self._connect_info(cls)
 
         where = dict()
@@ -378,6 +506,7 @@ class TableEntityWithID(object):
 
         if self.isconnected(other) and len(args) == 0:
             return
+        self._forget_connected(other)
 
         objects = dict()
         for i in (self, other):
@@ -416,6 +545,64 @@ class TableEntityWithID(object):
                     raise e
         elif len(columns) == 1:
             self.database.sql.update_where(unity_table, data, where)
+        self.database.changed(self, other)
+
+    def setconnected(self, cls, others):
+        """
+        Replace all connections to objects of type `cls` with connections to
+        `others`. Unchanged links are kept, the rest is deleted and inserted
+        in bulk: two executemany() queries instead of a query per object
+
+        `others` is a sequence of saved objects or of tuples (object, *args)
+        where args have the same meaning as in connect()
+        """
+        unity_table, columns = self._connect_info(cls)
+        if len(columns) != 2:
+            raise TypeError("setconnected() requires many-to-many relation, got %s"
+                            % unity_table)
+        own, their = columns[type(self)], columns[cls]
+        extra = list()
+        if {type(self), cls} == {Book, Series}:
+            extra.append("book_number")
+
+        wanted = dict()
+        for item in others:
+            if not isinstance(item, tuple):
+                item = (item,)
+            other, args = item[0], item[1:]
+            if not (self.saved and other.saved):
+                raise ValueError("%s object not saved before connecting" %
+                                 type(other if self.saved else self))
+            args = tuple(args[:len(extra)])
+            wanted[other.id] = (other, args + (None,) * (len(extra) - len(args)))
+
+        existing = dict()
+        search = self.database.sql.select(
+            unity_table, {own: self.id}, [their] + extra)
+        for row in search:
+            existing[row[0]] = tuple(row[1:])
+
+        stale = [id for id in existing
+                 if id not in wanted or wanted[id][1] != existing[id]]
+        fresh = [id for id in wanted
+                 if id not in existing or wanted[id][1] != existing[id]]
+        if stale:
+            self.database.sql.delete_many(
+                unity_table,
+                (own, their),
+                [(self.id, id) for id in stale])
+        if fresh:
+            self.database.sql.insert_many(
+                unity_table,
+                [own, their] + extra,
+                [(self.id, id) + wanted[id][1] for id in fresh])
+
+        self._connected.pop(cls, None)
+        for other, args in wanted.values():
+            self._forget_connected(other)
+        for id in set(stale).union(fresh):
+            other = wanted[id][0] if id in wanted else cls(self.database, id)
+            self.database.changed(self, other)
 
     def disconnect(self, other):
         """
@@ -423,6 +610,7 @@ class TableEntityWithID(object):
         """
         if not self.isconnected(other):
             return
+        self._forget_connected(other)
 
         objects = dict()
         for i in (self, other):
@@ -447,6 +635,7 @@ class TableEntityWithID(object):
             self.database.sql.delete(unity_table, data)
         elif len(columns) == 1:
             self.database.sql.update_where(unity_table, none_data, where)
+        self.database.changed(self, other)
 
     def delete(self):
         """
@@ -456,7 +645,15 @@ class TableEntityWithID(object):
             self.database.sql.delete(
                 self.__TableName__,
                 {self.__IDField__: self.id})
-        self.__dict__ = dict()
+            self.database.changed(self)
+            if self.database.identities is not None:
+                self.database.identities.pop((type(self), self.id), None)
+        for cls in type(self).__mro__:
+            for slot in cls.__dict__.get("__slots__", ()):
+                try:
+                    delattr(self, slot)
+                except AttributeError:
+                    pass
 
 
 class Book(TableEntityWithID):
@@ -465,23 +662,19 @@ class Book(TableEntityWithID):
     """
     __TableName__ = "books"
     __IDField__ = "id"
-
-    def __init__(self, db, id=None):
-        TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("name",
-                           "price",
-                           "publisher",
-                           "year",
-                           "in_type",
-                           "in_comment",
-                           "out_type",
-                           "out_comment",
-                           "thumbnail_id",
-                           "in_comment",
-                           "annotation")
-        self._simple_date_attrs("in_date",
-                                "out_date",
-                                "last_edit")
+    __Fields__ = ("name",
+                  "price",
+                  "publisher",
+                  "year",
+                  "in_type",
+                  "in_comment",
+                  "out_type",
+                  "out_comment",
+                  "thumbnail_id",
+                  "annotation")
+    __DateFields__ = ("in_date",
+                      "out_date",
+                      "last_edit")
 
     @property
     def isbn(self):
@@ -502,34 +695,26 @@ class Book(TableEntityWithID):
 class Author(TableEntityWithID):
     __TableName__ = "authors"
     __IDField__ = "id"
-
-    def __init__(self, db, id=None):
-        TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("name")
+    __Fields__ = ("name",)
 
 
 class Group(TableEntityWithID):
     __TableName__ = "groups"
     __IDField__ = "id"
-
-    def __init__(self, db, id=None):
-        TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("name")
+    __Fields__ = ("name",)
 
 
 class User(TableEntityWithID):
     __TableName__ = "users"
     __IDField__ = "id"
 
-    def __init__(self, db, id=None):
-        TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs(
-            "name",
-            "hash",
-            "fullname")
-        self._simple_date_attrs(
-            "created_on",
-            "expires_on")
+    __Fields__ = (
+        "name",
+        "hash",
+        "fullname")
+    __DateFields__ = (
+        "created_on",
+        "expires_on")
 
     def __password_set(self, password):
         """Set new password. Write-only property"""
@@ -549,11 +734,14 @@ class Series(TableEntityWithID):
     __TableName__ = "series"
     __IDField__ = "id"
 
+    __Fields__ = ("type",
+                  "name",
+                  "number_books")
+    __slots__ = ("_positions",)
+
     def __init__(self, db, id=None):
         TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("type",
-                           "name",
-                           "number_books")
+        self._positions = dict()  # prefetched {book_id: book_number}
 
     def position(self, book):
         """Return position of Book object in the Series"""
@@ -561,6 +749,8 @@ class Series(TableEntityWithID):
             question = book.id
         else:
             question = book
+        if question in self._positions:
+            return self._positions[question]
         search = self.database.sql.select(
             "book_series",
             where={"series_id": self.id, "book_id": question},
@@ -575,27 +765,23 @@ class AuthorRating(TableEntityWithID):
     __TableName__ = "author_ratings"
     __IDField__ = "id"
 
-    def __init__(self, db, id=None):
-        TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("author_id",
-                           "rated_by",
-                           "value",
-                           "comment")
-        self._simple_date_attrs("date")
+    __Fields__ = ("author_id",
+                  "rated_by",
+                  "value",
+                  "comment")
+    __DateFields__ = ("date",)
 
 
 class BookReview(TableEntityWithID):
     __TableName__ = "book_reviews"
     __IDField__ = "id"
 
-    def __init__(self, db, id=None):
-        TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("book_id",
-                           "reviewed_by",
-                           "review",
-                           "markup",
-                           "rating")
-        self._simple_date_attrs("date")
+    __Fields__ = ("book_id",
+                  "reviewed_by",
+                  "review",
+                  "markup",
+                  "rating")
+    __DateFields__ = ("date",)
 
     @property
     def html(self):
@@ -606,35 +792,57 @@ class BookFile(TableEntityWithID):
     __TableName__ = "files"
     __IDField__ = "id"
 
-    def __init__(self, db, id=None):
-        TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("name",
-                           "type")
+    __Fields__ = ("name",
+                  "type")
 
 
 class Tag(TableEntityWithID):
     __TableName__ = "tags"
     __IDField__ = "id"
-
-    def __init__(self, db, id=None):
-        TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("name")
+    __Fields__ = ("name",)
 
 
 class Thumbnail(TableEntityWithID):
+    """
+    Book cover image. Images are stored as files in CatalogueDB.thumbnails
+    storage, the database keeps only the hash of file contents
+    """
     __TableName__ = "thumbs"
     __IDField__ = "id"
     __MAXSIZE__ = (400, 550)  # todo: maybe smaller?
 
+    __Fields__ = ("url",)
+    __DateFields__ = ("last_edit",)
+    __slots__ = ("_image",)
+
     def __init__(self, db, id=None):
         TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("url")
-        self._simple_date_attrs("last_edit")
+        self._image = None  # new image data waiting to be saved
+
+    @staticmethod
+    def checksum(data):
+        """Return hash string for image data (bytes)"""
+        return sha224(data).hexdigest()
 
     @property
-    def image(self):
+    def hash(self):
         if self._data:
-            return self._data["image"]
+            return self._data.get("hash")
+
+    @property
+    def path(self):
+        """Path to image file or None if image is not saved to storage"""
+        if self.hash:
+            return self.database.thumbnails.get(self.hash)
+
+    @property
+    def image(self):
+        path = self.path
+        if path:
+            with open(path, "rb") as f:
+                return f.read()
+        elif self._data:
+            return self._data.get("image")  # not migrated to file storage
 
     @image.setter
     def image(self, data):
@@ -653,19 +861,32 @@ class Thumbnail(TableEntityWithID):
         img.save(pic, format="jpeg")
         del img
         pic.seek(0)
-        self._changes["image"] = pic.read()
+        self._image = pic.read()
         del pic
+        self._changes["hash"] = self.checksum(self._image)
         self._saved = False
 
+    def save(self):
+        if self._image is not None:
+            key = self.checksum(self._image)
+            storage = self.database.thumbnails
+            if key not in storage:
+                storage[key] = io.BytesIO(self._image)
+            self._image = None
+        TableEntityWithID.save(self)
+
 
 class Barcode(TableEntityWithID):
+    """
+    ISBN saved for adding to library later. Book information may be fetched
+    in advance (see fetch.QueueResolver)
+    """
     __TableName__ = "barcode_queue"
     __IDField__ = "id"
 
-    def __init__(self, db, id=None):
-        TableEntityWithID.__init__(self, db, id)
-        self._simple_attrs("title")
-        self._simple_date_attrs("date")
+    __Fields__ = ("title",)
+    __DateFields__ = ("date", "fetched")
+    __JSONFields__ = ("info", "thumbs")
 
     @property
     def isbn(self):
@@ -7,7 +7,12 @@ import sys
 import hlc
 from . import VERBOSITY
 from .cfg import settings
+from bottle import run as run_server
 from .web import WebUI, debug
+from .bulk import EXPORT_FORMATS, BulkImporter, export, read_records
+from .db import CatalogueDB
+from .db_transition import upgrade
+from .util import message
 
 
 DEFAULT_CONFIGURATION = {
@@ -23,15 +28,29 @@ DEFAULT_CONFIGURATION = {
         "port": 8080,
         "cookie_key": "SET YOUR OWN UNIQUE cookie_key AND id_key IN CONFIG!!!",
         "id_key": 72911,
+        "page_cache": 16,
+        "suggest_limit": 10000,
         },
     "db": {
         "filename": "database.sqlite",
+        "pool_size": 8,
+        "checkpoint_pages": 1000,
+        "checkpoint_interval": 0,
+        "checkpoint_mode": "PASSIVE",
+        "slow_query_ms": 100,
+        "slow_query_log": "",
+        },
+    "fetch": {
+        "cache": "fetcher_cache.sqlite",
+        "ttl": 30*24*60*60,
+        "negative_ttl": 24*60*60,
+        "queue_workers": 2,
         },
     }
 
 
-def wsgi_app(json_file, run=False):
-    """Create WSGI application for HomeLibraryCatalog"""
+def load_config(json_file):
+    """Read configuration file and resolve paths relative to it"""
     config = settings(os.path.abspath(json_file), DEFAULT_CONFIGURATION)
     VERBOSITY[0] = int(config.app.verbosity)
     if not config.app.root:
@@ -48,6 +67,12 @@ def wsgi_app(json_file, run=False):
         os.makedirs(config.app.data_dir, exist_ok=True)
     except FileExistsError as e:
         pass
+    return config
+
+
+def wsgi_app(json_file, run=False):
+    """Create WSGI application for HomeLibraryCatalog"""
+    config = load_config(json_file)
 
     if run:
         stdout = sys.stdout
@@ -61,7 +86,8 @@ def wsgi_app(json_file, run=False):
     debug(config)
 
     if run:
-        ui.app.run(
+        run_server(
+            ui,
             debug=VERBOSITY[0]>8,
             reloader=False,
             host=config.webui.host,
@@ -73,6 +99,60 @@ def wsgi_app(json_file, run=False):
         return ui
 
 
+def bulk_import(json_file, filename, format=None):
+    """
+    Import books from CSV or JSON lines file into the catalogue (see
+    hlc.bulk.BulkImporter). Use "-" as filename to read standard input
+    """
+    config = load_config(json_file)
+    dbfile = os.path.join(config.app.data_dir, config.db.filename)
+    if not os.path.isfile(dbfile):
+        message("Database not found: %s\nStart the web application once to create it" % dbfile, 0)
+        exit(1)
+    db = CatalogueDB(dbfile)
+    upgrade(db)
+    if filename == "-":
+        stream = sys.stdin
+    else:
+        stream = open(filename, encoding="utf-8", newline="")
+    try:
+        BulkImporter(db).run(read_records(stream, format))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        db.close()
+
+
+def bulk_export(json_file, filename):
+    """
+    Write the whole catalogue into CSV, JSON lines or MARC (.mrk) file
+    depending on file extension. Use "-" as filename to write JSON lines to
+    standard output
+    """
+    config = load_config(json_file)
+    dbfile = os.path.join(config.app.data_dir, config.db.filename)
+    if not os.path.isfile(dbfile):
+        message("Database not found: %s" % dbfile, 0)
+        exit(1)
+    extension = os.path.splitext(filename)[1].lstrip(".").lower()
+    format = "jsonl"
+    for name, (formatter, content_type, ext) in EXPORT_FORMATS.items():
+        if ext == extension:
+            format = name
+    db = CatalogueDB(dbfile)
+    if filename == "-":
+        stream = sys.stdout
+    else:
+        stream = open(filename, "w", encoding="utf-8", newline="")
+    try:
+        for text in export(db, format):
+            stream.write(text)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+        db.close()
+
+
 def main(argv):
     """
     Command-line interface for HomeLibraryCatalog
@@ -83,8 +163,23 @@ def main(argv):
         will be read from default configuration
     -t, --tests
         Run unit tests
+    -i, --import <books.csv|books.jsonl> [config.json]
+        Import books from CSV or JSON lines file ("-" for standard input)
+        and exit. Web application has to be restarted afterwards
+    -e, --export <books.csv|books.jsonl|books.mrk> [config.json]
+        Export the whole catalogue into CSV, JSON lines or MARC file ("-" for
+        JSON lines on standard output) and exit
     """
-    if len(argv) in {1, 2}:
+    if len(argv) in {3, 4} and argv[1] in {"-i", "--import", "-e", "--export"}:
+        try:
+            file = argv[3]
+        except IndexError:
+            file = "hlc.config"
+        if argv[1] in {"-i", "--import"}:
+            bulk_import(file, argv[2])
+        else:
+            bulk_export(file, argv[2])
+    elif len(argv) in {1, 2}:
         try:
             file = argv[1]
         except IndexError:
@@ -1,4 +1,4 @@
 '''
 Applying MVC paradigm, even though most code was written before I learned about it
 '''
-from . import review
+from . import book, review, templates
@@ -0,0 +1,96 @@
+'''
+View models for book listings
+'''
+
+from collections import namedtuple
+from hlc.items import (
+    ISBN,
+    Author,
+    Series,
+    Tag,
+)
+
+
+SeriesInfo = namedtuple('SeriesInfo', ['url', 'name', 'type', 'position', 'number_books'])
+
+
+class BookSummary(object):
+    '''
+    Pre-resolved book data for list templates (book_short, book_preview)
+
+    All related records are read in constructor, so rendering a template from
+    BookSummary does not touch the database. Book objects obtained via
+    CatalogueDB.getbooks() have their relations prefetched, which makes
+    building summaries for a whole page cost a constant number of queries.
+    Listing pages use from_record() instead, which needs no Book objects at all
+    '''
+
+    __slots__ = ('id', 'url', 'name', 'year', 'publisher', 'isbn', 'annotation',
+                 'thumbnail', 'authors', 'series', 'tags')
+
+    def __init__(self, book, id):
+        self.id = book.id
+        self.url = '/books/%s' % id.book.encode(book.id)
+        self.name = book.name
+        self.year = book.year
+        self.publisher = book.publisher
+        self.isbn = book.isbn
+        self.annotation = book.annotation
+        if book.thumbnail_id:
+            self.thumbnail = '/thumbs/%s' % id.thumb.encode(book.thumbnail_id)
+        else:
+            self.thumbnail = None
+        self.authors = [author.name for author in book.getconnected(Author)]
+        self.series = [
+            SeriesInfo(
+                '/series/%s' % id.series.encode(series.id),
+                series.name,
+                series.type,
+                series.position(book),
+                series.number_books,
+            )
+            for series in book.getconnected(Series, order='type')
+        ]
+        self.tags = [tag.name for tag in book.getconnected(Tag)]
+
+    @classmethod
+    def from_record(cls, record, id):
+        '''BookSummary for BookRecord (see CatalogueDB.getbookrecords)'''
+        summary = cls.__new__(cls)
+        summary.id = record.id
+        summary.url = '/books/%s' % id.book.encode(record.id)
+        summary.name = record.name
+        summary.year = record.year
+        summary.publisher = record.publisher
+        summary.isbn = ISBN(record.isbn).pretty
+        summary.annotation = record.annotation
+        if record.thumbnail_id:
+            summary.thumbnail = '/thumbs/%s' % id.thumb.encode(record.thumbnail_id)
+        else:
+            summary.thumbnail = None
+        summary.authors = record.authors
+        summary.series = [
+            SeriesInfo(
+                '/series/%s' % id.series.encode(series.id),
+                series.name,
+                series.type,
+                series.position,
+                series.number_books,
+            )
+            for series in record.series
+        ]
+        summary.tags = record.tags
+        return summary
+
+    @classmethod
+    def wrap(cls, book, id):
+        '''Return BookSummary for either Book or BookSummary object'''
+        if isinstance(book, cls):
+            return book
+        return cls(book, id)
+
+
+def summaries(webui, ids):
+    '''List of BookSummary objects for given book ids'''
+    return [BookSummary.from_record(record, webui.id)
+            for record in webui.db.getbookrecords(ids)]
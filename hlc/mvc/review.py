@@ -110,7 +110,7 @@ def view_single(webui, hexid, user=None):
 
 def view_list(webui, user=None):
     '''Show all book reviews'''
-    query = 'SELECT id FROM book_reviews ORDER BY date DESC'
+    listing = 'reviews'
     return reviews_page(**locals())
 
 
@@ -119,34 +119,20 @@ def view_by_book(webui, book_hexid, user=None):
     book = webui.item(Book, book_hexid)
     if not book.saved:
         abort(404)
-    query = 'SELECT id FROM book_reviews WHERE book_id=? ORDER BY date DESC'
+    listing = 'book_reviews'
     params = (book.id,)
     return reviews_page(**locals())
 
 
-def reviews_page(webui, query, params=None, title=None, user=None, book=None, **ka):
+def reviews_page(webui, listing, params=(), title=None, user=None, book=None, **ka):
     '''
-    Generate reviews page from SQL query that returns their ids
+    Generate reviews page from one of WebUI.listing_queries
 
     Pagination is added automatically based on URL parameters of GET request
     '''
-    query = query + ' LIMIT ? OFFSET ?'
-
-    if params is None:
-        params = list()
-    else:
-        params = list(params)
     title = title or 'Отзывы'
-
-    page = webui.pagination_params()
-    select = webui.db.sql.iterate(
-        webui.db.sql.generic(
-            webui.db.connection,
-            query,
-            params=params + [page.size, page.offset]
-        )
-    )
-    reviews = (BookReview(webui.db, row[0]) for row in select)
+    rows, page = webui.seek_page(listing, params)
+    reviews = (BookReview(webui.db, row['id']) for row in rows)
     return template(
         'review_all',
         info=webui.info,
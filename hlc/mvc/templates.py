@@ -0,0 +1,86 @@
+'''
+Precompiled page templates with render profiling
+'''
+
+import os
+import threading
+import time
+from bottle import SimpleTemplate, TEMPLATES
+from hlc.db import QUERIES
+
+
+class ProfiledTemplate(SimpleTemplate):
+    '''
+    Bottle template that records how long each render takes and how many SQL
+    statements are issued meanwhile (see hlc.db.QUERIES)
+
+    Numbers are inclusive: time and queries of included templates are also
+    counted towards the including one.
+
+    Templates compiled by precompile() are shared by all includes, so each
+    template file is parsed only once per process
+    '''
+    _pinned = dict()
+    _stats = dict()
+    _lock = threading.Lock()
+
+    def execute(self, _stdout, kwargs):
+        started = time.perf_counter()
+        queries = QUERIES.count
+        try:
+            return super().execute(_stdout, kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            queries = QUERIES.count - queries
+            with self._lock:
+                stats = self._stats.setdefault(self.name, [0, 0.0, 0, 0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] += queries
+                stats[3] = max(stats[3], queries)
+
+    def _include(self, _env, _name=None, **kwargs):
+        if _name in self._pinned and _name not in self.cache:
+            self.cache[_name] = self._pinned[_name]
+        return super()._include(_env, _name, **kwargs)
+
+    @classmethod
+    def stats(cls):
+        '''Render statistics for each template, slowest first'''
+        with cls._lock:
+            items = [(name, list(values)) for name, values in cls._stats.items()]
+        items.sort(key=lambda item: item[1][1], reverse=True)
+        return {
+            str(name): dict(
+                renders=renders,
+                time=seconds,
+                avg_time=seconds / renders,
+                queries=queries,
+                max_queries=max_queries,
+            )
+            for name, (renders, seconds, queries, max_queries) in items
+        }
+
+
+def precompile(lookup):
+    '''
+    Compile all templates found in `lookup` directories and pin them in
+    Bottle's template cache. Compilation errors are raised at startup instead
+    of the first request that needs the template.
+
+    Returns the number of compiled templates
+    '''
+    count = 0
+    for directory in lookup:
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            name, extension = os.path.splitext(filename)
+            if extension != '.tpl' or name in ProfiledTemplate._pinned:
+                continue
+            tpl = ProfiledTemplate(name=name, lookup=lookup)
+            tpl.co  # force compilation
+            ProfiledTemplate._pinned[name] = tpl
+            TEMPLATES[(id(lookup), name)] = tpl
+            count += 1
+    return count
@@ -212,7 +212,7 @@ count = include(
     page=Page(size=show_top_reviews, num=0, offset=0),
     **locals()
 )['count']
-if count == show_top_reviews:
+if count > show_top_reviews:
 %>
 <a href="{{ info['url'].path }}/reviews">
     Показать все отзывы
@@ -1,14 +1,15 @@
 % import itertools
-% from hlc.items import Series, Author, Tag
-% book_url = "/books/%s" % id.book.encode(book.id)
+% from hlc.mvc.book import BookSummary
+% book = BookSummary.wrap(book, id)
+% book_url = book.url
 <div class="book_preview clearfix">
 
 <a href="{{book_url}}">
 <h2>{{book.name}}
-% authors = book.getconnected(Author)
+% authors = book.authors
 % if authors:
 %   max_authors = 3
-%   names = [ author.name.replace(",","") for author in itertools.islice(authors,max_authors+1) ]
+%   names = [ author.replace(",","") for author in itertools.islice(authors,max_authors+1) ]
 %   if len(names) > max_authors:
 %       names.pop()
 %       names_suffix = " и др."
@@ -20,10 +21,10 @@
 </h2>
 </a>
 
-% if book.thumbnail_id:
+% if book.thumbnail:
 <div class="thumb">
     <a href="{{book_url}}">
-        <img src="/thumbs/{{id.thumb.encode(book.thumbnail_id)}}"/>
+        <img src="{{book.thumbnail}}"/>
     </a>
 </div>
 % end
@@ -40,7 +41,7 @@
 </div>
 % end
 
-% series = book.getconnected(Series, order="type")
+% series = book.series
 % if series:
 <div class="info_line">
 % for s in series:
@@ -48,7 +49,7 @@
 % if s.type:
 % num_info += s.type
 % end
-% position = s.position(book)
+% position = s.position
 % if position:
 %   if num_info: num_info += ", "
 %   end
@@ -60,7 +61,7 @@
 % if num_info:
 %   num_info = num_info.join("()")
 % end
-<a href="/series/{{id.series.encode(s.id)}}">{{s.name}}</a> {{num_info or ""}}<br/>
+<a href="{{s.url}}">{{s.name}}</a> {{num_info or ""}}<br/>
 % end
 </div>
 % end
@@ -79,7 +80,7 @@
 <div class="info_line">{{" – ".join(info_line2)}}</div>
 % end
 
-% tags = book.getconnected(Tag)
+% tags = book.tags
 % if tags:
 <div class="info_line">
 % first_tag = True
@@ -88,7 +89,7 @@
 ,
 %   end
 %   first_tag = False
-<a href="/tag/{{t.name}}" class="tag">{{t.name}}</a>\\
+<a href="/tag/{{t}}" class="tag">{{t}}</a>\\
 % end
 </div>
 % end
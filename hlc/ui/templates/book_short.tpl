@@ -1,15 +1,16 @@
 % import itertools
-% from hlc.items import Series, Author, Tag
-% book_url = "/books/%s" % id.book.encode(book.id)
+% from hlc.mvc.book import BookSummary
+% book = BookSummary.wrap(book, id)
+% book_url = book.url
 <div class="book_short clearfix">
 
 <a href="{{book_url}}">
 <h2>{{book.name}}
-% authors = book.getconnected(Author)
+% authors = book.authors
 % if authors and not "author" in hide:
 - \\
 %   max_authors = 3
-%   names = [ author.name.replace(",","") for author in itertools.islice(authors,max_authors+1) ]
+%   names = [ author.replace(",","") for author in itertools.islice(authors,max_authors+1) ]
 %   if len(names) > max_authors:
 %       names.pop()
 %       names_suffix = " и др."
@@ -24,7 +25,7 @@
 </h2>
 </a>
 
-% series = book.getconnected(Series, order="type")
+% series = book.series
 % if series:
 <div class="info">
 % first = True
@@ -38,7 +39,7 @@
 % if s.type:
 % num_info += s.type
 % end
-% position = s.position(book)
+% position = s.position
 % if position:
 %   if num_info: num_info += ", "
 %   end
@@ -50,7 +51,7 @@
 % if num_info:
 %   num_info = num_info.join("()")
 % end
-<a href="/series/{{id.series.encode(s.id)}}">{{s.name}}</a> {{num_info or ""}}</span>\\
+<a href="{{s.url}}">{{s.name}}</a> {{num_info or ""}}</span>\\
 % end
 </div>
 % end
@@ -1,6 +1,25 @@
 <%
 from urllib.parse import urlencode, parse_qs
 params = {k:v[0] for k,v in parse_qs(info["url"][3]).items()}
+if hasattr(page, 'next'):
+    # keyset pagination (see WebUI.seek_page)
+    for key in ('p', 'last', 'after', 'before'):
+        params.pop(key, None)
+    end
+%>
+<div class="page_nav">
+% if page.prev:
+%    params["before"] = page.prev
+<a class="prev" href="{{'?'+urlencode(params)}}">&lt; назад </a>
+%    del params["before"]
+% end
+% if page.next:
+%    params["after"] = page.next
+<a class="next" href="{{'?'+urlencode(params)}}"> далее &gt;</a>
+% end
+</div>
+<%
+else:
 last = params.pop('last', False)
 if (not count) and page.num and not last:
     from bottle import redirect
@@ -19,3 +38,4 @@ end
 <a class="next" href="{{'?'+urlencode(params)}}"> далее &gt;</a>
 % end
 </div>
+% end
@@ -7,10 +7,22 @@
 % if get("message"):
 <div class="message">{{message}}</div>
 % end
+% progress = get("progress")
+% if progress and progress["pending"]:
+<div class="message">
+    Поиск информации о книгах: осталось {{progress["pending"]}}
+    % if progress["per_minute"]:
+    ({{progress["per_minute"]}} в минуту)
+    % end
+</div>
+% end
 <ul class="items">Ранее добавлены:
 % for barcode in get("barcodes", set()):
 <li class="barcode">
     <a class="add" href="/books/add?isbn={{barcode.isbn}}">{{barcode.isbn}}</a>
+    % if barcode.title:
+    <span class="title">{{barcode.title}}</span>
+    % end
     <a class="del" href="/queue?isbn={{barcode.isbn}}&delete=yes">[x]</a>
 </li>
 % end
@@ -11,7 +11,7 @@ end
 count = 0
 for review in reviews:
     count += 1
-    if count == page.size:
+    if count > page.size:
         break
     end
     book = next(review.getconnected(Book))
@@ -28,24 +28,17 @@
 </style>
 
 <div class="rTable">
-% if cursor:
     <div class="rTableHeading">
-    % for field in [x[0] for x in cursor.description]:
+    % for field in columns:
         <div class="rTableHead">{{field}}</div>
     % end
     </div>
-    % for row in cursor.fetchall():
+    % for row in rows:
         <div class="rTableRow">
         % for value in row:
-            <div class="rTableCell">\\
-            <%
-            if isinstance(value, bytes):
-                value = "<BLOB>"
-            end
-            %>
-            {{value}}</div>
+            <div class="rTableCell">{{value}}</div>
         % end
         </div>
     % end
-% end
 </div>
+% include('pagination', **locals())
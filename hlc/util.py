@@ -9,8 +9,10 @@ import os
 import random
 import re
 import textwrap
+import threading
+import time
 from datetime import datetime
-from collections import UserDict
+from collections import OrderedDict, UserDict
 from hashlib import sha512
 
 
@@ -223,6 +225,89 @@ class DynamicDict(UserDict):
             pass
 
 
+class LRUCache(object):
+    """
+    Thread-safe mapping with limited size and optional expiration
+
+    Least recently used items are evicted when there are more than `size`
+    of them. If `weigh` function is given, `size` limits the total weight
+    of stored values instead (e.g. number of bytes). If `ttl` is given, items
+    expire that many seconds after being stored
+
+    Attributes `hits` and `misses` count the results of get() calls
+    """
+    def __init__(self, size=1000, ttl=None, weigh=None):
+        self._size = size
+        self._ttl = ttl
+        self._weigh = weigh
+        self._weight = 0
+        self._items = OrderedDict()  # key: (expires, value, weight)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value, weight = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        expires = None
+        if self._ttl is not None:
+            expires = time.monotonic() + self._ttl
+        weight = 1 if self._weigh is None else self._weigh(value)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            if weight > self._size:
+                return  # would evict everything else and still not fit
+            self._items[key] = (expires, value, weight)
+            self._weight += weight
+            while self._weight > self._size:
+                self._remove(next(iter(self._items)))
+
+    def _remove(self, key):
+        self._weight -= self._items.pop(key)[2]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items[key][1]
+            self._remove(key)
+            return value
+
+    def discard(self, condition):
+        """Remove all items for which condition(key, value) is true"""
+        with self._lock:
+            matching = [k for k, v in self._items.items() if condition(k, v[1])]
+            for key in matching:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._weight = 0
+
+    @property
+    def weight(self):
+        """Total weight of stored values"""
+        return self._weight
+
+    def __len__(self):
+        return len(self._items)
+
+
 def timestamp():
     """Return current Unix timestamp"""
     return int(datetime.timestamp(datetime.now()))
@@ -321,6 +406,20 @@ def fuzzy_str_eq(one, two):
     return (one == two or simplify(one) == simplify(two))
 
 
+def chunks(sequence, size):
+    """
+    Split sequence into lists of `size` elements (the last one may be shorter)
+    """
+    chunk = list()
+    for item in sequence:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
 def parse_csv(csv):
     """
     Parse comma-separated sequence of values (one line)
@@ -5,14 +5,18 @@ HomeLibraryCatalog main code module
 import sqlite3
 import os
 import json
+import logging
 import re
+import time
 import urllib.parse
 import urllib.request
 from collections import namedtuple
-from threading import get_ident
 from datetime import datetime, timedelta
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import sha224
 from bottle import (
     Bottle,
+    HTTPResponse,
     TEMPLATE_PATH,
     abort,
     redirect,
@@ -37,26 +41,37 @@ from .items import (
 )
 from .db import (
     CatalogueDB,
+    ConnectionPool,
     DBKeyValueStorage,
     FSKeyFileStorage,
+    QUERIES,
+    QueryStats,
+    inefficient_steps,
+    query_plan,
 )
 from .util import (
     DynamicDict,
     LinCrypt,
+    LRUCache,
     ReadOnlyDict,
     debug,
     message,
     parse_csv,
     random_str,
-    time2unix,
     timestamp,
 )
-from .fetch import book_info, book_thumbs
+from .fetch import QueueResolver, book_info, book_thumbs, setup_cache
+from .autocomplete import Autocomplete
+from .bulk import EXPORT_FORMATS, export
 from .db_transition import upgrade
 from . import mvc
 
 
 Page = namedtuple("Page", ["num", "size", "offset"])
+ListingQuery = namedtuple("ListingQuery", ["sql", "sample_params", "allow_sort", "seek_key"])
+SeekPage = namedtuple("SeekPage", ["size", "prev", "next"])
+
+log = logging.getLogger(__name__)
 
 
 class WebUI(object):
@@ -79,6 +94,9 @@ class WebUI(object):
             SessionManager() object. Stores sessions for normal users
         info
             Dictionary with some basic stats
+        listing_queries
+            SQL queries behind listing pages. Their plans are checked at
+            startup, see _check_query_plans()
 
     Access control wrappers:
         _acl_user
@@ -98,22 +116,111 @@ class WebUI(object):
         "series": 1991,
     }
 
+    listing_queries = {
+        # Sorting in temporary B-tree is allowed (allow_sort) only for rows
+        # that belong to a single author, tag or series. Listings with
+        # seek_key use keyset pagination (see seek_page)
+        "books": ListingQuery("""
+            SELECT id, last_edit FROM books
+            WHERE 1 {seek}
+            ORDER BY last_edit {order}, id {order}
+            LIMIT ?
+            """, (0, 0, 10), False, ("last_edit", "id")),
+        "author": ListingQuery("""
+            SELECT book_id
+            FROM (
+               SELECT book_id FROM book_authors WHERE author_id = ?
+            ) as conn LEFT JOIN books ON conn.book_id = books.id
+            ORDER BY books.year ASC, books.last_edit ASC
+            LIMIT ? OFFSET ?
+            """, (1, 25, 0), True, None),
+        "tag": ListingQuery("""
+            SELECT book_id
+            FROM (
+               SELECT book_id FROM book_tags WHERE tag_id = ?
+            ) as conn LEFT JOIN books ON conn.book_id = books.id
+            ORDER BY books.year ASC, books.last_edit ASC
+            LIMIT ? OFFSET ?
+            """, (1, 25, 0), True, None),
+        "series": ListingQuery("""
+            SELECT book_id
+            FROM
+                (SELECT book_id, book_number FROM book_series WHERE series_id = ?) as conn
+                LEFT JOIN
+                books
+                ON conn.book_id = books.id
+            ORDER BY conn.book_number ASC, books.year ASC, books.last_edit ASC
+            LIMIT ? OFFSET ?
+            """, (1, 25, 0), True, None),
+        "reviews": ListingQuery("""
+            SELECT id, date FROM book_reviews
+            WHERE 1 {seek}
+            ORDER BY date {order}, id {order}
+            LIMIT ?
+            """, (0, 0, 10), False, ("date", "id")),
+        "book_reviews": ListingQuery("""
+            SELECT id, date FROM book_reviews
+            WHERE book_id = ? {seek}
+            ORDER BY date {order}, id {order}
+            LIMIT ?
+            """, (1, 0, 0, 10), False, ("date", "id")),
+        "queue": ListingQuery(
+            "SELECT id FROM barcode_queue ORDER BY date DESC",
+            (), False, None),
+    }
+
     def __init__(self, sqlite_file, config):
-        self._connections = ThreadItemPool(CatalogueDB, sqlite_file)
+        self._writer_db = CatalogueDB(sqlite_file, shared=True)
+        writer = self._writer_db.writer
+        for pragma in (
+                "journal_mode=WAL",
+                "synchronous=NORMAL",
+                "wal_autocheckpoint=%d" % int(config.db.checkpoint_pages),
+            ):
+            writer.connection.execute("PRAGMA " + pragma).fetchall()
+        writer.connection.set_trace_callback(QUERIES.trace)
+        writer.checkpoint_interval = int(config.db.checkpoint_interval)
+        writer.checkpoint_mode = str(config.db.checkpoint_mode)
+        self._autocomplete = Autocomplete(int(config.webui.suggest_limit))
+
+        def connect():
+            db = CatalogueDB(sqlite_file, shared=True, writer=writer,
+                             identity_map=True)
+            db.connection.set_trace_callback(QUERIES.trace)
+            db.listeners.append(self._autocomplete.changed)
+            return db
+        self._connect = connect
+        self._connections = ConnectionPool(connect, size=int(config.db.pool_size))
         self._info_init()
         self._db_init()
         self._app = Bottle()
         self._first_user = self.option.get("init_user")
         self._datadir = os.path.dirname(os.path.abspath(sqlite_file))
+        self._slow_queries_init(config)
         self._info["title"] = config.app.title
         self._scramble_key = int(config.webui.id_key)
         self._cookie_secret = str(config.webui.cookie_key)
+        self._sessions_cache = LRUCache(size=1000, ttl=5*60)
+        self._pages_cache = LRUCache(
+            size=int(float(config.webui.page_cache) * 2**20),
+            weigh=lambda page: len(page[0]))
         self._static_location = os.path.join(config.app.root, "ui", "static")
         self._uploads = FSKeyFileStorage(
             os.path.join(self._datadir, "uploads"),
             max_filesize=10*2**20)
+        setup_cache(
+            os.path.join(self._datadir, config.fetch.cache),
+            config.fetch.ttl,
+            config.fetch.negative_ttl)
+        self._queue_workers = int(config.fetch.queue_workers)
+        self.queue = QueueResolver(
+            lambda: CatalogueDB(sqlite_file, writer=writer),
+            self._queue_workers)
+        if self._queue_workers:
+            self.queue.wake()
         TEMPLATE_PATH.insert(
             0, os.path.join(config.app.root, "ui", "templates"))
+        mvc.templates.precompile(TEMPLATE_PATH)
 
         class IDReader(object):
             pass
@@ -127,17 +234,18 @@ class WebUI(object):
             ("/static/<filename:path>", self._clbk_static),
             ("/<path:path>/", self._clbk_trailing_slash),
         )
+        cached = self._cached_page
         routes_after_init = (
             ("/", self._clbk_frontpage),
-            ("/authors/<hexid>", self._clbk_books_author),
-            ("/books", self._clbk_books_all),
+            ("/authors/<hexid>", cached(self._clbk_books_author)),
+            ("/books", cached(self._clbk_books_all)),
             ("/books/<book_hexid>/reviews", self._clbk_review_by_book),
-            ("/books/<hexid>", self._clbk_book),
+            ("/books/<hexid>", cached(self._clbk_book)),
             ("/reviews", self._clbk_review_list),
             ("/reviews/<hexid>", self._clbk_review_show),
             ("/search", self._clbk_search_simple),
-            ("/series/<hexid>", self._clbk_books_series),
-            ("/tag/<name>", self._clbk_books_tag),
+            ("/series/<hexid>", cached(self._clbk_books_series)),
+            ("/tag/<name>", cached(self._clbk_books_tag)),
             ("/thumbs/<hexid>", self._clbk_thumb),
         )
         routes_user = (
@@ -159,9 +267,13 @@ class WebUI(object):
         routes_admin = (
             ("/books/<hexid>/delete", self._clbk_book_delete),
             ("/table/<table>", self._clbk_table),
+            ("/export/<format>", self._clbk_export),
             ("/admin/users", self._clbk_admin_users, ["GET", "POST"]),
             ("/admin/groups", self._clbk_admin_groups, ["GET", "POST"]),
+            ("/admin/stats", self._clbk_admin_stats),
         )
+        self._check_query_plans()
+        self._connections.release()  # connection used for initialization
         for route_list, wrapper in (
                 (routes_no_acl, None),
                 (routes_after_init, self._acl_not_firstrun),
@@ -175,12 +287,24 @@ class WebUI(object):
         for code in [404, 403]:
             self.app.error(code)(http_error_handler)
 
-    def __call__(self, *a, **ka):
-        return self.app(*a, **ka)
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        QUERIES.reset()
+
+        def start_with_timing(status, headers, *exc_info):
+            headers.append(("Server-Timing", "%s, total;dur=%.1f" % (
+                QUERIES.summary,
+                (time.perf_counter() - started) * 1000)))
+            return start_response(status, headers, *exc_info)
+
+        try:
+            return self.app(environ, start_with_timing)
+        finally:
+            self._connections.release()
 
     def __del__(self):
-        for conn in self._connections.pool.values():
-            conn.close()
+        self._connections.close()
+        self._writer_db.close()
 
     def adduser(self, username, password, expiration=None):
         """
@@ -200,8 +324,8 @@ class WebUI(object):
         """
         Search for string in most important book properties
 
-        Returns number of books matching the query and generator object
-        yielding Book instances for books matching the search string
+        Returns a sequence of Book instances for books matching the search
+        string
 
         Arguments:
             search
@@ -213,43 +337,28 @@ class WebUI(object):
                 "title", "author". Raises sqlite3.OperationalError if invalid
                 sort key is supplied
         """
-        # sqlite's fts3,fts4,fts5 are much more superior, but Python's default
-        # build of this library does not support those extensions
-        WILDCARD = "*"  # single char
-
-        search = re.sub(r"\s+", " ", search).strip()
-        search = re.sub(r"[^\d\w %s]" % WILDCARD, "", search).lower()
-        old_words = search.split(" ")
-        words = list()
-        for i in range(len(old_words)):
-            new_word = old_words[i]
-            if len(new_word.strip(WILDCARD)) > 2:  # drop short words
-                if new_word[0] != WILDCARD:
-                    new_word = " " + new_word
-                if new_word[-1] != WILDCARD:
-                    new_word = new_word + " "
-                words.append(new_word.strip(WILDCARD))
-        where_clause = " AND ".join("instr(info, ?)>0" for w in words)
+        return self.db.getbooks(self._booksearch_ids(search, page, sort_keys))
+
+    def _booksearch_ids(self, search, page=None, sort_keys=None):
+        """Ids of books matching the search string, see booksearch()"""
+        subquery, params = self.db.search_index.query(search)
 
         if not sort_keys:
             sort_keys = ("in_date DESC",)
         order_clause = ", ".join(sort_keys)
 
-        query = "SELECT DISTINCT id FROM search_books WHERE %s ORDER BY %s" % (
-            where_clause, order_clause)
-
-        if words:
+        if subquery:
+            query = "SELECT id FROM book_summary WHERE id IN (%s) ORDER BY %s" % (
+                subquery, order_clause)
             if page:
                 query += " LIMIT ? OFFSET ?"
-                words += list(page[1:])
+                params += list(page[1:])
             cur = self.db.sql.generic(
                 self.db.connection,
                 query,
-                params=tuple(words))
-            books = (self.db.getbook(row[0]) for row in self.db.sql.iterate(cur))
-        else:
-            books = ()
-        return books
+                params=tuple(params))
+            return [row[0] for row in cur]
+        return []
 
     def pagination_params(self, default_size=10, max_size=100):
         """Read pagination parameters from GET request"""
@@ -261,44 +370,112 @@ class WebUI(object):
         offset = page_num * page_size
         return Page(page_num, page_size, offset)
 
+    def seek_page(self, listing, params=(), default_size=10, max_size=100):
+        """
+        Run listing query with keyset pagination (see listing_queries)
+
+        Instead of skipping OFFSET rows the query continues right after the
+        seek_key columns of the last row of the previous page, so every page
+        costs the same. Position is passed in opaque `after` (next page) or
+        `before` (previous page) GET parameters.
+
+        Listings are sorted by seek_key columns in descending order, the
+        last of them has to be unique
+
+        Arguments:
+            listing
+                Name of one of listing_queries or ListingQuery object
+            params
+                Query parameters that precede the seek condition
+
+        Returns (rows, page) tuple where page is SeekPage with tokens for
+        adjacent pages, or None if there is no such page
+        """
+        if isinstance(listing, str):
+            listing = self.listing_queries[listing]
+        keys = listing.seek_key
+        query = request.query.decode()
+        size = max(1, min(max_size, int(query.get("ps", default_size))))
+        backward = bool(query.get("before")) and not query.get("after")
+        token = query.get("before") if backward else query.get("after")
+        params = list(params)
+        seek = ""
+        if token:
+            seek = "AND (%s) %s (%s)" % (
+                ", ".join(keys), ">" if backward else "<", ", ".join("?" * len(keys)))
+            params += self._seek_token(token, len(keys))
+        sql = listing.sql.format(seek=seek, order="ASC" if backward else "DESC")
+        search = self.db.sql.generic(self.db.connection, sql, params=params + [size + 1])
+        rows = search.fetchall()
+        more = len(rows) > size
+        rows = rows[:size]
+        if backward:
+            rows.reverse()
+        prev = next = None
+        if rows:
+            # Going backward means there is a page after this one; going
+            # forward from a token means there is one before it
+            if more if backward else token:
+                prev = self._seek_token([rows[0][key] for key in keys])
+            if backward or more:
+                next = self._seek_token([rows[-1][key] for key in keys])
+        return rows, SeekPage(size, prev, next)
+
+    @staticmethod
+    def _seek_token(value, length=None):
+        """Encode seek key values to opaque string or decode them back"""
+        if isinstance(value, str):
+            try:
+                values = json.loads(
+                    urlsafe_b64decode(value.encode("ascii") + b"==").decode("utf-8"))
+            except (ValueError, UnicodeError):
+                values = None
+            if not isinstance(values, list) or len(values) != length \
+            or not all(x is None or isinstance(x, (int, float, str)) for x in values):
+                abort(404, "Invalid page token: %s" % value)
+            return values
+        return urlsafe_b64encode(
+            json.dumps(list(value)).encode("utf-8")).decode("ascii").rstrip("=")
+
     def read_cookie(self, name="auth"):
+        """
+        Check session cookie. Returns (valid, session) tuple, where session is
+        (user_id, group_ids, timestamp) or None
+
+        Sessions are cached in memory (see _sessions_cache), so most requests
+        do not need any database queries to identify the user
+        """
         COOKIE_MAX_AGE = 2*24*60*60  # seconds
 
         cookie = request.get_cookie(name, secret=self._cookie_secret)
-        data = self.session.get(cookie)
-
-        valid = self.session.valid(cookie)
-        valid_age = valid and data[1] + COOKIE_MAX_AGE > timestamp()
-        if valid and not valid_age:
-            self.session.pop(cookie)
+        if cookie is None:
+            return False, None
+
+        session = self._sessions_cache.get(cookie)
+        if session is None:
+            data = self.session.get(cookie)
+            if data is None:
+                return False, None
+            user_id, created = data
+            groups = User(self.db, user_id).getconnected_id(Group)
+            session = self._sessions_cache[cookie] = (user_id, groups, created)
+
+        valid = session[2] + COOKIE_MAX_AGE > timestamp()
+        if not valid:
+            self._sessions_cache.pop(cookie)
+            try:
+                self.session.pop(cookie)
+            except KeyError:
+                pass
             response.delete_cookie(name)
 
-        return valid and valid_age, data
+        return valid, session
 
     def suggest(self, field, input, count=10):
         """
-        Return suggestions based on user input
+        Return suggestions based on user input (see Autocomplete.FIELDS)
         """
-        translate = {
-            # form_field: (db_table, db_column)
-            "title": ("books", "name"),
-            "author": ("authors", "name"),
-            "publisher": ("books", "publisher"),
-            "in_type": ("books", "in_type"),
-            "in_comment": ("books", "in_comment"),
-            "out_type": ("books", "out_type"),
-            "out_comment": ("books", "out_comment"),
-            "series_type": ("series", "type"),
-            "series_name": ("series", "name"),
-            "tags": ("tags", "name"),
-            "groups": ("groups", "name"),
-        }
-
-        result = list()
-        if field in translate:
-            table, column = translate[field]
-            result = self.db.getsuggestions(str(input), table, column, count)
-        return result
+        return self._autocomplete.suggest(self.db, field, str(input), count)
 
     def _acl_admin(self, func):
         """Restrict access to callbacks to administators only"""
@@ -340,13 +517,53 @@ class WebUI(object):
                 redirect("/login" + to)
         return with_user
 
+    def _cached_page(self, func):
+        """
+        Wrapper for callback functions that render catalogue pages. Keeps
+        rendered pages in memory until any catalogue item is modified
+
+        Pages are cached separately for each user because page header
+        depends on the user. Database writer generation is a part of the key,
+        so all entries become obsolete after the next write (see
+        SQLiteWriter.touch). ETag is derived from page contents
+        """
+        def with_cache(*a, **ka):
+            user = ka.get("user")
+            generation = self.db.writer.generation  # before reading any data
+            key = (
+                request.path,
+                request.query_string,
+                user.id if user else None,
+                generation)
+            page = self._pages_cache.get(key)
+            if page is None:
+                body = func(*a, **ka)
+                if not isinstance(body, str):
+                    return body
+                etag = '"%s"' % sha224(body.encode("utf-8")).hexdigest()
+                page = self._pages_cache[key] = (body, etag)
+            body, etag = page
+            headers = {
+                "ETag": etag,
+                "Cache-Control": "private, no-cache",
+                "Vary": "Cookie",
+            }
+            if etag in request.headers.get("If-None-Match", ""):
+                return HTTPResponse(status=304, **headers)
+            for header, value in headers.items():
+                response.set_header(header, value)
+            return body
+        return with_cache
+
     def _acl_not_firstrun(self, func):
         """Wrapper for _acl_* functions that require app initialization"""
         def with_init(*a, **ka):
             if (not self._first_user) or (not self.option.get("init_user")):
                 valid, session = self.read_cookie()
                 if valid:
-                    user = User(self.db, session[0])
+                    user_id, groups = session[:2]
+                    user = User(self.db, user_id)
+                    user._connected[Group] = [Group(self.db, g) for g in groups]
                     ka["user"] = user
                 return func(*a, **ka)
             else:
@@ -381,6 +598,22 @@ class WebUI(object):
             add=request.forms.decode().get("add"),
             user=user)
 
+    def _clbk_admin_stats(self, user=None):
+        """Runtime metrics in JSON format"""
+        response.content_type = "application/json"
+        return json.dumps(dict(
+            db_pool=self._connections.stats,
+            queue=self.queue.stats,
+            sessions=dict(cached=len(self._sessions_cache)),
+            pages=dict(
+                cached=len(self._pages_cache),
+                bytes=self._pages_cache.weight,
+                hits=self._pages_cache.hits,
+                misses=self._pages_cache.misses),
+            suggestions=self._autocomplete.stats,
+            templates=mvc.templates.ProfiledTemplate.stats(),
+        ))
+
     def _clbk_admin_users(self, user=None):
         return self._clbk_admin_generic(
             cls=User,
@@ -402,7 +635,12 @@ class WebUI(object):
         params = request.query.decode()
         isbn = params.get("isbn")
         thumbs = params.get("thumbs")
+        queued = None
+        if ISBN(isbn).valid:
+            queued = self.db.get(Barcode, "isbn", ISBN(isbn).number)
         if thumbs:
+            if queued and queued.thumbs:
+                return json.dumps(queued.thumbs)
             return json.dumps(book_thumbs(isbn))
         else:
             repeat = self.db.getbook(isbn=isbn)
@@ -412,6 +650,8 @@ class WebUI(object):
                         {"redirect": "/books/%s?repeat=yes" %
                                      self.id.book.encode(repeat.id)}}
                     )
+            elif queued and queued.info:
+                return json.dumps(queued.info)
             else:
                 return json.dumps(book_info(isbn))
 
@@ -494,67 +734,6 @@ class WebUI(object):
                       ("out_type", "out_type", validate.nonempty),
                       ("out_comment", "out_comment", validate.nonempty))
 
-            for attr, input, func in inputs:
-                valid, value = func(form.get(input))
-                if valid:
-                    setattr(book, attr, value)
-
-            try:
-                book.save()
-            except sqlite3.IntegrityError as e:
-                repeat = self.db.getbook(
-                    isbn=validate.isbn(form.get("isbn"))[1])
-                if repeat.saved:
-                    redirect("/books/%s?repeat=yes" %
-                             self.id.book.encode(repeat.id))
-                else:
-                    raise e  # is there any chance execution gets here?
-
-            for author in book.getconnected(Author):
-                book.disconnect(author)
-            for name in form.getall("author"):
-                name = name.strip()
-                if name:
-                    author = self.db.getauthor(name)
-                    if author:
-                        author.save()
-                        try:
-                            book.connect(author)
-                        except sqlite3.IntegrityError as e:
-                            raise e  # todo: handle error
-
-            for s in book.getconnected(Series):
-                book.disconnect(s)
-            for type, name, num, total in zip(
-                form.getall("series_type"),
-                form.getall("series_name"),
-                form.getall("book_no"),
-                form.getall("total")
-            ):
-                series = self.db.getseries(name)
-                if series:
-                    valid_type, type = validate.nonempty(type)
-                    if valid_type and not series.saved:
-                        series.type = type
-                    valid_total, total = validate.positive(total)
-                    if valid_total and total:
-                        series.number_books = total
-                    valid_num, num = validate.positive(num)
-                    try:
-                        series.save()
-                    except sqlite3.IntegrityError as e:
-                        raise e  # todo: handle exception
-                    if not valid_num: num = None
-                    book.connect(series, num)
-
-            for t in book.getconnected(Tag):
-                book.disconnect(t)
-            for tag in parse_csv(form.get("tags", "")):
-                if tag:
-                    t = self.db.gettag(tag)
-                    t.save()
-                    t.connect(book)
-
             url = None
             pic = request.files.get("thumbnail")
             if pic: pic = pic.file
@@ -574,46 +753,98 @@ class WebUI(object):
                             pic = None
                     except Exception as e:
                         raise e  # todo: notify user that fetching failed
-            if pic:
-                for old_pic in book.getconnected(Thumbnail):
-                    book.disconnect(old_pic)
-                thumb = Thumbnail(self.db)
-                if url: thumb.url = url
-                thumb.image = pic
-                thumb.save()
-                thumb.connect(book)
-
-            for file_hex in form.getall("delete_file"):
-                file = BookFile(self.db, self.id.file.decode(file_hex))
-                book.disconnect(file)
-            for upload in request.files.getall("upload"):
-                fo = BookFile(self.db)
-                fo.name = upload.raw_filename
-                fo.type = upload.content_type
-                fo.save()
-                try:
-                    self._uploads["BookFile:%s" % fo.id] = upload.file
-                except Exception as e:
-                    fo.delete()
-                    raise e  # todo: handle error
+
+            # All changes are committed at once, downloads are done beforehand
+            # to avoid holding database lock while waiting for remote host
+            with self.db.transaction():
+                for attr, input, func in inputs:
+                    valid, value = func(form.get(input))
+                    if valid:
+                        setattr(book, attr, value)
+
                 try:
-                    book.connect(fo)
+                    book.save()
                 except sqlite3.IntegrityError as e:
-                    raise e  # todo: handle error
+                    repeat = self.db.getbook(
+                        isbn=validate.isbn(form.get("isbn"))[1])
+                    if repeat.saved:
+                        redirect("/books/%s?repeat=yes" %
+                                 self.id.book.encode(repeat.id))
+                    else:
+                        raise e  # is there any chance execution gets here?
+
+                authors = list()
+                for name in form.getall("author"):
+                    name = name.strip()
+                    if name:
+                        author = self.db.getauthor(name)
+                        if author:
+                            author.save()
+                            authors.append(author)
+                book.setconnected(Author, authors)
+
+                series_list = list()
+                for type, name, num, total in zip(
+                    form.getall("series_type"),
+                    form.getall("series_name"),
+                    form.getall("book_no"),
+                    form.getall("total")
+                ):
+                    series = self.db.getseries(name)
+                    if series:
+                        valid_type, type = validate.nonempty(type)
+                        if valid_type and not series.saved:
+                            series.type = type
+                        valid_total, total = validate.positive(total)
+                        if valid_total and total:
+                            series.number_books = total
+                        valid_num, num = validate.positive(num)
+                        try:
+                            series.save()
+                        except sqlite3.IntegrityError as e:
+                            raise e  # todo: handle exception
+                        if not valid_num: num = None
+                        series_list.append((series, num))
+                book.setconnected(Series, series_list)
+
+                tags = list()
+                for tag in parse_csv(form.get("tags", "")):
+                    if tag:
+                        t = self.db.gettag(tag)
+                        t.save()
+                        tags.append(t)
+                book.setconnected(Tag, tags)
+
+                if pic:
+                    for old_pic in book.getconnected(Thumbnail):
+                        book.disconnect(old_pic)
+                    thumb = Thumbnail(self.db)
+                    if url: thumb.url = url
+                    thumb.image = pic
+                    thumb.save()
+                    thumb.connect(book)
+
+                for file_hex in form.getall("delete_file"):
+                    file = BookFile(self.db, self.id.file.decode(file_hex))
+                    book.disconnect(file)
+                for upload in request.files.getall("upload"):
+                    fo = BookFile(self.db)
+                    fo.name = upload.raw_filename
+                    fo.type = upload.content_type
+                    fo.save()
+                    self._uploads["BookFile:%s" % fo.id] = upload.file
+                    try:
+                        book.connect(fo)
+                    except sqlite3.IntegrityError as e:
+                        raise e  # todo: handle error
 
             redirect("/books/%s" % self.id.book.encode(book.id))
 
     def _clbk_books_all(self, user=None):
-        query = "SELECT id FROM books ORDER BY last_edit DESC LIMIT ? OFFSET ?"
-        page = self.pagination_params()
-        search = self.db.sql.generic(
-                    self.db.connection,
-                    query,
-                    params=page[1:])
+        rows, page = self.seek_page("books")
         return template(
             "book_list",
-            books=(self.db.getbook(row[0]) \
-                   for row in self.db.sql.iterate(search)),
+            books=mvc.book.summaries(self, (row["id"] for row in rows)),
             title="Все книги",
             page=page,
             info=self.info,
@@ -623,14 +854,7 @@ class WebUI(object):
     def _clbk_books_author(self, hexid, user=None):
         author = Author(self.db, self.id.author.decode(hexid))
         if not author.saved: abort(404)
-        query = """
-            SELECT book_id
-            FROM (
-               SELECT book_id FROM book_authors WHERE author_id = ?
-            ) as conn LEFT JOIN books ON conn.book_id = books.id
-            ORDER BY books.year ASC, books.last_edit ASC
-            LIMIT ? OFFSET ?
-            """
+        query = self.listing_queries["author"].sql
         page = self.pagination_params(default_size=25)
         search = self.db.sql.generic(
                     self.db.connection,
@@ -638,8 +862,7 @@ class WebUI(object):
                     params=[author.id,] + list(page[1:]))
         return template(
             "author",
-            books=(self.db.getbook(row[0]) \
-                   for row in self.db.sql.iterate(search)),
+            books=mvc.book.summaries(self, (row[0] for row in search)),
             title=author.name.replace(",", ""),
             page=page,
             info=self.info,
@@ -649,14 +872,7 @@ class WebUI(object):
     def _clbk_books_tag(self, name, user=None):
         tag = self.db.get(Tag, "name", name)
         if not tag.saved: abort(404)
-        query = """
-            SELECT book_id
-            FROM (
-               SELECT book_id FROM book_tags WHERE tag_id = ?
-            ) as conn LEFT JOIN books ON conn.book_id = books.id
-            ORDER BY books.year ASC, books.last_edit ASC
-            LIMIT ? OFFSET ?
-            """
+        query = self.listing_queries["tag"].sql
         page = self.pagination_params(default_size=25)
         search = self.db.sql.generic(
                     self.db.connection,
@@ -664,8 +880,7 @@ class WebUI(object):
                     params=[tag.id,] + list(page[1:]))
         return template(
             "series",
-            books=(self.db.getbook(row[0]) \
-                   for row in self.db.sql.iterate(search)),
+            books=mvc.book.summaries(self, (row[0] for row in search)),
             title=tag.name,
             page=page,
             info=self.info,
@@ -675,16 +890,7 @@ class WebUI(object):
     def _clbk_books_series(self, hexid, user=None):
         series = Series(self.db, self.id.series.decode(hexid))
         if not series.saved: abort(404)
-        query = """
-            SELECT book_id
-            FROM
-                (SELECT book_id, book_number FROM book_series WHERE series_id = ?) as conn
-                LEFT JOIN
-                books
-                ON conn.book_id = books.id
-            ORDER BY conn.book_number ASC, books.year ASC, books.last_edit ASC
-            LIMIT ? OFFSET ?
-            """
+        query = self.listing_queries["series"].sql
         page = self.pagination_params(default_size=25)
         search = self.db.sql.generic(
                     self.db.connection,
@@ -692,8 +898,7 @@ class WebUI(object):
                     params=[series.id,] + list(page[1:]))
         return template(
             "series",
-            books=(self.db.getbook(row[0]) \
-                   for row in self.db.sql.iterate(search)),
+            books=mvc.book.summaries(self, (row[0] for row in search)),
             title=series.name,
             page=page,
             info=self.info,
@@ -748,6 +953,7 @@ class WebUI(object):
 
     def _clbk_logout(self, user=None):
         cookie = request.get_cookie("auth", secret=self._cookie_secret)
+        self._sessions_cache.pop(cookie)
         try:
             self.session.pop(cookie)
         except KeyError:
@@ -781,7 +987,9 @@ class WebUI(object):
                 else:
                     brcode.connect(user)
                     reply = "[OK] ISBN saved to queue: %s" % isbn
-            query = "SELECT id FROM barcode_queue ORDER BY date DESC"
+                    if self._queue_workers:
+                        self.queue.wake()
+            query = self.listing_queries["queue"].sql
             search = self.db.sql.generic(
                 self.db.connection,
                 query)
@@ -790,6 +998,7 @@ class WebUI(object):
             return template(
                 "queue",
                 barcodes=barcodes,
+                progress=self.queue.stats,
                 message=reply,
                 info=self.info,
                 user=user)
@@ -807,10 +1016,10 @@ class WebUI(object):
         if not query:
             redirect("/")
         page = self.pagination_params()
-        books = self.booksearch(query, page, ["last_edit DESC"])
+        ids = self._booksearch_ids(query, page, ["last_edit DESC"])
         return template(
             "book_list",
-            books=books,
+            books=mvc.book.summaries(self, ids),
             title="Результаты поиска",
             page=page,
             info=self.info,
@@ -823,30 +1032,106 @@ class WebUI(object):
             root=self._static_location)
 
     def _clbk_table(self, table, user=None):
-        try:
-            return template("table",
-                cursor=self.db.sql.select(table),
-                title=table,
-                info=self.info,
-                user=user)
-        except sqlite3.OperationalError:
+        """
+        Browse raw database table or view. Columns are selected explicitly
+        and blobs are replaced by their sizes. Tables are paginated by rowid
+        (newest rows first), views and WITHOUT ROWID tables - by offset
+        """
+        schema = self.db.sql.generic(
+            self.db.connection,
+            "SELECT type, sql FROM sqlite_master WHERE name = ? AND type IN ('table', 'view')",
+            params=(table,)).fetchone()
+        if schema is None:
             abort(404, "Table `%s` not found in %s" % (table, self.db.filename))
+        escape = self.db.sql._escape_identifier
+        columns = [row["name"] for row in self.db.connection.execute(
+            "PRAGMA table_info(%s)" % escape(table))]
+        select = ", ".join(
+            "CASE typeof({0}) WHEN 'blob' THEN '<BLOB: ' || length({0}) || ' bytes>' "
+            "ELSE {0} END".format(escape(column)) for column in columns)
+        if schema["type"] == "table" and "WITHOUT ROWID" not in schema["sql"].upper():
+            listing = ListingQuery(
+                "SELECT rowid AS rowid, %s FROM %s WHERE 1 {seek} ORDER BY rowid {order} LIMIT ?"
+                % (select, escape(table).replace("{", "{{").replace("}", "}}")),
+                (), False, ("rowid",))
+            rows, page = self.seek_page(listing, default_size=50, max_size=500)
+            rows = [tuple(row)[1:] for row in rows]
+        else:
+            page = self.pagination_params(default_size=50, max_size=500)
+            rows = self.db.sql.generic(
+                self.db.connection,
+                "SELECT %s FROM %s LIMIT ? OFFSET ?" % (select, escape(table)),
+                params=page[1:]).fetchall()
+        return template("table",
+            columns=columns,
+            rows=rows,
+            page=page,
+            count=len(rows),
+            title=table,
+            info=self.info,
+            user=user)
+
+    def _clbk_export(self, format, user=None):
+        """
+        Download the whole catalogue (see hlc.bulk.export). Response body is
+        generated while it is being sent, so it uses a dedicated database
+        connection: pooled one is released as soon as callback returns
+        """
+        if format not in EXPORT_FORMATS:
+            abort(404, "Unknown export format: %s" % format)
+        content_type, extension = EXPORT_FORMATS[format][1:]
+        response.content_type = "%s; charset=utf-8" % content_type
+        response.set_header(
+            "Content-Disposition",
+            "attachment; filename=catalogue-%s.%s" % (
+                datetime.now().strftime("%Y%m%d"), extension))
+
+        def stream(db):
+            try:
+                for text in export(db, format):
+                    yield text.encode("utf-8")
+            finally:
+                db.close()
+        return stream(self._connect())
 
     def _clbk_thumb(self, hexid, user=None):
         """Show thumbnail based on encrypted `hexid`"""
         try:
             id = self.id.thumb.decode(hexid)
-            thumb = Thumbnail(self.db, id)
         except ValueError:
             abort(404, "Invalid thumnail ID: %s" % hexid)
+        search = self.db.sql.select(
+            Thumbnail.__TableName__,
+            {Thumbnail.__IDField__: id},
+            ("hash", "last_edit"))
+        row = search.fetchone()
+        if not row:
+            abort(404, "Invalid thumnail ID: %s" % hexid)
 
-        last_modified_unix = time2unix(thumb.last_edit)
-        last_modified_utc = datetime.utcfromtimestamp(last_modified_unix)
-        last_modified = last_modified_utc.strftime("%a, %d %b %Y %H:%M:%S GMT")
-        response.set_header("Last-Modified", last_modified)
-        response.set_header("Cache-Control", "public,max-age=%d" % (60*60*24*30))
-        response.content_type = "image/jpeg"
-        return thumb.image
+        last_modified_utc = datetime.utcfromtimestamp(row["last_edit"])
+        headers = {
+            "Last-Modified": last_modified_utc.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "Cache-Control": "public,max-age=%d" % (60*60*24*30),
+        }
+        path = row["hash"] and self.db.thumbnails.get(row["hash"])
+        if not path:  # image was not moved out of the database
+            for header, value in headers.items():
+                response.set_header(header, value)
+            response.content_type = "image/jpeg"
+            return Thumbnail(self.db, id).image
+
+        etag = row["hash"].join('""')
+        headers["ETag"] = etag
+        if_none_match = request.environ.get("HTTP_IF_NONE_MATCH", "")
+        if etag in (tag.strip() for tag in if_none_match.split(",")):
+            return HTTPResponse(status=304, **headers)
+        reply = static_file(
+            os.path.basename(path),
+            root=os.path.dirname(path),
+            mimetype="image/jpeg")
+        for header, value in headers.items():
+            reply.set_header(header, value)
+        return reply
 
     def _clbk_trailing_slash(self, path, user=None):
         redirect("/" + path)
@@ -925,6 +1210,8 @@ class WebUI(object):
                         group = self.db.get(Group, "name", group_name)
                         if group and group.saved:
                             group.connect(subject)
+                    self._sessions_cache.discard(
+                        lambda cookie, session: session[0] == subject.id)
 
                 redirect("/users/" + subject.name)
             else:
@@ -932,6 +1219,24 @@ class WebUI(object):
         else:
             abort(404, "Invalid user name: %s" % name)
 
+    def _check_query_plans(self):
+        """
+        Warn about listing queries that scan whole tables or sort their results
+        in temporary B-trees. Usually that means a missing index
+        """
+        for name, listing in sorted(self.listing_queries.items()):
+            sql = listing.sql
+            if listing.seek_key:
+                sql = sql.format(order="DESC", seek="AND (%s) < (%s)" % (
+                    ", ".join(listing.seek_key), ", ".join("?" * len(listing.seek_key))))
+            plan = query_plan(self.db.connection, sql, listing.sample_params)
+            for step in inefficient_steps(plan):
+                if listing.allow_sort and "TEMP B-TREE" in step:
+                    continue
+                log.warning("Inefficient query plan for {name} listing: {step}".format(
+                    name=name,
+                    step=step))
+
     def _create_routes(self, routes, wrapper=None):
         """
         Create multiple routes at once. Decorate callback functions in wrapper
@@ -954,7 +1259,27 @@ class WebUI(object):
                 method = "GET"
             else:
                 raise ValueError("Invalid route tuple of length=%s" % len(route))
-            self.app.route(url, method=method, callback=func)
+            self.app.route(url, method=method, callback=self._label_queries(func, url))
+
+    @staticmethod
+    def _label_queries(func, label):
+        """Wrapper that marks SQL statements issued by callback with route label"""
+        def labeled(*a, **ka):
+            QUERIES.route = label
+            return func(*a, **ka)
+        return labeled
+
+    def _slow_queries_init(self, config):
+        """Configure slow query log (see QueryStats)"""
+        threshold = float(config.db.slow_query_ms)
+        QueryStats.slow_threshold = threshold / 1000 if threshold > 0 else None
+        if config.db.slow_query_log:
+            filename = os.path.join(self._datadir, config.db.slow_query_log)
+            log = QueryStats.slow_log
+            if not any(getattr(h, "baseFilename", None) == filename for h in log.handlers):
+                handler = logging.FileHandler(filename, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                log.addHandler(handler)
 
     def _db_init(self):
         """
@@ -1024,8 +1349,13 @@ class WebUI(object):
 
     @property
     def db(self):
-        """CatalogueDB object. Used for storing persistent data. Thread-safe"""
-        return self._connections.get()
+        """
+        CatalogueDB object. Used for storing persistent data. Thread-safe
+
+        Connection is checked out from the pool on first access and is
+        returned there after request is processed (see __call__)
+        """
+        return self._connections.checkout()
 
     @property
     def app(self):
@@ -1035,12 +1365,14 @@ class WebUI(object):
     @property
     def option(self):
         """Access application persistent configuration. Thread-safe"""
-        return DBKeyValueStorage(self.db.connection, "app_config", "option", "value")
+        db = self.db
+        return DBKeyValueStorage(
+            db.connection, "app_config", "option", "value", db.writer)
 
     @property
     def session(self):
         """Manage user cookie sessions. Thread-safe"""
-        return SessionManager(self.db.connection)
+        return SessionManager(self.db.connection, self.db.writer)
 
     @property
     def info(self):
@@ -1138,14 +1470,15 @@ class SessionManager(object):
         JSON formatted session data. Data structure should be kept as simple
         as possible to avoid unexpected serialization errors
     """
-    def __init__(self, db=None):
+    def __init__(self, db=None, writer=None):
         # _sessions object should be a key-value storage for strings,
         # for example dict() or DBKeyValueStorage()
         self._sessions = DBKeyValueStorage(
             db,
             "sessions",
             "cookie",
-            "session")
+            "session",
+            writer)
 
     def get(self, cookie, default=None):
         """Get data corresponding to a cookie"""
@@ -1170,29 +1503,3 @@ class SessionManager(object):
         """Check if a cookie string represents a valid session"""
         return cookie in self._sessions
 
-
-class ThreadItemPool(object):
-    """
-    Store objects that should not be shared between threads
-
-    Thread IDs returned by threading.get_ident() may be recycled when thread
-    exits and another one is created
-    """
-    # todo: garbage-collect objects that correspond to outdated IDs
-    #       check against [t.ident for t in threading.enumerate()]
-    def __init__(self, constructor, *a, **ka):
-        def create(): return constructor(*a, **ka)
-        self._create = create
-        self._stored = dict()
-
-    def get(self):
-        thread_id = get_ident()
-        try:
-            item = self.pool[thread_id]
-        except KeyError:
-            item = self.pool[thread_id] = self._create()
-        return item
-
-    @property
-    def pool(self):
-        return self._stored
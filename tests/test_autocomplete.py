@@ -0,0 +1,75 @@
+from unittest import TestCase
+
+from hlc.autocomplete import Autocomplete, PrefixIndex
+from hlc.db import CatalogueDB
+from hlc.items import Author
+
+
+class TestPrefixIndex(TestCase):
+
+    def test_ranking(self):
+        index = PrefixIndex()
+        index.load([(1, 'Tolkien', 1), (2, 'Tolstoy', 5), (3, 'Twain', 9)])
+        self.assertEqual(index.search('TO'), ['Tolstoy', 'Tolkien'])
+        self.assertEqual(index.search('to', count=1), ['Tolstoy'])
+        self.assertEqual(index.search('x'), [])
+        self.assertEqual(index.search('...'), [])
+
+    def test_updates(self):
+        index = PrefixIndex()
+        index.load([(1, 'Tolkien', 1), (2, 'Tolkien', 1), (3, 'Tolstoy', 1)])
+        index.set(3, 'Tolkien')
+        self.assertEqual(index.search('tol'), ['Tolkien'])
+        index.remove(1)
+        index.remove(2)
+        index.set(4, 'Tolstoy', 2)
+        self.assertEqual(index.search('tol'), ['Tolstoy', 'Tolkien'])
+        self.assertEqual(len(index), 2)
+
+    def test_limit(self):
+        index = PrefixIndex(limit=2)
+        index.load([(1, 'a1', 3), (2, 'a2', 1), (3, 'a3', 2)])
+        self.assertFalse(index.complete)
+        self.assertEqual(index.search('a'), ['a1', 'a3'])
+        index.set(4, 'a4')
+        self.assertEqual(len(index), 2)
+
+
+class TestAutocomplete(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        self.autocomplete = Autocomplete()
+        self.db.listeners.append(self.autocomplete.changed)
+        self.books = list()
+        for name in ('Book one', 'Book two'):
+            book = self.db.getbook()
+            book.name = name
+            book.save()
+            self.books.append(book)
+        for name in ('Tolkien', 'Tolstoy'):
+            self.db.getauthor(name).save()
+        self.books[0].connect(self.db.getauthor('Tolkien'))
+
+    def suggest(self, field, line):
+        return self.autocomplete.suggest(self.db, field, line)
+
+    def test_ranked_by_books(self):
+        self.assertEqual(self.suggest('author', 'tol'), ['Tolkien', 'Tolstoy'])
+        tolstoy = self.db.getauthor('Tolstoy')
+        for book in self.books:
+            book.connect(tolstoy)
+        self.assertEqual(self.suggest('author', 'tol'), ['Tolstoy', 'Tolkien'])
+
+    def test_rename_and_delete(self):
+        self.assertEqual(self.suggest('title', 'book'), ['Book one', 'Book two'])
+        self.books[1].name = 'Another book'
+        self.books[1].save()
+        self.assertEqual(self.suggest('title', 'book'), ['Book one'])
+        self.assertEqual(self.suggest('title', 'an'), ['Another book'])
+        self.suggest('author', 't')
+        Author(self.db, self.db.getauthor('Tolkien').id).delete()
+        self.assertEqual(self.suggest('author', 'tol'), ['Tolstoy'])
+
+    def test_unknown_field(self):
+        self.assertEqual(self.suggest('isbn', '978'), [])
@@ -0,0 +1,112 @@
+from unittest import TestCase
+
+from hlc.db import CatalogueDB
+from hlc.db_transition import SCHEMA_TRANSITIONS, upgrade, version
+from hlc.items import Author, Book, Series
+
+
+class TestBookSummary(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        self.books = list()
+        for name, authors in (('Hobbit', ('Tolkien', 'Lewis')), ('Narnia', ('Lewis',))):
+            book = self.db.getbook()
+            book.name = name
+            book.save()
+            for name in authors:
+                author = self.db.getauthor(name)
+                author.save()
+                book.connect(author)
+            self.books.append(book)
+        self.series = self.db.getseries('Saga')
+        self.series.type = 'cycle'
+        self.series.save()
+        self.books[0].connect(self.series, 1)
+        tag = self.db.gettag('fantasy')
+        tag.save()
+        self.books[0].connect(tag)
+
+    def summary(self, book):
+        row = self.db.sql.select('book_summary', {'id': book.id}).fetchone()
+        return row and dict(row)
+
+    def test_sync(self):
+        hobbit = self.summary(self.books[0])
+        self.assertEqual(hobbit['title'], 'Hobbit')
+        self.assertEqual(hobbit['author'], 'Tolkien')
+        self.assertEqual(hobbit['authors'], '["Tolkien","Lewis"]')
+        self.assertEqual(hobbit['series'], '[[%s,"Saga","cycle",1,null]]' % self.series.id)
+        self.assertEqual(hobbit['tags'], '["fantasy"]')
+
+        self.series.number_books = 3
+        self.series.save()
+        author = self.db.getauthor('Lewis')
+        author.name = 'Lewis, C.S.'
+        author.save()
+        self.books[0].disconnect(self.db.getauthor('Tolkien'))
+        hobbit = self.summary(self.books[0])
+        self.assertEqual(hobbit['authors'], '["Lewis, C.S."]')
+        self.assertIn(',3]]', hobbit['series'])
+        self.assertEqual(self.summary(self.books[1])['author'], 'Lewis, C.S.')
+
+        Series(self.db, self.series.id).delete()
+        self.assertEqual(self.summary(self.books[0])['series'], '[]')
+        Book(self.db, self.books[1].id).delete()
+        self.assertIsNone(self.summary(self.books[1]))
+
+    def test_refresh_once(self):
+        refreshes = list()
+        self.db.connection.create_function('refreshed', 0, lambda: refreshes.append(1))
+        self.db.connection.execute(
+            'CREATE TEMP TRIGGER count_refresh AFTER INSERT ON main.book_summary '
+            'BEGIN SELECT refreshed(); END')
+        book = Book(self.db, self.books[1].id)
+        book.name = 'Narnia, vol. 1'
+        book.year = 2000
+        book.isbn = '0-306-40615-2'
+        book.save()
+        self.assertEqual(len(refreshes), 1)
+        book.price = 10
+        book.save()
+        self.assertEqual(len(refreshes), 1)
+        summary = self.summary(book)
+        self.assertEqual((summary['title'], summary['year']), ('Narnia, vol. 1', 2000))
+        self.assertEqual(summary['last_edit'], self.db.connection.execute(
+            'SELECT last_edit FROM books WHERE id = ?', (book.id,)).fetchone()[0])
+
+    def test_one_row_per_book(self):
+        ids = [row[0] for row in self.db.connection.execute(
+            'SELECT id FROM book_summary ORDER BY author, title')]
+        self.assertEqual(ids, [self.books[1].id, self.books[0].id])
+
+    def test_upgrade(self):
+        before = [tuple(row) for row in self.db.sql.select('book_summary')]
+        with self.db.writer as connection:
+            for name, in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE name LIKE 'trg_book_summary_%'").fetchall():
+                connection.execute('DROP TRIGGER %s' % name)
+            connection.execute('DROP TABLE book_summary')
+            connection.execute(SCHEMA_TRANSITIONS[2][-1])  # search_books view
+        self.db.sql.insert('app_config', {'option': 'init_date', 'value': 0})
+        version(self.db, 8)
+        upgrade(self.db)
+        self.assertEqual(version(self.db), CatalogueDB._schema_version)
+        self.assertEqual([tuple(row) for row in self.db.sql.select('book_summary')], before)
+        self.db.getauthor('Lewis').delete()
+        self.assertEqual(self.summary(self.books[0])['authors'], '["Tolkien"]')
+
+    def test_rebuild(self):
+        before = [tuple(row) for row in self.db.sql.select('book_summary')]
+        with self.db.writer as connection:
+            connection.execute('ALTER TABLE book_summary ADD info text')
+        self.db.sql.insert('app_config', {'option': 'init_date', 'value': 0})
+        version(self.db, 9)
+        upgrade(self.db, 10)
+        columns = [row[1] for row in self.db.connection.execute('PRAGMA table_info(book_summary)')]
+        self.assertNotIn('info', columns)
+        indexes = [row[1] for row in self.db.connection.execute('PRAGMA index_list(book_summary)')]
+        self.assertIn('idx_book_summary_title', indexes)
+        self.assertEqual([tuple(row) for row in self.db.sql.select('book_summary')], before)
+        self.db.getauthor('Lewis').delete()
+        self.assertEqual(self.summary(self.books[0])['authors'], '["Tolkien"]')
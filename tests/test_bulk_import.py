@@ -0,0 +1,123 @@
+import io
+import json
+from unittest import TestCase
+
+from hlc.bulk import BulkImporter, export, read_records
+from hlc.db import CatalogueDB
+from hlc.items import Author, Book, ISBN, Series, Tag
+
+
+CSV = '''title,authors,isbn,year,tags,series_name,series_type,book_no,total,in_date
+War and Peace,"Tolstoy, Leo",978-5-389-06256-6,2010,"classic, novel",,,,,01.02.2003
+Anna Karenina,"tolstoy leo; Somebody, Else",,3000,classic,Works,collection,2,5,
+,No title,,,,,,,,
+Duplicate,,9785389062566,,,,,,,
+Unknown series,,,,,Nowhere,,,,
+'''
+
+
+class TestBulkImport(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        self.db.getauthor('Tolstoy, Leo').save()
+        book = self.db.getbook()
+        book.name = 'Existing'
+        book.save()
+
+    def load(self, text, format):
+        importer = BulkImporter(self.db, batch_size=1)
+        importer.run(read_records(io.StringIO(text), format))
+        return importer
+
+    def test_csv(self):
+        importer = self.load(CSV, 'csv')
+        self.assertEqual((importer.rows, importer.books, importer.skipped), (5, 2, 3))
+        self.assertEqual(self.db.sql.select('app_config', {'option': 'book_count'}).fetchone()['value'], '3')
+
+        tolstoy = self.db.getauthor('Tolstoy, Leo')
+        books = {book.name: book for book in (Book(self.db, id) for id in tolstoy.getconnected_id(Book))}
+        self.assertEqual(set(books), {'War and Peace', 'Anna Karenina'})
+        war, anna = books['War and Peace'], books['Anna Karenina']
+        self.assertEqual(war.isbn, ISBN('9785389062566').pretty)
+        self.assertEqual(war.year, 2010)
+        self.assertEqual(war.in_date.year, 2003)
+        self.assertEqual(sorted(tag.name for tag in war.getconnected(Tag)), ['classic', 'novel'])
+        self.assertIsNone(anna.year)
+        self.assertEqual(len(list(anna.getconnected(Author))), 2)
+        series, = anna.getconnected(Series)
+        self.assertEqual((series.name, series.type, series.number_books), ('Works', 'collection', 5))
+        self.assertEqual(self.db.gettag('classic').id, self.db.gettag('CLASSIC').id)
+
+        subquery, params = self.db.search_index.query('karenina')
+        self.assertEqual([row[0] for row in self.db.connection.execute(subquery, params)], [anna.id])
+        record, = self.db.getbookrecords([anna.id])
+        self.assertEqual(record.authors, ('Tolstoy, Leo', 'Somebody, Else'))
+        self.assertEqual([(s.name, s.position) for s in record.series], [('Works', 2)])
+
+    def test_triggers_restored(self):
+        self.load('{"title": "One"}\n\n{"title": "Two", "authors": ["A"]}\n', 'jsonl')
+        book = self.db.getbook()
+        book.name = 'Three'
+        book.isbn = '0-306-40615-2'
+        book.save()
+        self.assertEqual(book.isbn, ISBN('0306406152').pretty)
+        self.assertEqual(self.db.sql.select('app_config', {'option': 'book_count'}).fetchone()['value'], '4')
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            self.load('{"title": "One"}\nnot json\n', 'jsonl')
+        self.assertEqual(self.db.connection.execute('SELECT count(*) FROM books').fetchone()[0], 1)
+        triggers = [row[0] for row in self.db.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'")]
+        for name in BulkImporter.DEFERRED_TRIGGERS:
+            self.assertIn(name, triggers)
+
+    def test_new_series_in_batch(self):
+        importer = BulkImporter(self.db)
+        importer.run(read_records(io.StringIO(
+            '{"title": "First", "series_name": "Cycle", "series_type": "cycle", "book_no": 1}\n'
+            '{"title": "Second", "series_name": "cycle", "book_no": 2}\n'), 'jsonl'))
+        self.assertEqual((importer.rows, importer.books, importer.skipped), (2, 2, 0))
+        series = self.db.getseries('Cycle')
+        self.assertEqual(series.type, 'cycle')
+        self.assertEqual(sorted(book.name for book in series.getconnected(Book)), ['First', 'Second'])
+
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        BulkImporter(self.db).run(read_records(io.StringIO(CSV), 'csv'))
+
+    def test_round_trip(self):
+        for format in ('csv', 'jsonl'):
+            text = ''.join(export(self.db, format, chunk_size=1))
+            copy = CatalogueDB(':memory:')
+            BulkImporter(copy).run(read_records(io.StringIO(text), format))
+            self.assertEqual(''.join(export(copy, 'jsonl')), ''.join(export(self.db, 'jsonl')))
+
+    def test_marc(self):
+        text = ''.join(export(self.db, 'marc'))
+        self.assertEqual(text.count('=LDR  '), 2)
+        self.assertIn('=020  \\\\$a9785389062566\n', text)
+        self.assertIn('=490  0\\$aWorks$v2\n', text)
+        self.assertIn('=700  1\\$aSomebody, Else\n', text)
+
+    def test_several_series(self):
+        BulkImporter(self.db).run(read_records(io.StringIO(
+            '{"title": "Both", "series_name": ["Works", "Cycle", null], '
+            '"series_type": [null, "cycle"], "book_no": [3, 1], "total": [null, 2]}\n'), 'jsonl'))
+        book, = (Book(self.db, id) for id in self.db.getseries('Cycle').getconnected_id(Book))
+        self.assertEqual(sorted(series.name for series in book.getconnected(Series)), ['Cycle', 'Works'])
+        self.assertEqual(self.db.getseries('Cycle').type, 'cycle')
+        for format in ('csv', 'jsonl'):
+            text = ''.join(export(self.db, format))
+            copy = CatalogueDB(':memory:')
+            BulkImporter(copy).run(read_records(io.StringIO(text), format))
+            self.assertEqual(''.join(export(copy, 'jsonl')), ''.join(export(self.db, 'jsonl')))
+        record = json.loads(''.join(export(self.db, 'jsonl')).splitlines()[-1])
+        self.assertEqual(record['series_name'], ['Works', 'Cycle'])
+        self.assertEqual(record['book_no'], [3, 1])
+        text = ''.join(export(self.db, 'marc'))
+        self.assertIn('=490  0\\$aWorks$v3\n=490  0\\$aCycle$v1\n', text)
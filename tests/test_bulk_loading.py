@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from hlc.db import CatalogueDB
+from hlc.items import Author, Series, Tag
+
+
+class TestGetBooks(TestCase):
+    '''New SQLite database is created in memory for each test'''
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        for num in range(10):
+            book = self.db.getbook()
+            book.name = 'Book %s' % num
+            book.save()
+            for author_num in range(num % 3 + 1):
+                author = self.db.getauthor('Author %s' % (num + author_num))
+                author.save()
+                book.connect(author)
+            series = self.db.getseries('Series %s' % (num % 4))
+            series.type = 'cycle'
+            series.save()
+            book.connect(series, num + 1)
+            tag = self.db.gettag('tag%s' % (num % 2))
+            tag.save()
+            tag.connect(book)
+        self.ids = [row[0] for row in self.db.connection.execute(
+                        'SELECT id FROM books ORDER BY id DESC')]
+        self.queries = []
+        self.db.connection.set_trace_callback(self.queries.append)
+
+    def tearDown(self):
+        del self.db
+
+    @staticmethod
+    def summary(book):
+        return (
+            book.id,
+            book.name,
+            [a.name for a in book.getconnected(Author)],
+            [(s.name, s.type, s.position(book))
+             for s in book.getconnected(Series, order='type')],
+            [t.name for t in book.getconnected(Tag)],
+        )
+
+    def test_same_as_lazy(self):
+        bulk = [self.summary(b) for b in self.db.getbooks(self.ids)]
+        lazy = [self.summary(self.db.getbook(id)) for id in self.ids]
+        self.assertEqual(bulk, lazy)
+
+    def test_constant_queries(self):
+        for book in self.db.getbooks(self.ids + [-1, None]):
+            self.summary(book)
+        self.assertEqual(len(self.queries), 4)
+
+    def test_records(self):
+        records = self.db.getbookrecords(self.ids + [-1, None])
+        self.assertEqual(len(self.queries), 1)
+        lazy = [self.summary(self.db.getbook(id)) for id in self.ids]
+        self.assertEqual([
+            (r.id, r.name, list(r.authors),
+             [(s.name, s.type, s.position) for s in r.series], list(r.tags))
+            for r in records], lazy)
+
+    def test_connect_invalidates(self):
+        book = self.db.getbooks(self.ids[:1])[0]
+        author = self.db.getauthor('New Author')
+        author.save()
+        book.connect(author)
+        self.assertIn('New Author', [a.name for a in book.getconnected(Author)])
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import tempfile
+import threading
+from unittest import TestCase
+
+from hlc.db import CatalogueDB, ConnectionPool, ConnectionPoolTimeout
+
+
+class TestConnectionPool(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        filename = os.path.join(self.tmp.name, 'test.sqlite')
+        CatalogueDB(filename).close()
+        self.pool = ConnectionPool(
+            lambda: CatalogueDB(filename, shared=True),
+            size=2,
+            timeout=0.1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.tmp.cleanup()
+
+    def in_thread(self, func):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_same_thread(self):
+        db = self.pool.checkout()
+        self.assertIs(self.pool.checkout(), db)
+        self.pool.release()
+        self.assertIs(self.pool.checkout(), db)
+        self.assertEqual(self.pool.stats['created'], 1)
+
+    def test_pragmas(self):
+        db = self.pool.checkout()
+        mode = db.connection.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_bounded(self):
+        self.pool.checkout()
+        self.in_thread(self.pool.checkout)  # thread exits without release
+        self.assertEqual(self.pool.stats['busy'], 2)
+        self.in_thread(self.pool.checkout)  # connection of dead thread is reused
+        self.assertEqual(self.pool.stats['created'], 2)
+        self.assertEqual(self.pool.stats['reclaimed'], 1)
+
+    def test_timeout(self):
+        hold, done = threading.Event(), threading.Event()
+        def busy():
+            self.pool.checkout()
+            hold.set()
+            done.wait()
+        threads = [threading.Thread(target=busy) for _ in range(2)]
+        for thread in threads:
+            hold.clear()
+            thread.start()
+            hold.wait()
+        try:
+            self.assertRaises(ConnectionPoolTimeout, self.pool.checkout)
+            self.assertEqual(self.pool.stats['waits'], 1)
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join()
+
+
+class TestSharedWriter(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        filename = os.path.join(self.tmp.name, 'test.sqlite')
+        self.main = CatalogueDB(filename, shared=True)
+        self.main.connection.execute('PRAGMA journal_mode=WAL').fetchall()
+        self.reader = CatalogueDB(filename, writer=self.main.writer)
+
+    def tearDown(self):
+        self.reader.close()
+        self.main.close()
+        self.tmp.cleanup()
+
+    def count(self, db):
+        return db.connection.execute('SELECT count(*) FROM tags').fetchone()[0]
+
+    def test_read_only(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.reader._connection.execute("INSERT INTO tags (name) VALUES ('x')")
+        self.reader._connection.rollback()
+        tag = self.reader.gettag('x')
+        tag.save()
+        self.assertEqual(self.count(self.reader), 1)
+
+    def test_isolation(self):
+        with self.reader.writer:
+            self.reader.gettag('x').save()
+            self.reader.gettag('y').save()
+            self.assertEqual(self.count(self.reader), 2)  # sees own changes
+            other = self.count_in_thread()
+            self.assertEqual(other, 0)  # others are not blocked and see old data
+        self.assertEqual(self.count(self.reader), 2)
+
+    def test_rollback(self):
+        with self.assertRaises(ZeroDivisionError):
+            with self.reader.writer:
+                self.reader.gettag('x').save()
+                1/0
+        self.assertEqual(self.count(self.reader), 0)
+
+    def count_in_thread(self):
+        result = []
+        def target():
+            db = CatalogueDB(self.main.filename, writer=self.main.writer)
+            result.append(self.count(db))
+            db.close()
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        return result[0]
@@ -0,0 +1,63 @@
+from unittest import TestCase, mock
+
+from hlc.db import CatalogueDB
+from hlc.db_transition import SCHEMA_TRANSITIONS, upgrade, upgrade_next, version
+from hlc.items import Thumbnail
+
+
+class TestMoveThumbnails(TestCase):
+    '''Upgrade from version 4, when cover images were stored as blobs'''
+
+    images = (b'first image', b'second image', b'first image')
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        with self.db.writer as connection:
+            connection.execute('ALTER TABLE thumbs DROP COLUMN hash')
+            for num, image in enumerate(self.images):
+                connection.execute(
+                    'INSERT INTO thumbs (url, image, last_edit) VALUES (?, ?, ?)',
+                    ('http://example.com/%s' % num, image, 1000 + num))
+        self.db.sql.insert('app_config', {'option': 'init_date', 'value': 0})
+        version(self.db, 4)
+
+    def columns(self):
+        return [row['name'] for row in self.db.connection.execute('PRAGMA table_info(thumbs)')]
+
+    def test_upgrade(self):
+        upgrade(self.db, 5)
+        self.check_moved()
+
+    def test_chunks(self):
+        with mock.patch('hlc.db_transition.THUMBNAILS_CHUNK', 2):
+            upgrade(self.db, 5)
+        self.check_moved()
+
+    def check_moved(self):
+        self.assertEqual(version(self.db), 5)
+        rows = self.db.connection.execute(
+            'SELECT hash, image, last_edit FROM thumbs ORDER BY id').fetchall()
+        self.assertEqual(
+            [tuple(row) for row in rows],
+            [(Thumbnail.checksum(image), None, 1000 + num)
+             for num, image in enumerate(self.images)])
+        storage = self.db.thumbnails
+        for image in set(self.images):
+            with storage.open(Thumbnail.checksum(image), 'rb') as stored:
+                self.assertEqual(stored.read(), image)
+
+    def test_rollback(self):
+        def fail(catalogue_db):
+            '''Fail after thumbnails were moved'''
+            raise RuntimeError('transition failed')
+
+        transitions = {5: SCHEMA_TRANSITIONS[5] + [fail]}
+        with self.assertRaises(RuntimeError):
+            upgrade_next(self.db, transitions)
+        self.assertEqual(version(self.db), 4)
+        self.assertNotIn('hash', self.columns())
+        self.assertEqual(
+            self.db.connection.execute('SELECT count(*) FROM thumbs WHERE image NOT NULL').fetchone()[0],
+            len(self.images))
+        upgrade(self.db, 5)
+        self.assertIn('hash', self.columns())
@@ -0,0 +1,139 @@
+import os
+from timeit import Timer
+from unittest import TestCase, skipUnless
+
+from hlc.db import CatalogueDB, ConnectionPool, QUERIES
+from hlc.items import Author, Book
+
+
+class Plain(object):
+    __slots__ = ('name', 'db', 'id')
+
+    def __init__(self, db=None, id=None):
+        self.db = db
+        self.id = id
+
+
+class TestEntityAttrs(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        book = self.db.getbook()
+        book.name = 'Book'
+        book.year = 2010
+        book.save()
+        self.id = book.id
+        QUERIES.reset('test')
+
+    def test_lazy_fetch(self):
+        book = Book(self.db, self.id)
+        self.assertEqual(QUERIES.queries, 0)
+        self.assertEqual(book.name, 'Book')
+        self.assertEqual(book.year, 2010)
+        self.assertIsNotNone(book.last_edit)
+        self.assertEqual(QUERIES.queries, 1)
+        with self.assertRaises(AttributeError):
+            book.missing
+
+    def test_save_refetches(self):
+        book = Book(self.db, self.id)
+        book.name = 'Other'
+        book.save()
+        self.assertEqual(book.name, 'Other')
+        self.assertEqual(Book(self.db, self.id).name, 'Other')
+
+    def test_deleted(self):
+        book = Book(self.db, self.id)
+        book.delete()
+        for attr in ('id', 'name', 'year'):
+            with self.assertRaises(AttributeError):
+                getattr(book, attr)
+
+    def test_no_queries_on_init(self):
+        books = [Book(self.db, self.id) for i in range(100)]
+        self.assertEqual(QUERIES.queries, 0)
+        self.assertEqual(books[0]._changes, {})
+        self.assertEqual(QUERIES.queries, 0)
+
+
+@skipUnless(os.environ.get('HLC_BENCH'), 'set HLC_BENCH=1 to run benchmarks')
+class TestEntityBenchmark(TestCase):
+    '''Entity costs compared to a plain slotted class'''
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        book = self.db.getbook()
+        book.name = 'Book'
+        book.save()
+        self.id = book.id
+
+    def test_init_speed(self):
+        def best(cls):
+            timer = Timer('cls(db, 1)', globals=dict(cls=cls, db=self.db))
+            return min(timer.repeat(5, 5000))
+
+        # Fields and the fetch query are prepared with the class, creating
+        # an entity only fills a few slots
+        book, plain = best(Book), best(Plain)
+        print('\ninit: Book %.2f us, Plain %.2f us' % (book / 5e-3, plain / 5e-3))
+        self.assertLess(book, plain * 5)
+
+    def test_read_speed(self):
+        book = Book(self.db, self.id)
+        book.name
+        plain = Plain()
+        plain.name = 'Book'
+
+        def best(obj):
+            return min(Timer('obj.name', globals=dict(obj=obj)).repeat(5, 20000))
+
+        # Field read is a C-level getter over a slot. Used to be two orders
+        # of magnitude slower than a plain slot when it went through
+        # __getattribute__
+        book, plain = best(book), best(plain)
+        print('\nread: Book %.1f ns, Plain %.1f ns' % (book / 2e-5, plain / 2e-5))
+        self.assertLess(book, plain * 30)
+
+
+class TestIdentityMap(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:', identity_map=True)
+        book = self.db.getbook()
+        book.name = 'Book'
+        book.save()
+        author = self.db.getauthor('Tolkien')
+        author.save()
+        book.connect(author)
+        self.book = book
+        QUERIES.reset('test')
+
+    def test_shared(self):
+        author = self.db.getauthor('Tolkien')
+        self.assertIs(next(self.book.getconnected(Author)), author)
+        self.assertIs(Book(self.db, self.book.id), self.book)
+        author.name
+        queries = QUERIES.queries
+        self.assertEqual(Author(self.db, author.id).name, 'Tolkien')
+        self.assertEqual(QUERIES.queries, queries)
+
+    def test_reset(self):
+        self.db.reset()
+        self.assertEqual(self.db.identities, {})
+        self.assertIsNot(Book(self.db, self.book.id), self.book)
+        self.assertIsNot(Book(CatalogueDB(':memory:'), 1), Book(CatalogueDB(':memory:'), 1))
+
+    def test_delete(self):
+        id = self.book.id
+        Book(self.db, id).delete()
+        self.assertNotIn((Book, id), self.db.identities)
+        self.assertIsNot(Book(self.db, id), self.book)
+
+    def test_pool_release(self):
+        pool = ConnectionPool(lambda: CatalogueDB(':memory:', shared=True, identity_map=True))
+        db = pool.checkout()
+        Book(db, 1)
+        pool.release()
+        self.assertIs(pool.checkout(), db)
+        self.assertEqual(db.identities, {})
+        pool.close()
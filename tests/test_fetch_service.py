@@ -0,0 +1,209 @@
+import threading
+import time
+from unittest import TestCase, mock
+
+from hlc import fetch
+from hlc.db import CatalogueDB
+from hlc.fetch import FetchService, QueueResolver
+from hlc.items import ISBN, Barcode
+
+
+ISBNS = ('9785389062566', '9780306406157', '9781234567897')
+
+
+def stub(name, info=None, error=None, full=False):
+    '''
+    Create fetcher class that returns `info` or raises `error`. Fetching
+    blocks until `release` event of the class is set
+    '''
+    class Stub(object):
+        release = threading.Event()
+        lock = threading.Lock()
+        created = 0
+        running = 0
+        max_running = 0
+
+        def __init__(self, isbn):
+            cls = type(self)
+            with cls.lock:
+                cls.created += 1
+                cls.running += 1
+                cls.max_running = max(cls.max_running, cls.running)
+            try:
+                cls.release.wait(5)
+                if error:
+                    raise error
+                self.isbn = isbn
+                self.info = {isbn: dict(info or {})}
+            finally:
+                with cls.lock:
+                    cls.running -= 1
+
+        def isfull(self, result):
+            return full
+
+    Stub.__name__ = name
+    return Stub
+
+
+class TestFetchService(TestCase):
+
+    def setUp(self):
+        self.service = FetchService(max_workers=2, concurrency=1)
+        self.stubs = list()
+
+    def tearDown(self):
+        for cls in self.stubs:
+            cls.release.set()
+        self.service._executor.shutdown(wait=True)
+
+    def stub(self, *a, release=True, **kw):
+        cls = stub(*a, **kw)
+        if release:
+            cls.release.set()
+        self.stubs.append(cls)
+        return cls
+
+    def test_coalescing(self):
+        slow = self.stub('Slow', {'title': 'Book'}, release=False)
+        job = self.service.submit(slow, ISBNS[0])
+        self.assertIs(self.service.submit(slow, ISBNS[0]), job)
+        slow.release.set()
+        self.assertEqual(job.result(5).info, {ISBNS[0]: {'title': 'Book'}})
+        self.assertEqual(slow.created, 1)
+        self.assertIsNot(self.service.submit(slow, ISBNS[0]), job)
+
+    def test_limit_per_fetcher(self):
+        slow = self.stub('Slow', release=False)
+        fast = self.stub('Fast', {'title': 'Book'})
+        waiting = [self.service.submit(slow, isbn) for isbn in ISBNS]
+        # both executor threads are free for other fetchers while slow jobs wait
+        self.assertEqual(self.service.submit(fast, ISBNS[0]).result(5).isbn, ISBNS[0])
+        self.assertEqual(self.service.submit(fast, ISBNS[1]).result(5).isbn, ISBNS[1])
+        slow.release.set()
+        self.assertEqual([job.result(5).isbn for job in waiting], list(ISBNS))
+        self.assertEqual(slow.max_running, 1)
+        self.assertEqual(self.service.pending, 0)
+
+    def test_deadline(self):
+        blocked = self.stub('Blocked', release=False)
+        started = time.monotonic()
+        self.assertEqual(list(self.service.fetch([blocked], ISBNS[0], timeout=0.1)), [])
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_failing_skipped(self):
+        broken = self.stub('Broken', error=ValueError('no connection'))
+        good = self.stub('Good', {'title': 'Book'})
+        with self.assertLogs(fetch.log, 'WARNING') as logs:
+            fetchers = list(self.service.fetch([broken, good], ISBNS[0], timeout=5))
+        self.assertEqual([type(f) for f in fetchers], [good])
+        self.assertIn('Broken failed to fetch', logs.output[0])
+
+    def test_book_info_returns_when_full(self):
+        full = self.stub('Full', {'title': 'Book', 'year': 2010}, full=True)
+        blocked = self.stub('Blocked', {'publisher': 'Never'}, release=False)
+        with mock.patch.object(fetch, 'service', self.service), \
+             mock.patch.object(fetch, 'INFO_FETCHERS', [blocked, full]):
+            started = time.monotonic()
+            info = fetch.book_info(ISBNS[0], timeout=5)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(info, {ISBNS[0]: {'title': 'Book', 'year': 2010}})
+
+    def test_book_info_merges(self):
+        first = self.stub('First', {'title': 'Book'})
+        second = self.stub('Second', {'title': 'Other', 'year': 2010})
+        with mock.patch.object(fetch, 'service', self.service), \
+             mock.patch.object(fetch, 'INFO_FETCHERS', [first, second]):
+            info = fetch.book_info(ISBNS[0], timeout=5)
+        self.assertEqual(info[ISBNS[0]]['year'], 2010)
+        self.assertIn(info[ISBNS[0]]['title'], ('Book', 'Other'))
+
+
+class Catalogue(object):
+    '''Stub fetcher that knows a single book'''
+    BOOKS = {
+        ISBNS[0]: {
+            'title': ['War', 'and', 'Peace'],
+            'year': 2010,
+            'thumbnail': ['http://example.com/cover.jpg'],
+        },
+    }
+
+    def __init__(self, isbn):
+        self.isbn = ISBN(isbn).number
+        self.info = {self.isbn: dict(self.BOOKS.get(self.isbn, {}))}
+
+    def isfull(self, result):
+        return True
+
+
+class TestQueueResolver(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        self.ids = dict()
+        for isbn in ISBNS[:2]:
+            barcode = Barcode(self.db)
+            barcode.isbn = isbn
+            barcode.save()
+            self.ids[isbn] = barcode.id
+        self.service = FetchService()
+        patches = (
+            mock.patch.object(fetch, 'service', self.service),
+            mock.patch.object(fetch, 'INFO_FETCHERS', [Catalogue]),
+            mock.patch.object(fetch, 'THUMB_FETCHERS', [Catalogue]),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.resolver = QueueResolver(lambda: self.db)
+
+    def tearDown(self):
+        self.service._executor.shutdown(wait=True)
+
+    def test_drain(self):
+        self.resolver.resolve_pending(self.db)
+        found = Barcode(self.db, self.ids[ISBNS[0]])
+        self.assertEqual(found.title, 'War and Peace')
+        self.assertEqual(found.info[ISBNS[0]]['year'], 2010)
+        self.assertEqual(found.thumbs, {ISBNS[0]: {'thumbnail': ['http://example.com/cover.jpg']}})
+        self.assertIsNotNone(found.fetched)
+        empty = Barcode(self.db, self.ids[ISBNS[1]])
+        self.assertIsNone(empty.title)
+        self.assertIsNone(empty.info)
+        self.assertIsNone(empty.fetched)
+
+    def test_stats(self):
+        self.assertEqual(self.resolver.stats['per_minute'], None)
+        self.resolver.resolve_pending(self.db)
+        stats = self.resolver.stats
+        self.assertEqual(
+            (stats['resolved'], stats['empty'], stats['failed'], stats['pending']),
+            (1, 1, 0, 0))
+        self.assertGreater(stats['per_minute'], 0)
+        self.resolver.resolve_pending(self.db)  # fetched barcodes are skipped
+        self.assertEqual(self.resolver.stats['resolved'], 1)
+        self.assertEqual(self.resolver.stats['empty'], 1)  # and so are recent retries
+
+    def test_retry(self):
+        calls = list()
+        original = QueueResolver._fetch
+
+        def counted(isbn):
+            calls.append(isbn)
+            return original(isbn)
+
+        self.resolver.RETRY_INTERVAL = 0
+        with mock.patch.object(QueueResolver, '_fetch', side_effect=counted):
+            self.resolver.resolve_pending(self.db)
+            self.resolver.resolve_pending(self.db)
+        self.assertEqual(sorted(calls), sorted([ISBNS[0], ISBNS[1], ISBNS[1]]))
+        self.assertEqual(self.resolver.stats['empty'], 2)
+        self.assertIsNone(Barcode(self.db, self.ids[ISBNS[1]]).fetched)
+
+    def test_failed(self):
+        with mock.patch.object(QueueResolver, '_fetch', side_effect=RuntimeError('broken')), \
+             self.assertLogs(fetch.log, 'WARNING'):
+            self.resolver.resolve_pending(self.db)
+        self.assertEqual(self.resolver.stats['failed'], 2)
+        self.assertIsNone(Barcode(self.db, self.ids[ISBNS[0]]).fetched)
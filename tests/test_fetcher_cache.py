@@ -1,7 +1,9 @@
+import os
 import random
+import tempfile
 from unittest import TestCase
 
-from hlc.fetcher_cache import StrongCache, WeakAndStrongCache
+from hlc.fetcher_cache import PersistentCache, StrongCache, WeakAndStrongCache
 
 
 class Dummy:
@@ -101,3 +103,35 @@ class TestWeakAndStrongCache(TestStrongCache):
         length = len(self.cache)
         del strong_ref
         self.assertEqual(len(self.cache), length - strong_ref_count)
+
+
+class TestPersistentCache(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, 'cache.sqlite')
+        self.cache = PersistentCache(self.filename)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tempdir.cleanup()
+
+    def test_survives_reopen(self):
+        value = {'1234567890': {'title': 'Hello', 'authors': ['World']}}
+        self.cache.set('key', value, 60)
+        self.cache.close()
+        self.cache = PersistentCache(self.filename)
+        self.assertEqual(self.cache.get('key'), value)
+        self.assertIn('key', self.cache)
+
+    def test_expiration(self):
+        self.cache.set('old', {}, -1)
+        self.cache.set('new', {}, 60)
+        self.assertNotIn('old', self.cache)
+        self.assertEqual(self.cache.get('old', 'default'), 'default')
+        self.assertEqual(self.cache.get('new'), {})
+
+    def test_delete(self):
+        self.cache.set('key', [1, 2, 3], 60)
+        del self.cache['key']
+        self.assertNotIn('key', self.cache)
@@ -0,0 +1,46 @@
+from unittest import TestCase, mock
+
+from hlc.util import LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(size=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_expiration(self):
+        cache = LRUCache(ttl=10)
+        with mock.patch('hlc.util.time.monotonic', return_value=100):
+            cache['a'] = 1
+        with mock.patch('hlc.util.time.monotonic', return_value=105):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('hlc.util.time.monotonic', return_value=111):
+            self.assertIsNone(cache.get('a'))
+
+    def test_discard(self):
+        cache = LRUCache()
+        for key, user in (('x', 1), ('y', 2), ('z', 1)):
+            cache[key] = (user, 'session')
+        cache.discard(lambda key, value: value[0] == 1)
+        self.assertEqual([cache.get(k) for k in 'xyz'], [None, (2, 'session'), None])
+        self.assertEqual(cache.pop('y'), (2, 'session'))
+        self.assertIsNone(cache.pop('y'))
+
+    def test_weight(self):
+        cache = LRUCache(size=10, weigh=len)
+        cache['a'] = 'x' * 4
+        cache['b'] = 'x' * 4
+        cache['c'] = 'x' * 4
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.weight, 8)
+        cache['d'] = 'x' * 11  # too big to be stored at all
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
@@ -0,0 +1,50 @@
+from unittest import TestCase
+
+from hlc.db import CatalogueDB
+from hlc.db_transition import SCHEMA_TRANSITIONS, upgrade, version
+
+
+class TestNameKeys(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        for name in ('Толстой, Лев', 'Tolkien, J.R.R.', 'Tolstoy'):
+            self.db.getauthor(name).save()
+
+    def test_lookup(self):
+        self.assertTrue(self.db.getauthor('толстой лев').saved)
+        self.assertTrue(self.db.getauthor('TOLKIEN JRR').saved)
+        self.assertFalse(self.db.getauthor('Tolkien').saved)
+
+    def test_rename(self):
+        author = self.db.getauthor('tolstoy')
+        author.name = 'Tolstoy, L.'
+        author.save()
+        self.assertEqual(self.db.getauthor('tolstoy l').id, author.id)
+        self.assertFalse(self.db.getauthor('tolstoy').saved)
+
+    def test_suggestions(self):
+        suggest = self.db.getsuggestions
+        self.assertEqual(suggest('TOL', 'authors', 'name'), ['Tolkien, J.R.R.', 'Tolstoy'])
+        self.assertEqual(suggest('толс', 'authors', 'name'), ['Толстой, Лев'])
+        self.assertEqual(suggest('tol', 'authors', 'name', count=1), ['Tolkien, J.R.R.'])
+        self.assertEqual(suggest('...', 'authors', 'name'), [])
+
+    def test_upgrade(self):
+        with self.db.writer as connection:
+            for table in CatalogueDB.NAME_KEYS:
+                connection.execute('DROP INDEX idx_%s_name_key' % table)
+                for event in ('insert', 'update'):
+                    connection.execute('DROP TRIGGER trg_%s_name_key_%s' % (table, event))
+                connection.execute('ALTER TABLE %s DROP COLUMN name_key' % table)
+            for name, in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE name LIKE 'trg_book_summary_%'").fetchall():
+                connection.execute('DROP TRIGGER %s' % name)
+            connection.execute('DROP TABLE book_summary')
+            connection.execute(SCHEMA_TRANSITIONS[2][-1])  # search_books view
+        self.db.sql.insert('app_config', {'option': 'init_date', 'value': 0})
+        version(self.db, 7)
+        upgrade(self.db)
+        self.assertEqual(version(self.db), CatalogueDB._schema_version)
+        self.test_lookup()
+        self.test_suggestions()
@@ -0,0 +1,66 @@
+from unittest import TestCase, mock
+
+from hlc.db import CatalogueDB, QUERIES, QueryStats, inefficient_steps, query_plan
+
+
+class TestQueryStats(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        QUERIES.reset('test')
+
+    def test_summary(self):
+        self.db.sql.insert('tags', {'name': 'one'})
+        self.db.sql.insert('tags', {'name': 'two'})
+        list(self.db.sql.select('tags'))
+        self.assertEqual(QUERIES.queries, 3)
+        self.assertEqual(QUERIES.rows, 2)
+        self.assertGreater(QUERIES.time, 0)
+        self.assertIn('desc="3 queries"', QUERIES.summary)
+        QUERIES.reset()
+        self.assertEqual(QUERIES.queries, 0)
+
+    def test_slow_log(self):
+        with mock.patch.object(QueryStats, 'slow_threshold', 0), \
+             self.assertLogs(QueryStats.slow_log, 'WARNING') as logs:
+            self.db.sql.select('tags', {'name': 'one'})
+        message, = logs.output
+        self.assertIn('route: test', message)
+        self.assertIn("Parameters: ['one']", message)
+        self.assertIn('SEARCH tags', message)
+
+
+class TestQueryPlans(TestCase):
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+
+    def plan(self, query, params=()):
+        return inefficient_steps(query_plan(self.db.connection, query, params))
+
+    def test_link_tables(self):
+        for table, column in (('book_authors', 'author_id'),
+                              ('book_tags', 'tag_id'),
+                              ('book_series', 'series_id')):
+            query = 'SELECT book_id FROM %s WHERE %s=?' % (table, column)
+            self.assertEqual(self.plan(query, (1,)), [])
+
+    def test_sorting(self):
+        self.assertEqual(self.plan('SELECT id FROM books ORDER BY last_edit DESC'), [])
+        self.assertEqual(self.plan('SELECT id FROM books ORDER BY price'), [
+            'SCAN books',
+            'USE TEMP B-TREE FOR ORDER BY',
+        ])
+
+    def test_search_sorting(self):
+        for key in ('in_date DESC', 'year', 'title', 'author'):
+            query = 'SELECT id FROM book_summary ORDER BY %s LIMIT 10' % key
+            self.assertEqual(self.plan(query), [], key)
+
+    def test_keyset(self):
+        for query in ('SELECT id FROM books WHERE (last_edit, id) < (?, ?) '
+                      'ORDER BY last_edit DESC, id DESC LIMIT ?',
+                      'SELECT id FROM book_reviews WHERE book_id = ? AND (date, id) > (?, ?) '
+                      'ORDER BY date ASC, id ASC LIMIT ?'):
+            params = (0,) * query.count('?')
+            self.assertEqual(self.plan(query, params), [])
@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+from hlc.db import CatalogueDB, SearchIndex
+from hlc.items import Author
+
+
+class TestSearchIndex(TestCase):
+    '''New SQLite database is created in memory for each test'''
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        self.book = self.add_book('Lord of the Rings', 'Tolkien, John')
+        self.other = self.add_book('The Hobbit', 'Tolkien, John')
+
+    def tearDown(self):
+        del self.db
+
+    def add_book(self, title, author):
+        book = self.db.getbook()
+        book.name = title
+        book.save()
+        author = self.db.getauthor(author)
+        author.save()
+        book.connect(author)
+        return book
+
+    def search(self, text):
+        subquery, params = self.db.search_index.query(text)
+        if subquery is None:
+            return None
+        return set(row[0] for row in self.db.connection.execute(subquery, params))
+
+    def test_words(self):
+        for text, ids in (
+            ('tolkien', {self.book.id, self.other.id}),
+            ('hobbit TOLKIEN', {self.other.id}),
+            ('tolk*', {self.book.id, self.other.id}),
+            ('*bbit', {self.other.id}),
+            ('*obbi*', {self.other.id}),
+            ('tolk', set()),
+            ('of', None),
+        ):
+            with self.subTest(text=text):
+                self.assertEqual(self.search(text), ids)
+
+    def test_updates(self):
+        author = next(self.book.getconnected(Author))
+        author.name = 'Professor, Tolkien'
+        author.save()
+        self.assertEqual(self.search('professor'), {self.book.id, self.other.id})
+        self.book.disconnect(author)
+        self.assertEqual(self.search('professor'), {self.other.id})
+        self.other.delete()
+        self.assertEqual(self.search('professor'), set())
+
+    def test_rebuild(self):
+        self.db.connection.execute('DELETE FROM %s' % (
+            SearchIndex.FTS_TABLE if self.db.search_index.fts
+            else SearchIndex.TOKENS_TABLE))
+        self.assertEqual(self.search('tolkien'), set())
+        self.db.search_index.rebuild()
+        self.assertEqual(self.search('tolkien'), {self.book.id, self.other.id})
+
+
+class TestSearchIndexFallback(TestSearchIndex):
+    '''Run all tests for posting lists table instead of FTS5'''
+
+    def setUp(self):
+        self._fts5 = SearchIndex._fts5_support
+        SearchIndex._fts5_support = False
+        super().setUp()
+        self.assertFalse(self.db.search_index.fts)
+
+    def tearDown(self):
+        super().tearDown()
+        SearchIndex._fts5_support = self._fts5
@@ -0,0 +1,81 @@
+import os
+from types import SimpleNamespace
+from unittest import TestCase
+
+from bottle import template
+
+import hlc
+from hlc.db import CatalogueDB, QUERIES
+from hlc.items import Author, Series
+from hlc.mvc.book import BookSummary
+from hlc.mvc.templates import ProfiledTemplate, precompile
+from hlc.util import LinCrypt
+
+
+class TestTemplates(TestCase):
+
+    lookup = [os.path.join(os.path.dirname(hlc.__file__), 'ui', 'templates')]
+
+    def setUp(self):
+        precompile(self.lookup)
+        self.db = CatalogueDB(':memory:')
+        self.db.connection.set_trace_callback(QUERIES.trace)
+        self.id = SimpleNamespace(**{
+            key: LinCrypt(1000 + num) for num, key in enumerate(('book', 'thumb', 'series'))
+        })
+        book = self.db.getbook()
+        book.name = 'Book'
+        book.save()
+        for name in ('Author, A', 'Author, B'):
+            author = self.db.getauthor(name)
+            author.save()
+            book.connect(author)
+        series = self.db.getseries('Series')
+        series.type = 'cycle'
+        series.number_books = 3
+        series.save()
+        book.connect(series, 2)
+        self.book_id = book.id
+
+    def render(self, name, book):
+        return template(
+            name,
+            book=book,
+            id=self.id,
+            hide=set(),
+            template_lookup=self.lookup,
+        )
+
+    def test_precompiled(self):
+        self.assertIn('book_short', ProfiledTemplate._pinned)
+        self.assertEqual(precompile(self.lookup), 0)
+
+    def test_summary_renders_without_queries(self):
+        book, = self.db.getbooks([self.book_id])
+        summary = BookSummary(book, self.id)
+        before = QUERIES.count
+        profiled = ProfiledTemplate.stats().get('book_short', {})
+        for name in ('book_short', 'book_preview'):
+            html = self.render(name, summary)
+            self.assertIn('Author A, Author B', html)
+            self.assertIn('книга 2 из 3', html)
+        self.assertEqual(QUERIES.count, before)
+        stats = ProfiledTemplate.stats()['book_short']
+        self.assertEqual(stats['renders'], profiled.get('renders', 0) + 1)
+        self.assertEqual(stats['queries'], profiled.get('queries', 0))
+
+    def test_same_as_live_object(self):
+        for name in ('book_short', 'book_preview'):
+            book = self.db.getbook(self.book_id)
+            summary = BookSummary(book, self.id)
+            self.assertEqual(
+                self.render(name, book),
+                self.render(name, summary))
+
+    def test_record_same_as_live_object(self):
+        record, = self.db.getbookrecords([self.book_id])
+        for name in ('book_short', 'book_preview'):
+            book = self.db.getbook(self.book_id)
+            self.assertEqual(
+                self.render(name, book),
+                self.render(name, BookSummary.from_record(record, self.id)))
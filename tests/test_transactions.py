@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+from hlc.db import CatalogueDB
+from hlc.items import Author, Series, Tag
+
+
+class TestTransaction(TestCase):
+    '''New SQLite database is created in memory for each test'''
+
+    def setUp(self):
+        self.db = CatalogueDB(':memory:')
+        self.book = self.db.getbook()
+        self.book.name = 'Book'
+        self.book.save()
+        self.queries = []
+        self.db.connection.set_trace_callback(self.queries.append)
+
+    def tearDown(self):
+        del self.db
+
+    def saved(self, items):
+        for item in items:
+            item.save()
+        return items
+
+    def edit(self, authors, tags):
+        with self.db.transaction():
+            self.book.name = 'Book, edited'
+            self.book.save()
+            self.book.setconnected(Author, self.saved(
+                [self.db.getauthor('Author %s' % x) for x in authors]))
+            self.book.setconnected(Tag, self.saved(
+                [self.db.gettag('tag%s' % x) for x in tags]))
+
+    def names(self, cls):
+        return sorted(x.name for x in self.book.getconnected(cls))
+
+    def test_single_commit(self):
+        self.edit(range(5), range(10))
+        self.assertEqual(self.queries.count('COMMIT'), 1)
+        self.assertEqual(self.names(Author), ['Author %s' % x for x in range(5)])
+        self.assertEqual(len(self.names(Tag)), 10)
+        subquery, params = self.db.search_index.query('author')
+        self.assertEqual(
+            [row[0] for row in self.db.connection.execute(subquery, params)],
+            [self.book.id])
+
+    def test_diff(self):
+        self.edit(range(5), range(3))
+        self.queries.clear()
+        self.edit(range(2, 7), range(3))
+        self.assertEqual(self.names(Author), ['Author %s' % x for x in range(2, 7)])
+        # statements are traced again for each book_summary trigger step
+        bulk = set(q for q in self.queries if 'book_authors' in q and 'SELECT' not in q)
+        self.assertEqual(len(bulk), 4)  # executemany runs the statement per row
+        self.assertFalse([q for q in self.queries if 'book_tags' in q and 'SELECT' not in q])
+
+    def test_series_numbers(self):
+        series = self.db.getseries('Series')
+        series.type = 'cycle'
+        series.save()
+        self.book.setconnected(Series, [(series, 1)])
+        self.book.setconnected(Series, [(series, 2)])
+        self.assertEqual(series.position(self.book), 2)
+        self.book.setconnected(Series, [])
+        self.assertEqual(self.names(Series), [])
+
+    def test_rollback(self):
+        self.edit(range(2), range(2))
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.book.setconnected(Author, [])
+                self.book.name = 'Lost'
+                self.book.save()
+                raise RuntimeError('partial failure')
+        book = self.db.getbook(self.book.id)
+        self.assertEqual(book.name, 'Book, edited')
+        self.assertEqual(len(book.getconnected_id(Author)), 2)
@@ -0,0 +1,160 @@
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+from unittest import TestCase, mock
+from urllib.parse import unquote, urlencode
+from wsgiref.util import setup_testing_defaults
+
+import hlc
+from hlc.cfg import Configuration
+from hlc.items import Barcode, Thumbnail
+from hlc.launcher import DEFAULT_CONFIGURATION
+from hlc.web import WebUI
+
+
+class WebUITestCase(TestCase):
+    '''WebUI with a fresh database in temporary directory, logged in as admin'''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        config = json.loads(json.dumps(DEFAULT_CONFIGURATION))
+        config['app']['root'] = os.path.dirname(hlc.__file__)
+        config['app']['data_dir'] = self.tmp
+        config['fetch']['queue_workers'] = 0
+        self.ui = WebUI(os.path.join(self.tmp, 'db.sqlite'), Configuration(config))
+        user, password = self.ui.option.get('init_user').split(':')
+        status, headers, body = self.call(
+            '/login', 'POST', body=urlencode({'user': user, 'password': password}))
+        self.cookie = headers['Set-Cookie'].split(';')[0]
+
+    def tearDown(self):
+        self.ui._connections.close()
+        self.ui._writer_db.close()
+        shutil.rmtree(self.tmp)
+
+    def call(self, path, method='GET', body='', headers=None):
+        '''Return status, headers and body of HTTP response'''
+        environ = dict()
+        setup_testing_defaults(environ)
+        path, _, query = path.partition('?')
+        body = body.encode()
+        environ.update(
+            PATH_INFO=path,
+            QUERY_STRING=query,
+            REQUEST_METHOD=method,
+            CONTENT_TYPE='application/x-www-form-urlencoded',
+            CONTENT_LENGTH=str(len(body)),
+        )
+        environ['wsgi.input'] = io.BytesIO(body)
+        if getattr(self, 'cookie', None):
+            environ['HTTP_COOKIE'] = self.cookie
+        environ.update(headers or {})
+        response = dict()
+
+        def start_response(status, headers, exc_info=None):
+            response.update(status=status, headers=dict(headers))
+
+        chunks = self.ui(environ, start_response)
+        try:
+            body = b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return response['status'], response['headers'], body
+
+
+class TestThumbnails(WebUITestCase):
+
+    def test_not_modified(self):
+        data = b'not really a jpeg'
+        key = Thumbnail.checksum(data)
+        self.ui.db.thumbnails[key] = io.BytesIO(data)
+        self.ui.db.sql.insert('thumbs', {'url': 'http://example.com', 'hash': key})
+        id, = self.ui.db.connection.execute('SELECT id FROM thumbs').fetchone()
+        path = '/thumbs/%s' % self.ui.id.thumb.encode(id)
+
+        status, headers, body = self.call(path)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, data)
+        self.assertEqual(headers['Etag'], '"%s"' % key)
+        status, headers, body = self.call(path, headers={'HTTP_IF_NONE_MATCH': '"other", "%s"' % key})
+        self.assertEqual(status[:3], '304')
+        self.assertEqual(body, b'')
+
+
+class TestAjaxFill(WebUITestCase):
+
+    isbn = '9785389062566'
+
+    def test_queued_info(self):
+        barcode = Barcode(self.ui.db)
+        barcode.isbn = self.isbn
+        barcode.info = {self.isbn: {'title': 'War and Peace'}}
+        barcode.thumbs = {self.isbn: {'thumbnail': ['http://example.com/cover.jpg']}}
+        barcode.save()
+        with mock.patch('hlc.web.book_info', side_effect=AssertionError('fetched')), \
+             mock.patch('hlc.web.book_thumbs', side_effect=AssertionError('fetched')):
+            status, headers, body = self.call('/ajax/fill?isbn=%s' % self.isbn)
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(json.loads(body), {self.isbn: {'title': 'War and Peace'}})
+            status, headers, body = self.call('/ajax/fill?isbn=%s&thumbs=1' % self.isbn)
+            self.assertEqual(json.loads(body)[self.isbn]['thumbnail'], ['http://example.com/cover.jpg'])
+
+
+class TestTableViewer(WebUITestCase):
+
+    def setUp(self):
+        super().setUp()
+        for number in range(1, 6):
+            book = self.ui.db.getbook()
+            book.name = 'Book %s' % number
+            book.publisher = 'Publisher %s' % (number % 3)
+            book.save()
+
+    def page(self, path):
+        '''Return first cells of table rows and links to previous and next pages'''
+        status, headers, body = self.call(path)
+        self.assertEqual(status, '200 OK')
+        html = body.decode()
+        cells = re.findall(r'<div class="rTableRow">\s*<div class="rTableCell">(.*?)</div>', html)
+        links = {name: unquote(link).replace('&amp;', '&') for name, link in
+                 re.findall(r'<a class="(prev|next)" href="([^"]*)"', html)}
+        return cells, links
+
+    def test_blob(self):
+        self.ui.db.sql.insert('thumbs', {'url': 'http://example.com', 'image': b'\xff<secret>' * 10})
+        status, headers, body = self.call('/table/thumbs')
+        self.assertEqual(status, '200 OK')
+        self.assertIn(b'&lt;BLOB: 90 bytes&gt;', body)
+        self.assertNotIn(b'secret', body)
+        self.assertIn(b'http://example.com', body)
+
+    def test_rowid_pages(self):
+        ids, links = self.page('/table/books?ps=2')
+        self.assertEqual(ids, ['5', '4'])
+        self.assertEqual(set(links), {'next'})
+        ids, links = self.page('/table/books' + links['next'])
+        self.assertEqual(ids, ['3', '2'])
+        self.assertEqual(set(links), {'prev', 'next'})
+        ids, links = self.page('/table/books' + links['next'])
+        self.assertEqual(ids, ['1'])
+        ids, links = self.page('/table/books' + links['prev'])
+        self.assertEqual(ids, ['3', '2'])
+
+    def test_view_pages(self):
+        names, links = self.page('/table/publishers?ps=2')
+        self.assertEqual(len(names), 2)
+        self.assertEqual(links['next'], '?ps=2&p=1')
+        self.assertNotIn('prev', links)
+        rest, links = self.page('/table/publishers' + links['next'])
+        self.assertEqual(set(names + rest), {'Publisher 0', 'Publisher 1', 'Publisher 2'})
+        self.assertEqual(links['prev'], '?ps=2&p=0')
+
+    def test_unknown(self):
+        for name in ('nope', 'books"', 'books;drop table books', 'sqlite_master'):
+            status, headers, body = self.call('/table/' + name)
+            self.assertEqual(status[:3], '404', name)
+        self.assertEqual(self.ui.db.connection.execute('SELECT count(*) FROM books').fetchone()[0], 5)